@@ -32,3 +32,157 @@ proxy_port = 8888
 proxy_user = 'proxyuser'
 good_proxy_pass = 'proxypass'
 bad_proxy_pass = 'badproxypass'
+
+import re
+import ssl
+import time
+import random
+import hashlib
+import threading
+from email.utils import formatdate
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keepalive
+    disable_nagle_algorithm = True # headers and body are sent apart
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_GET(self, body=True):
+        self.server.requests.append((self.path, dict(self.headers)))
+        if self.server.fail:
+            self.send_response(self.server.fail.pop(0))
+            if self.server.retry_after is not None:
+                self.send_header('Retry-After', str(self.server.retry_after))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        last_modified = None
+        if self.server.last_modified is not None:
+            last_modified = formatdate(self.server.last_modified, usegmt=True)
+        ranges = []
+        spec = self.headers.get('Range') or ''
+        if not self.server.ranges:
+            spec = ''
+        if self.headers.get('If-Range') not in (None, etag, last_modified):
+            spec = '' # changed, send all of it
+        if spec.startswith('bytes='):
+            for r in spec[6:].split(','):
+                m = re.match(r'(\d+)-(\d*)$', r.strip())
+                if m:
+                    end = len(data)
+                    if m.group(2): end = min(int(m.group(2)) + 1, end)
+                    ranges.append((int(m.group(1)), end))
+        if not self.server.multipart:
+            ranges = ranges[:1]
+        if ranges and ranges[0][0] >= len(data) > 0:
+            self.send_error(416)
+            return
+        if len(ranges) > 1:
+            boundary = b'THIS_STRING_SEPARATES'
+            parts = [b'--%s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n%s\r\n'
+                     % (boundary, start, end - 1, len(data), data[start:end])
+                     for start, end in ranges]
+            data = b''.join(parts) + b'--%s--\r\n' % boundary
+            self.send_response(206)
+            self.send_header('Content-Type', 'multipart/byteranges; boundary='
+                             + boundary.decode())
+            start, end = 0, len(data)
+        else:
+            start, end = ranges and ranges[0] or (0, len(data))
+            self.send_response(ranges and 206 or 200)
+            if ranges:
+                self.send_header('Content-Range',
+                                 'bytes %d-%d/%d' % (start, end - 1, len(data)))
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('ETag', etag)
+        if last_modified:
+            self.send_header('Last-Modified', last_modified)
+        self.end_headers()
+        if body:
+            self.send_body(data[start:end])
+
+    def send_body(self, data):
+        rate, loss = self.server.rate, self.server.loss
+        if loss and random.random() < loss:
+            # drop the connection half-way
+            data = data[:len(data) // 2]
+            self.close_connection = True
+        if not rate:
+            self.wfile.write(data)
+            return
+        step = max(rate // 20, 1)
+        for pos in range(0, len(data), step):
+            self.wfile.write(data[pos:pos + step])
+            time.sleep(float(len(data[pos:pos + step])) / rate)
+
+class LocalHTTPServer(ThreadingMixIn, HTTPServer):
+    """A threaded HTTP/1.1 server on localhost.  Serves the bytes in the
+    'files' dict (keyed by path, eg '/reference') and supports simple
+    byte ranges, unless 'ranges' is cleared, and If-None-Match.  Several
+    ranges get a multipart/byteranges response, or only the first one
+    if 'multipart' is cleared.  When
+    'last_modified' is set to a timestamp, it is sent and If-Range is
+    honoured.  While the 'fail' list isn't empty, requests are
+    answered with the status codes popped from it, with a Retry-After
+    header if 'retry_after' is set.  Received requests are recorded in
+    'requests', and accepted connections are counted in
+    'connections'.  Bodies are sent at 'rate' bytes per second if it's
+    set, and with probability 'loss' only half of a body is sent before
+    the connection is closed.  With a certfile, it's an HTTPS server."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, files=None, certfile=None):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _RequestHandler)
+        scheme = 'http'
+        if certfile:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile)
+            self.socket = context.wrap_socket(self.socket, server_side=True,
+                                              do_handshake_on_connect=False)
+            scheme = 'https'
+        self.files = files or {}
+        self.requests = []
+        self.connections = 0
+        self.ranges = True
+        self.multipart = True
+        self.last_modified = None
+        self.fail = []
+        self.retry_after = None
+        self.rate = None
+        self.loss = 0.0
+        self.base = '%s://127.0.0.1:%d/' % (scheme, self.server_address[1])
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def handle_error(self, request, client_address):
+        pass # clients hanging up early is expected
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
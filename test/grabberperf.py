@@ -21,119 +21,338 @@
 
 from __future__ import print_function
 
+"""Usage: python grabberperf.py [OPTIONS] [SCENARIO ...]
+Benchmark urlgrabber against local HTTP servers and print the
+results as JSON.
+
+OPTIONS:
+
+  -o, --output=FILE      Write the results to FILE instead of stdout.
+  -c, --compare=FILE     Compare the results with those in FILE, and
+                         exit with 1 if any got worse by more than
+                         the threshold.
+  -t, --threshold=FRAC   The relative change that is a regression.
+                         Defaults to 0.1.
+  -s, --scale=FACTOR     Scale the number and the size of the files.
+                         Defaults to 1.
+  -b, --backend=NAME     parallel_backend for parallel_wait().
+                         Defaults to curlmulti.
+  --https                Use HTTPS.  Needs the openssl command.
+  --rate=BYTES           Send bodies at BYTES per second.
+  --loss=PROB            Cut bodies short with probability PROB.
+
+The scenarios are %s, all by default.  Each runs in a child
+process, so that its CPU time and peak RSS are not mixed with those
+of the servers or of the other scenarios.  For each one, the number
+of requests and errors, the bytes, the wall time, the throughput in
+bytes per second, the p50 and p99 request latency, the CPU time and
+the peak RSS in kB are reported.  The reget scenario always runs on
+a lossy server.
+"""
+
 import sys
 import os
 from os.path import dirname, join as joinpath
 import tempfile
+import shutil
+import subprocess
+import json
 import time
+import resource
+from getopt import getopt
 
-import urlgrabber.grabber as grabber
-from urlgrabber.grabber import URLGrabber, urlgrab, urlopen, urlread
-from urlgrabber.progress import text_progress_meter
+timer = getattr(time, 'perf_counter', time.time)
 
-tempsrc = '/tmp/ug-test-src'
-tempdst = '/tmp/ug-test-dst'
+SMALL = 4 * 1024
+MEDIUM = 64 * 1024
+HUGE = 64 * 1024 * 1024
+REGET = 16 * 1024 * 1024
 
-# this isn't used but forces a proxy handler to be
-# added when creating the urllib2 opener.
-proxies = { 'http' : 'http://localhost' }
-DEBUG=0
+def counts(scale):
+    def n(count):
+        return max(int(count * scale), 1)
+    return {'small': n(500), 'failover': n(100), 'hosts': 4,
+            'parallel': n(50), 'huge': n(HUGE), 'reget': n(REGET),
+            'regets': n(4)}
 
-def main():
-    speedtest(1024)         # 1KB
-    speedtest(10 * 1024)    # 10 KB
-    speedtest(100 * 1024)   # 100 KB
-    speedtest(1000 * 1024)  # 1,000 KB (almost 1MB)
-    #speedtest(10000 * 1024) # 10,000 KB (almost 10MB)
-    # remove temp files
-    os.unlink(tempsrc)
-    os.unlink(tempdst)
-
-def setuptemp(size):
-    if DEBUG: print('writing %d KB to temporary file (%s).' % (size / 1024, tempsrc))
-    file = open(tempsrc, 'w', 1024)
-    chars = '0123456789'
-    for i in range(size):
-        file.write(chars[i % 10])
-    file.flush()
-    file.close()
-
-def speedtest(size):
-    setuptemp(size)
-    full_times = []
-    raw_times = []
-    none_times = []
-    throttle = 2**40 # throttle to 1 TB/s   :)
+def make_files(scale):
+    c = counts(scale)
+    chunk = b'0123456789abcdef' * 4096
+    def data(size):
+        return (chunk * (size // len(chunk) + 1))[:size]
+    small, medium = data(SMALL), data(MEDIUM)
+    files = {'/huge': data(c['huge']), '/reget': data(c['reget'])}
+    for i in range(c['small']):
+        files['/small/%d' % i] = small
+    for i in range(c['parallel']):
+        files['/medium/%d' % i] = medium
+    return files
+
+#####################################################################
+# scenarios, run in the child processes
+
+class Timings:
+    """the latencies and the failures of the requests of a scenario"""
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+
+    def timed(self, func, *args, **kwargs):
+        t = timer()
+        try:
+            func(*args, **kwargs)
+        except URLGrabError:
+            self.errors += 1
+        else:
+            self.latencies.append(timer() - t)
+
+def small_files(cfg, dst, timings):
+    "many small files, one at a time"
+    g = URLGrabber(**cfg['opts'])
+    base = cfg['bases'][0]
+    for i in range(counts(cfg['scale'])['small']):
+        timings.timed(g.urlgrab, base + 'small/%d' % i, dst)
+
+def huge_file(cfg, dst, timings):
+    "a single huge file"
+    g = URLGrabber(**cfg['opts'])
+    timings.timed(g.urlgrab, cfg['bases'][0] + 'huge', dst)
+
+def mirror_failover(cfg, dst, timings):
+    "small files from a MirrorGroup whose first mirror 404s"
+    g = URLGrabber(**cfg['opts'])
+    base = cfg['bases'][0]
+    mg = MirrorGroup(g, [base + 'missing/', base],
+                     default_action={'increment_master': 0})
+    for i in range(counts(cfg['scale'])['failover']):
+        timings.timed(mg.urlgrab, 'small/%d' % i, dst)
+
+def parallel(cfg, dst, timings):
+    "parallel_wait() with files from several hosts"
+    grabber.default_grabber.opts.parallel_backend = cfg['backend']
+    def checkfunc(opts):
+        timings.latencies.append(opts.stats.total)
+    def failfunc(opts):
+        timings.errors += 1
+    for base in cfg['bases']:
+        for i in range(counts(cfg['scale'])['parallel']):
+            urlgrab(base + 'medium/%d' % i, dst, async_=(base, 2),
+                    checkfunc=checkfunc, failfunc=failfunc, **cfg['opts'])
+    grabber.parallel_wait()
+
+def streaming(cfg, dst, timings):
+    "urlopen(stream=True) of the huge file"
+    def read():
+        fo = urlopen(cfg['bases'][0] + 'huge', stream=True, **cfg['opts'])
+        try:
+            while fo.read(65536):
+                pass
+        finally:
+            fo.close()
+    timings.timed(read)
+
+def reget(cfg, dst, timings):
+    "a big file from a lossy server, resumed with reget"
+    g = URLGrabber(reget='simple', retry=100, retrycodes=[14], retry_backoff=0,
+                   breaker_threshold=0, **cfg['opts'])
+    for i in range(counts(cfg['scale'])['regets']):
+        os.unlink(dst)
+        timings.timed(g.urlgrab, cfg['lossy'] + 'reget', dst)
+
+scenarios = [small_files, huge_file, mirror_failover, parallel, streaming, reget]
 
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(int(len(values) * p), len(values) - 1)], 6)
+
+def run_scenario(name, cfg):
+    """run a scenario in this process and return its results"""
+    func = dict((f.__name__, f) for f in scenarios)[name]
+    registry = metrics.enable()
+    timings = Timings()
+    tmpdir = tempfile.mkdtemp()
+    dst = joinpath(tmpdir, 'dst')
+    open(dst, 'wb').close()
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = ru.ru_utime + ru.ru_stime
+    start = timer()
+    try:
+        func(cfg, dst, timings)
+        wall = timer() - start
+    finally:
+        shutil.rmtree(tmpdir)
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    # the bytes received, of failed transfers too
+    nbytes = 0
+    for base in cfg['bases'] + [cfg['lossy']]:
+        nbytes += registry.get('urlgrabber_bytes_total', host=base.split('/')[2]) or 0
+    return {
+        'requests': len(timings.latencies) + timings.errors,
+        'errors': timings.errors,
+        'bytes': nbytes,
+        'wall': round(wall, 6),
+        'throughput': round(nbytes / wall, 1),
+        'p50': percentile(timings.latencies, 0.50),
+        'p99': percentile(timings.latencies, 0.99),
+        'cpu': round(ru.ru_utime + ru.ru_stime - cpu, 6),
+        'max_rss_kb': ru.ru_maxrss,
+    }
+
+#####################################################################
+# the parent: servers, children and comparisons
+
+def make_cert(tmpdir):
+    """a self-signed certificate and key for 127.0.0.1, in one file"""
+    pem = joinpath(tmpdir, 'server.pem')
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+                           '-nodes', '-days', '1', '-subj', '/CN=127.0.0.1',
+                           '-keyout', pem, '-out', pem + '.crt'],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    with open(pem, 'a') as f:
+        f.write(open(pem + '.crt').read())
+    return pem
+
+def environment():
+    env = {'python': sys.version.split()[0],
+           'pycurl': pycurl.version,
+           'urlgrabber': urlgrabber.__version__,
+           'time': int(time.time())}
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         cwd=dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.PIPE)
+        env['commit'] = commit.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return env
+
+def run(names, scale=1.0, https=False, rate=None, loss=0.0, backend='curlmulti'):
+    tmpdir = tempfile.mkdtemp()
+    servers = []
     try:
-        from urlgrabber.progress import text_progress_meter
-    except ImportError as e:
-        tpm = None
-        print('not using progress meter')
+        certfile = https and make_cert(tmpdir) or None
+        files = make_files(scale)
+        for i in range(counts(scale)['hosts'] + 1):
+            server = LocalHTTPServer(files, certfile)
+            server.rate = rate
+            server.loss = loss
+            servers.append(server)
+        lossy = servers.pop()
+        lossy.loss = max(loss, 0.5)
+        opts = {}
+        if https:
+            opts = {'ssl_verify_peer': False, 'ssl_verify_host': False}
+        cfg = {'bases': [s.base for s in servers], 'lossy': lossy.base,
+               'scale': scale, 'opts': opts, 'backend': backend}
+        results = {'environment': environment(),
+                   'config': {'scale': scale, 'https': https, 'rate': rate,
+                              'loss': loss, 'backend': backend},
+                   'scenarios': {}}
+        for name in names:
+            env = dict(os.environ, URLGRABBER_PERF=json.dumps(cfg))
+            out = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                           '--run', name], env=env)
+            results['scenarios'][name] = json.loads(out.decode())
+        return results
+    finally:
+        for server in servers + [lossy]:
+            server.stop()
+        shutil.rmtree(tmpdir)
+
+# what is worse: a lower (-1) or a higher (1) value
+compared = [('throughput', -1), ('p50', 1), ('p99', 1), ('cpu', 1),
+            ('max_rss_kb', 1)]
+
+def compare(old, new, threshold):
+    """print the changes from old to new, return the regressions"""
+    regressions = []
+    print('%-16s %-11s %14s %14s %8s' % ('scenario', 'metric', 'old', 'new', 'change'),
+          file=sys.stderr)
+    for name in sorted(new['scenarios']):
+        if name not in old.get('scenarios', {}):
+            continue
+        for key, worse in compared:
+            a = old['scenarios'][name].get(key)
+            b = new['scenarios'][name].get(key)
+            if not a or b is None:
+                continue
+            change = float(b - a) / a
+            flag = ''
+            if change * worse > threshold:
+                flag = ' <-'
+                regressions.append((name, key))
+            print('%-16s %-11s %14.6g %14.6g %+7.1f%%%s'
+                  % (name, key, a, b, change * 100, flag), file=sys.stderr)
+    return regressions
+
+def main():
+    # setup sys.path so that we can run this from the source
+    # directory.
+    dn = dirname(os.path.abspath(__file__))
+    sys.path.insert(0, joinpath(dn, '..'))
+    sys.path.insert(0, dn)
+    global pycurl, urlgrabber, grabber, metrics, URLGrabber, URLGrabError, \
+        urlgrab, urlopen, MirrorGroup, LocalHTTPServer
+    import pycurl
+    import urlgrabber
+    import urlgrabber.grabber as grabber
+    from urlgrabber import metrics
+    from urlgrabber.grabber import URLGrabber, URLGrabError, urlgrab, urlopen
+    from urlgrabber.mirror import MirrorGroup
+    from base_test_code import LocalHTTPServer
+
+    opts, args = getopt(sys.argv[1:], 'ho:c:t:s:b:',
+                        ['help', 'output=', 'compare=', 'threshold=', 'scale=',
+                         'backend=', 'https', 'rate=', 'loss=', 'run='])
+    output = base = None
+    threshold = 0.1
+    kw = {}
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+        elif o == '--run':
+            cfg = json.loads(os.environ['URLGRABBER_PERF'])
+            print(json.dumps(run_scenario(a, cfg)))
+            return
+        elif o in ('-o', '--output'):
+            output = a
+        elif o in ('-c', '--compare'):
+            base = a
+        elif o in ('-t', '--threshold'):
+            threshold = float(a)
+        elif o in ('-s', '--scale'):
+            kw['scale'] = float(a)
+        elif o in ('-b', '--backend'):
+            kw['backend'] = a
+        elif o == '--https':
+            kw['https'] = True
+        elif o == '--rate':
+            kw['rate'] = int(a)
+        elif o == '--loss':
+            kw['loss'] = float(a)
+
+    names = [f.__name__ for f in scenarios]
+    for name in args:
+        if name not in names:
+            usage()
+            sys.exit(2)
+    results = run(args or names, **kw)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
     else:
-        tpm = text_progress_meter(fo=open('/dev/null', 'w'))
-
-    # to address concerns that the overhead from the progress meter
-    # and throttling slow things down, we do this little test.
-    #
-    # using this test, you get the FULL overhead of the progress
-    # meter and throttling, without the benefit: the meter is directed
-    # to /dev/null and the throttle bandwidth is set EXTREMELY high.
-    #
-    # note: it _is_ even slower to direct the progress meter to a real
-    # tty or file, but I'm just interested in the overhead from _this_
-    # module.
-
-    # get it nicely cached before we start comparing
-    if DEBUG: print('pre-caching')
-    for i in range(100):
-        urlgrab(tempsrc, tempdst, copy_local=1, throttle=None, proxies=proxies)
-
-    if DEBUG: print('running speed test.')
-    reps = 500
-    for i in range(reps):
-        if DEBUG:
-            print('\r%4i/%-4i' % (i+1, reps), end=' ')
-            sys.stdout.flush()
-        t = time.time()
-        urlgrab(tempsrc, tempdst,
-                copy_local=1, progress_obj=tpm,
-                throttle=throttle, proxies=proxies)
-        full_times.append(1000 * (time.time() - t))
-
-        t = time.time()
-        urlgrab(tempsrc, tempdst,
-                copy_local=1, progress_obj=None,
-                throttle=None, proxies=proxies)
-        raw_times.append(1000 * (time.time() - t))
-
-        t = time.time()
-        in_fo = open(tempsrc)
-        out_fo = open(tempdst, 'wb')
-        while True:
-            s = in_fo.read(1024 * 8)
-            if not s: break
-            out_fo.write(s)
-        in_fo.close()
-        out_fo.close()
-        none_times.append(1000 * (time.time() - t))
-
-    if DEBUG: print('\r')
-
-    print("%d KB Results:" % (size / 1024))
-    print_result('full', full_times)
-    print_result('raw', raw_times)
-    print_result('none', none_times)
-
-def print_result(label, result_list):
-    format = '[%4s] mean: %6.3f ms, median: %6.3f ms, ' \
-             'min: %6.3f ms, max: %6.3f ms'
-    result_list.sort()
-    mean = 0.0
-    for i in result_list: mean += i
-    mean = mean/len(result_list)
-    median = result_list[int(len(result_list)/2)]
-    print(format % (label, mean, median, result_list[0], result_list[-1]))
+        print(text)
+    if base:
+        with open(base) as f:
+            if compare(json.load(f), results, threshold):
+                sys.exit(1)
+
+def usage():
+    print(__doc__ % ', '.join(f.__name__ for f in scenarios))
 
 if __name__ == '__main__':
     main()
@@ -29,10 +29,15 @@ def main():
     sys.path.insert(0, joinpath(dn,'..'))
     sys.path.insert(0, dn)
     # it's okay to import now that sys.path is setup.
-    import test_grabber, test_byterange, test_mirror
-    suite = TestSuite( (test_grabber.suite(),
-                        test_byterange.suite(),
-                        test_mirror.suite()) )
+    import test_grabber, test_byterange, test_mirror, test_metrics
+    suites = [test_grabber.suite(),
+              test_byterange.suite(),
+              test_mirror.suite(),
+              test_metrics.suite()]
+    if sys.version_info >= (3, 7):
+        import test_aio
+        suites.append(test_aio.suite())
+    suite = TestSuite(suites)
     suite.description = 'urlgrabber tests'
     runner = TextTestRunner(stream=sys.stdout,
                             descriptions=descriptions,
@@ -0,0 +1,103 @@
+#!/usr/bin/python -t
+
+#   This library is free software; you can redistribute it and/or
+#   modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+#
+#   This library is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, write to the
+#      Free Software Foundation, Inc.,
+#      59 Temple Place, Suite 330,
+#      Boston, MA  02111-1307  USA
+
+# This file is part of urlgrabber, a high-level cross-protocol url-grabber
+
+"""aio.py tests"""
+
+import sys
+import os
+import tempfile
+import asyncio
+
+from urlgrabber import aio
+from urlgrabber.grabber import URLGrabber, URLGrabError
+
+from base_test_code import *
+
+class AsyncGrabberTests(TestCase):
+    def setUp(self):
+        self.server = LocalHTTPServer({'/reference': reference_data,
+                                       '/mirror/reference': reference_data})
+        self.url = self.server.base + 'reference'
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_urlread(self):
+        "concurrent aio.urlread() calls"
+        async def main():
+            return await asyncio.gather(*[aio.urlread(self.url) for i in range(5)])
+        self.assertEqual(asyncio.run(main()), [reference_data] * 5)
+
+    def test_urlgrab(self):
+        "aio.urlgrab() with checkfunc"
+        filename = tempfile.mktemp()
+        calls = []
+        try:
+            ret = asyncio.run(aio.urlgrab(self.url, filename,
+                                          checkfunc=calls.append))
+            self.assertEqual(ret, filename)
+            self.assertEqual(open(filename, 'rb').read(), reference_data)
+            self.assertEqual(len(calls), 1)
+        finally:
+            os.unlink(filename)
+
+    def test_urlopen(self):
+        "aio.urlopen() streams the body"
+        async def main():
+            fo = await aio.urlopen(self.url, stream_bufsize=1024)
+            try:
+                self.assertFalse(fo.fo._complete)
+                lines = [await fo.readline(), await fo.readline()]
+                async for chunk in fo:
+                    lines.append(chunk)
+            finally:
+                fo.close()
+            return lines
+        lines = asyncio.run(main())
+        self.assertEqual(lines[:2], [b'0\n', b'1\n'])
+        self.assertEqual(b''.join(lines), reference_data)
+
+    def test_retry(self):
+        "aio retries failures and raises the last error"
+        tries = []
+        def cb(obj): tries.append(obj.tries)
+        coro = aio.urlread(self.server.base + 'missing', retry=3,
+                           retrycodes=[14], failure_callback=cb)
+        try:
+            asyncio.run(coro)
+        except URLGrabError as e:
+            self.assertEqual(e.code, 404)
+        else:
+            self.fail('URLGrabError not raised')
+        self.assertEqual(tries, [1, 2, 3])
+
+    def test_mirror_failover(self):
+        "AsyncMirrorGroup fails over to the next mirror"
+        mg = aio.AsyncMirrorGroup(URLGrabber(), [self.server.base + 'bad/',
+                                                 self.server.base + 'mirror/'])
+        self.assertEqual(asyncio.run(mg.urlread('reference')), reference_data)
+
+def suite():
+    tl = TestLoader()
+    return tl.loadTestsFromModule(sys.modules[__name__])
+
+if __name__ == '__main__':
+    runner = TextTestRunner(stream=sys.stdout,descriptions=1,verbosity=2)
+    runner.run(suite())
@@ -147,6 +147,55 @@ class RangeModuleTestCase(TestCase):
         except ValueError: pass
         else: self.fail("range_tuple_to_header( (0, 'not an int') ) should have raised ValueError")
 
+    def test_range_tuples_coalesce(self):
+        """byterange.range_tuples_coalesce()"""
+        from urlgrabber.byterange import range_tuples_coalesce
+        self.assertEqual(range_tuples_coalesce([(10,20), (0,5), (15,30), (40,None)]),
+                         [(0,5), (10,30), (40,'')])
+        self.assertEqual(range_tuples_coalesce([(0,5), (10,20)], gap=5),
+                         [(0,20)])
+        self.assertEqual(range_tuples_coalesce([]), [])
+
+    def test_range_tuples_to_header(self):
+        """byterange.range_tuples_to_header()"""
+        from urlgrabber.byterange import range_tuples_to_header
+        self.assertEqual(range_tuples_to_header([(500,600), (0,100), (700,'')]),
+                         'bytes=0-99,500-599,700-')
+        self.assertEqual(range_tuples_to_header([(None,None)]), None)
+
+class MultipartByterangesTestCase(TestCase):
+    body = (b'preamble\r\n--XX\r\nContent-Type: text/plain\r\n'
+            b'Content-Range: bytes 0-4/100\r\n\r\nhello\r\n'
+            b'--XX\r\nContent-Range: bytes 10-12/100\r\n\r\nabc\r\n--XX--\r\n')
+
+    def _parse(self, step):
+        from urlgrabber.byterange import MultipartByteranges
+        parser = MultipartByteranges('XX')
+        parts = {}
+        for i in range(0, len(self.body), step):
+            for offset, data in parser.feed(self.body[i:i+step]):
+                self.assertTrue(isinstance(data, memoryview))
+                parts[offset] = data.tobytes()
+        self.assertTrue(parser.done)
+        return parts
+
+    def test_parse(self):
+        """MultipartByteranges parses a whole body"""
+        self.assertEqual(self._parse(1000), {0: b'hello', 10: b'abc'})
+
+    def test_split(self):
+        """MultipartByteranges parses a body in small pieces"""
+        for step in (1, 3, 7):
+            parts = self._parse(step)
+            self.assertEqual(b''.join(parts[o] for o in sorted(parts) if o < 5), b'hello')
+            self.assertEqual(b''.join(parts[o] for o in sorted(parts) if o >= 10), b'abc')
+
+    def test_no_content_range(self):
+        """MultipartByteranges needs Content-Range"""
+        from urlgrabber.byterange import MultipartByteranges, RangeError
+        parser = MultipartByteranges('XX')
+        self.assertRaises(RangeError, parser.feed, b'--XX\r\n\r\nhello')
+
 def suite():
     tl = TestLoader()
     return tl.loadTestsFromModule(sys.modules[__name__])
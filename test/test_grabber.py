@@ -27,6 +27,10 @@ import sys
 import os
 import tempfile, random, os
 import socket
+import time
+import hashlib
+import threading
+import shutil
 from io import BytesIO
 from six import string_types
 
@@ -50,6 +54,7 @@ import urlgrabber.grabber as grabber
 from urlgrabber.grabber import URLGrabber, URLGrabError, CallbackObject, \
      URLParser
 from urlgrabber.progress import text_progress_meter
+from urlgrabber.mirror import MirrorGroup
 
 class FileObjectTests(TestCase):
 
@@ -97,6 +102,1031 @@ class FileObjectTests(TestCase):
             if not s: break
         self.assertTrue(reference_data == self.fo_output.getvalue())
 
+class StreamingTests(TestCase):
+    def setUp(self):
+        self.server = LocalHTTPServer({'/reference': reference_data})
+        self.url = self.server.base + 'reference'
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_bounded(self):
+        "streaming urlopen() returns before the body is downloaded"
+        fo = grabber.urlopen(self.url, stream=True, stream_bufsize=1024)
+        try:
+            self.assertFalse(fo._complete)
+            self.assertTrue(len(fo.fo) < len(reference_data))
+            self.assertEqual(fo.read(10), reference_data[:10])
+        finally:
+            fo.close()
+
+    def test_smallread(self):
+        "streaming urlopen() .read(N) with small N"
+        fo = grabber.urlopen(self.url, stream=True, stream_bufsize=1024)
+        s = []
+        while True:
+            s.append(fo.read(23))
+            if not s[-1]: break
+        fo.close()
+        self.assertEqual(b''.join(s), reference_data)
+
+    def test_readline(self):
+        "streaming urlopen() .readline() method"
+        fo = grabber.urlopen(self.url, stream=True, stream_bufsize=1024)
+        s = []
+        while True:
+            s.append(fo.readline())
+            if not s[-1]: break
+        fo.close()
+        self.assertEqual(s[1], b'1\n')
+        self.assertEqual(b''.join(s), reference_data)
+
+    def test_error(self):
+        "streaming urlopen() raises HTTP errors"
+        try:
+            grabber.urlopen(self.server.base + 'missing', stream=True)
+        except URLGrabError as e:
+            self.assertEqual(e.code, 404)
+        else:
+            self.fail('URLGrabError not raised')
+
+class CurlMultiTests(TestCase):
+    def setUp(self):
+        self.server = LocalHTTPServer({'/reference': reference_data})
+        self.url = self.server.base + 'reference'
+        self.backend = grabber.default_grabber.opts.parallel_backend
+        grabber.default_grabber.opts.parallel_backend = 'curlmulti'
+        self.filenames = []
+
+    def tearDown(self):
+        grabber.default_grabber.opts.parallel_backend = self.backend
+        self.server.stop()
+        for filename in self.filenames:
+            try: os.unlink(filename)
+            except OSError: pass
+
+    def _grab(self, url, **kwargs):
+        filename = tempfile.mktemp()
+        self.filenames.append(filename)
+        grabber.urlgrab(url, filename, async_=(self.server.base, 2), **kwargs)
+        return filename
+
+    def test_grab(self):
+        "parallel_wait() with the curlmulti backend"
+        filenames = [self._grab(self.url) for i in range(5)]
+        grabber.parallel_wait()
+        for filename in filenames:
+            self.assertEqual(open(filename, 'rb').read(), reference_data)
+        self.assertEqual(len(self.server.requests), 5)
+
+    def test_failfunc(self):
+        "curlmulti backend calls failfunc on errors"
+        err = []
+        self._grab(self.server.base + 'missing', failfunc=err.append)
+        grabber.parallel_wait()
+        self.assertEqual(len(err), 1)
+        self.assertEqual(err[0].exception.code, 404)
+
+    def test_checkfunc(self):
+        "curlmulti backend retries when checkfunc fails"
+        calls = []
+        def checkfunc(obj):
+            calls.append(obj.url)
+            if len(calls) == 1:
+                raise URLGrabError(-1, 'bad checksum')
+        filename = self._grab(self.url, checkfunc=checkfunc, retry=2)
+        grabber.parallel_wait()
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(open(filename, 'rb').read(), reference_data)
+
+    def test_pool(self):
+        "downloader_pool() keeps connections across parallel_wait() calls"
+        pool = grabber.downloader_pool()
+        try:
+            for i in range(3):
+                filename = self._grab(self.url)
+                grabber.parallel_wait(pool=pool)
+                self.assertEqual(open(filename, 'rb').read(), reference_data)
+        finally:
+            pool.abort()
+        self.assertEqual(self.server.connections, 1)
+
+    def test_pool_ttl(self):
+        "idle pools are closed after idle_ttl"
+        pool = grabber.downloader_pool(idle_ttl=0)
+        try:
+            self._grab(self.url)
+            grabber.parallel_wait(pool=pool)
+            self.assertEqual(pool.multi, None)
+            self.assertEqual(pool.handles, [])
+        finally:
+            pool.abort()
+
+class BatchTests(TestCase):
+    def setUp(self):
+        self.server = LocalHTTPServer({'/reference': reference_data,
+                                       '/good/reference': reference_data})
+        self.url = self.server.base + 'reference'
+        self.filenames = []
+
+    def tearDown(self):
+        self.server.stop()
+        for filename in self.filenames:
+            try: os.unlink(filename)
+            except OSError: pass
+
+    def _name(self):
+        filename = tempfile.mktemp()
+        self.filenames.append(filename)
+        return filename
+
+    def test_urlgrab_many(self):
+        "urlgrab_many() yields each request, failures included"
+        missing = self.server.base + 'missing'
+        requests = [(self.url, self._name()) for i in range(3)]
+        requests.append((missing, self._name()))
+        results = list(URLGrabber().urlgrab_many(requests, max_connections=2,
+                                                 parallel_backend='curlmulti'))
+        self.assertEqual(grabber._async_queue, [])
+        self.assertEqual(sorted((opts.url.decode(), opts.filename) for opts in results),
+                         sorted(requests))
+        for opts in results:
+            if opts.url.decode() == missing:
+                self.assertEqual(opts.exception.code, 404)
+            else:
+                self.assertEqual(opts.exception, None)
+                self.assertEqual(opts.stats.size, len(reference_data))
+                self.assertEqual(open(opts.filename, 'rb').read(), reference_data)
+
+    def test_threads(self):
+        "batches run at the same time in different threads"
+        batches = [grabber.Batch(parallel_backend='curlmulti') for i in range(2)]
+        for batch in batches:
+            for i in range(3):
+                batch.urlgrab(self.url, self._name())
+        results = []
+        threads = [threading.Thread(target=lambda b=batch: results.append(list(b)))
+                   for batch in batches]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        self.assertEqual(sorted(len(r) for r in results), [3, 3])
+        self.assertEqual(len(self.server.requests), 6)
+        self.assertEqual(len(batches[0]), 0)
+
+    def test_mirror_group(self):
+        "MirrorGroup requests fail over inside a batch"
+        batch = grabber.Batch(parallel_backend='curlmulti')
+        mg = MirrorGroup(URLGrabber(), [self.server.base + 'bad/',
+                                        self.server.base + 'good/'])
+        filename = self._name()
+        mg.urlgrab('reference', filename, async_=(None, 1), batch=batch)
+        self.assertEqual(len(batch), 1)
+        opts, = list(batch)
+        self.assertEqual(opts.exception, None)
+        self.assertEqual(open(filename, 'rb').read(), reference_data)
+
+class SegmentedTests(TestCase):
+    def setUp(self):
+        self.data = os.urandom(100000)
+        self.server = LocalHTTPServer({'/big': self.data})
+        self.url = self.server.base + 'big'
+        self.filename = tempfile.mktemp()
+
+    def tearDown(self):
+        self.server.stop()
+        try: os.unlink(self.filename)
+        except OSError: pass
+
+    def _ranges(self):
+        return [headers.get('Range') for path, headers in self.server.requests]
+
+    def test_segments(self):
+        "segments=4 fetches four byte ranges"
+        grabber.urlgrab(self.url, self.filename, segments=4, min_segment_size=10000)
+        self.assertEqual(open(self.filename, 'rb').read(), self.data)
+        ranges = self._ranges()
+        self.assertEqual(ranges[0], 'bytes=0-0')
+        self.assertEqual(sorted(ranges[1:]), ['bytes=0-24999', 'bytes=25000-49999',
+                                              'bytes=50000-74999', 'bytes=75000-99999'])
+
+    def test_min_segment_size(self):
+        "small files are not split"
+        grabber.urlgrab(self.url, self.filename, segments=4, min_segment_size=60000)
+        self.assertEqual(open(self.filename, 'rb').read(), self.data)
+        self.assertEqual(self._ranges(), ['bytes=0-0', None])
+
+    def test_no_ranges(self):
+        "servers without byte ranges get a plain download"
+        self.server.ranges = False
+        grabber.urlgrab(self.url, self.filename, segments=4, min_segment_size=10000)
+        self.assertEqual(open(self.filename, 'rb').read(), self.data)
+        self.assertEqual(self._ranges(), ['bytes=0-0', None])
+
+class ReadRangesTests(TestCase):
+    def setUp(self):
+        self.data = os.urandom(300000)
+        self.server = LocalHTTPServer({'/big': self.data})
+        self.url = self.server.base + 'big'
+        self.ranges = [(0, 10), (200000, 200100), (5, 50), (299000, None)]
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _read(self, **kwargs):
+        got = bytearray(len(self.data))
+        for offset, data in grabber.urlread_ranges(self.url, self.ranges, **kwargs):
+            self.assertTrue(isinstance(data, memoryview))
+            got[offset:offset+len(data)] = data
+        for start, end in self.ranges:
+            self.assertEqual(bytes(got[start:end]), self.data[start:end])
+        return [headers.get('Range') for path, headers in self.server.requests]
+
+    def test_multipart(self):
+        "one multi-range request"
+        self.assertEqual(self._read(), ['bytes=0-49,200000-200099,299000-'])
+
+    def test_no_multipart(self):
+        "the rest is fetched with single ranges, close ones merged"
+        self.server.multipart = False
+        self.ranges = [(0, 10), (100000, 100100), (170000, 180000),
+                       (185000, 190000), (299000, None)]
+        self.assertEqual(self._read(), ['bytes=0-9,100000-100099,170000-179999,185000-189999,299000-',
+                                        'bytes=100000-100099',
+                                        'bytes=170000-189999',
+                                        'bytes=299000-'])
+
+    def test_no_ranges(self):
+        "servers without byte ranges send it all, once"
+        self.server.ranges = False
+        self.assertEqual(self._read(), ['bytes=0-49,200000-200099,299000-'])
+
+    def test_single(self):
+        "a single range"
+        self.ranges = [(1000, 2000)]
+        self.assertEqual(self._read(), ['bytes=1000-1999'])
+
+class SeekableTests(TestCase):
+    def setUp(self):
+        self.data = os.urandom(100000)
+        self.server = LocalHTTPServer({'/big': self.data})
+        self.url = self.server.base + 'big'
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _ranges(self):
+        return [headers.get('Range') for path, headers in self.server.requests]
+
+    def test_seek(self):
+        "only the blocks read are fetched"
+        fo = grabber.urlopen(self.url, seekable=True, seekable_block_size=10000)
+        self.assertEqual(fo.size, len(self.data))
+        fo.seek(-5, os.SEEK_END)
+        self.assertEqual(fo.read(), self.data[-5:])
+        fo.seek(45000)
+        self.assertEqual(fo.read(10000), self.data[45000:55000])
+        self.assertEqual(fo.tell(), 55000)
+        fo.seek(1000)
+        b = bytearray(100)
+        self.assertEqual(fo.readinto(b), 100)
+        self.assertEqual(bytes(b), self.data[1000:1100])
+        fo.close()
+        self.assertEqual(self._ranges(), ['bytes=0-9999', 'bytes=90000-99999',
+                                          'bytes=40000-49999', 'bytes=50000-69999'])
+        self.assertEqual(self.server.connections, 2)
+
+    def test_read_ahead(self):
+        "sequential misses read ahead"
+        fo = grabber.urlopen(self.url, seekable=True, seekable_block_size=10000)
+        self.assertEqual(fo.read(), self.data)
+        self.assertEqual(self._ranges(), ['bytes=0-9999', 'bytes=10000-19999',
+                                          'bytes=20000-39999', 'bytes=40000-79999',
+                                          'bytes=80000-99999'])
+
+    def test_cache_size(self):
+        "at most seekable_cache_size bytes of blocks are kept"
+        fo = grabber.urlopen(self.url, seekable=True, seekable_block_size=10000,
+                             seekable_cache_size=20000)
+        for pos in (0, 50000, 90000, 50000, 0):
+            fo.seek(pos)
+            self.assertEqual(fo.read(10), self.data[pos:pos+10])
+        self.assertEqual(self._ranges(), ['bytes=0-9999', 'bytes=50000-59999',
+                                          'bytes=90000-99999', 'bytes=0-9999'])
+
+    def test_no_ranges(self):
+        "servers without byte ranges are downloaded once"
+        self.server.ranges = False
+        fo = grabber.urlopen(self.url, seekable=True)
+        fo.seek(50000)
+        self.assertEqual(fo.read(10), self.data[50000:50010])
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_file(self):
+        "file:// urls are opened directly"
+        tmp = tempfile.mktemp()
+        with open(tmp, 'wb') as f:
+            f.write(self.data)
+        try:
+            fo = grabber.urlopen(tmp, seekable=True)
+            fo.seek(99990)
+            self.assertEqual(fo.read(), self.data[99990:])
+            fo.close()
+        finally:
+            os.unlink(tmp)
+
+class TimedHostsTests(TestCase):
+    def setUp(self):
+        self.th = grabber._TH
+        self.saved = self.th.hosts, self.th.latency, self.th.dirty
+        self.th.hosts, self.th.latency, self.th.dirty = {}, {}, False
+        self.server = LocalHTTPServer({'/short_reference': short_reference_data})
+
+    def tearDown(self):
+        self.th.hosts, self.th.latency, self.th.dirty = self.saved
+        self.th.updated.clear()
+        self.server.stop()
+
+    def _latency(self, host, ttfb):
+        sketches = [grabber._LatencySketch() for i in range(3)]
+        for i in range(10):
+            sketches[2].add(ttfb)
+        self.th.latency[host] = time.time(), sketches
+
+    def test_sketch(self):
+        "latency quantiles"
+        sk = grabber._LatencySketch()
+        for i in range(90): sk.add(0.01)
+        for i in range(10): sk.add(1.0)
+        self.assertTrue(0.009 < sk.quantile(0.5) < 0.011)
+        self.assertTrue(0.9 < sk.quantile(0.95) < 1.1)
+        sk.scale(0.5)
+        sk = grabber._LatencySketch.loads(sk.dumps())
+        self.assertTrue(0.009 < sk.quantile(0.5) < 0.011)
+
+    def test_small_files(self):
+        "latencies of small files are recorded"
+        filename = tempfile.mktemp()
+        grabber.urlgrab(self.server.base + 'short_reference', filename)
+        os.unlink(filename)
+        host = self.server.base.split('/')[2]
+        self.assertEqual(list(self.th.latency), [host])
+        self.assertEqual(self.th.hosts, {})
+        connect, tls, ttfb = self.th.quantiles(self.server.base.encode())
+        self.assertTrue(0 < ttfb < 1)
+
+    def test_cost(self):
+        "near mirrors for small files, fast ones for big files"
+        now = time.time()
+        self.th.hosts['far'] = 10e6, 0, now
+        self._latency('far', 0.5)
+        self.th.hosts['near'] = 100e3, 0, now
+        self._latency('near', 0.01)
+        far, near = b'http://far/', b'http://near/'
+        self.assertTrue(self.th.cost(near, 10000) < self.th.cost(far, 10000))
+        self.assertTrue(self.th.cost(far, 100e6) < self.th.cost(near, 100e6))
+
+    def test_save(self):
+        "latencies are saved and loaded"
+        self._latency('near', 0.01)
+        self.th.hosts['near'] = 100000, 0, 1500000000
+        self.th.updated.add('near')
+        self.th.dirty = True
+        filename = tempfile.mktemp()
+        opts = grabber.default_grabber.opts
+        opts.timedhosts = filename
+        try:
+            self.th.save()
+            self.th.hosts, self.th.latency, self.th.dirty = {}, {}, None
+            self.th.load()
+            self.assertEqual(self.th.hosts, {'near': (100000, 0, 1500000000)})
+            self.assertTrue(0.009 < self.th.quantiles(b'http://near/')[2] < 0.011)
+        finally:
+            opts.timedhosts = None
+            os.unlink(filename)
+            os.unlink(filename + '.lock')
+
+    def test_merge(self):
+        "saves merge with what other processes saved"
+        filename = tempfile.mktemp()
+        opts = grabber.default_grabber.opts
+        opts.timedhosts = filename
+        try:
+            with open(filename, 'w') as f:
+                f.write('a 1000 0 1500000000\nb 1000 0 1500000000\n')
+            self.th.dirty = None
+            self.th.load()
+            # another process saves a newer "a"
+            with open(filename, 'w') as f:
+                f.write('a 2000 0 1600000000\nb 1000 0 1500000000\nc 3000 0 1600000000\n')
+            self.th.update(b'http://b/', 2e6, 1.0, None)
+            self.th.save()
+            self.th.hosts, self.th.latency, self.th.dirty = {}, {}, None
+            self.th.load()
+            self.assertEqual(sorted(self.th.hosts), ['a', 'b', 'c'])
+            self.assertEqual(self.th.hosts['a'][0], 2000)
+            self.assertTrue(self.th.hosts['b'][0] > 1000)
+            self.assertEqual(self.th.updated, set())
+        finally:
+            opts.timedhosts = None
+            os.unlink(filename)
+            os.unlink(filename + '.lock')
+
+class TransferStatsTests(TestCase):
+    def setUp(self):
+        self.server = LocalHTTPServer({'/reference': reference_data})
+        self.url = self.server.base + 'reference'
+        self.filename = tempfile.mktemp()
+
+    def tearDown(self):
+        self.server.stop()
+        try: os.unlink(self.filename)
+        except OSError: pass
+
+    def test_urlgrab(self):
+        "urlgrab() keeps the stats in the grabber"
+        g = URLGrabber()
+        g.urlgrab(self.url, self.filename)
+        stats = g.stats
+        self.assertEqual(stats.size, len(reference_data))
+        self.assertEqual(stats.url, self.url)
+        self.assertEqual(stats.redirects, 0)
+        self.assertEqual(stats.http_version, '1.1')
+        self.assertTrue(0 <= stats.namelookup <= stats.connect <= stats.ttfb <= stats.total)
+        g.urlread(self.url)
+        self.assertEqual(g.stats.reused, True)
+
+    def test_callbacks(self):
+        "checkfunc and failfunc get the stats"
+        objs = []
+        g = URLGrabber(checkfunc=objs.append, failfunc=objs.append)
+        g.urlgrab(self.url, self.filename)
+        g.urlgrab(self.server.base + 'missing', self.filename)
+        self.assertEqual(objs[0].stats.size, len(reference_data))
+        self.assertEqual(objs[1].exception.code, 404)
+        self.assertEqual(objs[1].stats.http_version, '1.1')
+        self.assertTrue(g.stats is objs[1].stats)
+
+class BackoffTests(TestCase):
+    def setUp(self):
+        self.cb = grabber._CB
+        self.saved = self.cb.hosts
+        self.cb.hosts = {}
+        self.server = LocalHTTPServer({'/reference': reference_data})
+        self.url = self.server.base + 'reference'
+        self.host = self.server.base.split('/')[2]
+
+    def tearDown(self):
+        self.cb.hosts = self.saved
+        self.server.stop()
+
+    def test_delay(self):
+        "exponential backoff with full jitter, capped"
+        opts = grabber.URLGrabberOptions(retry_backoff=1, retry_backoff_max=4)
+        err = URLGrabError(14, 'failed')
+        for tries, top in (1, 1), (2, 2), (3, 4), (10, 4):
+            delays = [grabber._retry_delay(opts, tries, err) for i in range(50)]
+            self.assertTrue(0 <= min(delays) and max(delays) <= top)
+            self.assertTrue(max(delays) > top / 2.0)
+        err.retry_after = 3.0
+        self.assertTrue(grabber._retry_delay(opts, 1, err) >= 3.0)
+        err.retry_after = 5.0
+        self.assertEqual(grabber._retry_delay(opts, 1, err), None)
+
+    def test_retry_after(self):
+        "Retry-After on 503 is waited for"
+        self.server.fail = [503]
+        self.server.retry_after = 1
+        start = time.time()
+        data = grabber.urlread(self.url, retry=2, retrycodes=[14])
+        self.assertTrue(time.time() - start >= 1.0)
+        self.assertEqual(data, reference_data)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.cb.hosts, {})
+
+    def test_retry_after_too_long(self):
+        "a Retry-After over retry_backoff_max is not waited for"
+        self.server.fail = [503]
+        self.server.retry_after = 60
+        start = time.time()
+        try:
+            grabber.urlread(self.url, retry=2, retrycodes=[14], breaker_threshold=5)
+        except URLGrabError as e:
+            self.assertEqual(e.code, 503)
+            self.assertEqual(e.retry_after, 60)
+        else:
+            self.fail('URLGrabError not raised')
+        self.assertTrue(time.time() - start < 10)
+        self.assertEqual(len(self.server.requests), 1)
+        # and the host is left alone
+        self.assertRaises(URLGrabError, grabber.urlread, self.url, breaker_threshold=5)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_breaker(self):
+        "the breaker opens after failures in a row, then half-opens"
+        self.server.fail = [503] * 3
+        kw = {'breaker_threshold': 2, 'breaker_cooldown': 60}
+        for i in range(2):
+            self.assertRaises(URLGrabError, grabber.urlread, self.url, **kw)
+        try:
+            grabber.urlread(self.url, **kw)
+        except URLGrabError as e:
+            self.assertEqual(e.errno, 19)
+        else:
+            self.fail('URLGrabError not raised')
+        self.assertEqual(len(self.server.requests), 2)
+
+        # half-open, a failed probe opens it again
+        self.cb.hosts[self.host][1] = time.time() - 1
+        self.assertRaises(URLGrabError, grabber.urlread, self.url, **kw)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertRaises(URLGrabError, grabber.urlread, self.url, **kw)
+        self.assertEqual(len(self.server.requests), 3)
+
+        # a successful probe closes it
+        self.cb.hosts[self.host][1] = time.time() - 1
+        self.assertEqual(grabber.urlread(self.url, **kw), reference_data)
+        self.assertEqual(self.cb.hosts, {})
+
+    def test_not_found(self):
+        "404 responses don't open the breaker"
+        for i in range(3):
+            self.assertRaises(URLGrabError, grabber.urlread,
+                              self.server.base + 'missing', breaker_threshold=2)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.cb.hosts, {})
+
+    def test_parallel(self):
+        "parallel_wait() retries after the Retry-After wait"
+        backend = grabber.default_grabber.opts.parallel_backend
+        grabber.default_grabber.opts.parallel_backend = 'curlmulti'
+        self.server.fail = [503]
+        self.server.retry_after = 1
+        filename = tempfile.mktemp()
+        err = []
+        try:
+            start = time.time()
+            grabber.urlgrab(self.url, filename, async_=(self.host, 1), retry=2,
+                            retrycodes=[14], failfunc=err.append)
+            grabber.parallel_wait()
+            self.assertEqual(err, [])
+            self.assertTrue(time.time() - start >= 1.0)
+            self.assertEqual(open(filename, 'rb').read(), reference_data)
+        finally:
+            grabber.default_grabber.opts.parallel_backend = backend
+            try: os.unlink(filename)
+            except OSError: pass
+
+class ChecksumTests(TestCase):
+    def setUp(self):
+        self.server = LocalHTTPServer({'/reference': reference_data})
+        self.url = self.server.base + 'reference'
+        self.filename = tempfile.mktemp()
+        self.good = [('sha256', hashlib.sha256(reference_data).hexdigest()),
+                     ('md5', hashlib.md5(reference_data).hexdigest())]
+        self.bad = [('sha256', '0' * 64)]
+
+    def tearDown(self):
+        self.server.stop()
+        try: os.unlink(self.filename)
+        except OSError: pass
+
+    def test_good(self):
+        "matching checksums"
+        grabber.urlgrab(self.url, self.filename, checksums=self.good)
+        self.assertEqual(open(self.filename, 'rb').read(), reference_data)
+        self.assertEqual(grabber.urlread(self.url, checksums=self.good), reference_data)
+
+    def test_bad(self):
+        "checksum mismatch raises URLGrabError 17 and truncates the file"
+        try:
+            grabber.urlgrab(self.url, self.filename, checksums=self.bad)
+        except URLGrabError as e:
+            self.assertEqual(e.errno, 17)
+        else:
+            self.fail('URLGrabError not raised')
+        self.assertEqual(os.path.getsize(self.filename), 0)
+
+    def test_reget(self):
+        "the existing part of the file is hashed when regetting"
+        with open(self.filename, 'wb') as fo:
+            fo.write(reference_data[:1000])
+        grabber.urlgrab(self.url, self.filename, reget='simple', checksums=self.good)
+        self.assertEqual(self.server.requests[-1][1].get('Range'), 'bytes=1000-')
+        self.assertEqual(open(self.filename, 'rb').read(), reference_data)
+
+class ExactSizeTests(TestCase):
+    def setUp(self):
+        self.server = LocalHTTPServer({'/reference': reference_data})
+        self.url = self.server.base + 'reference'
+        self.filename = tempfile.mktemp()
+
+    def tearDown(self):
+        self.server.stop()
+        try: os.unlink(self.filename)
+        except OSError: pass
+
+    def _grab(self, size, **kwargs):
+        try:
+            grabber.urlgrab(self.url, self.filename, size=size, exact_size=True, **kwargs)
+        except URLGrabError as e:
+            return e.errno
+
+    def test_size(self):
+        "exact_size accepts the right size"
+        self.assertEqual(self._grab(len(reference_data)), None)
+        self.assertEqual(open(self.filename, 'rb').read(), reference_data)
+
+    def test_content_length(self):
+        "a wrong Content-Length aborts before any data is written"
+        self.assertEqual(self._grab(len(reference_data) + 1), 18)
+        self.assertEqual(os.path.getsize(self.filename), 0)
+        self.assertEqual(self._grab(len(reference_data) - 1), 18)
+
+    def test_reget(self):
+        "the reget part counts"
+        with open(self.filename, 'wb') as fo:
+            fo.write(reference_data[:1000])
+        self.assertEqual(self._grab(len(reference_data), reget='simple'), None)
+        self.assertEqual(open(self.filename, 'rb').read(), reference_data)
+
+class DownloadCacheTests(TestCase):
+    def setUp(self):
+        self.server = LocalHTTPServer({'/reference': reference_data})
+        self.url = self.server.base + 'reference'
+        self.filename = tempfile.mktemp()
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.stop()
+        try: os.unlink(self.filename)
+        except OSError: pass
+        shutil.rmtree(self.cache_dir)
+
+    def _conditional(self):
+        return [headers.get('If-None-Match') is not None
+                for path, headers in self.server.requests]
+
+    def test_urlgrab(self):
+        "urlgrab() revalidates and uses the cached body"
+        for i in range(3):
+            grabber.urlgrab(self.url, self.filename, cache_dir=self.cache_dir)
+            self.assertEqual(open(self.filename, 'rb').read(), reference_data)
+        self.assertEqual(self._conditional(), [False, True, True])
+        self.assertEqual(os.listdir(self.cache_dir + '/objects'),
+                         [hashlib.sha256(reference_data).hexdigest()])
+
+    def test_urlread(self):
+        "urlread() uses the cache too"
+        for i in range(2):
+            data = grabber.urlread(self.url, cache_dir=self.cache_dir)
+            self.assertEqual(data, reference_data)
+        self.assertEqual(self._conditional(), [False, True])
+
+    def test_modified(self):
+        "a modified file replaces the cached one"
+        grabber.urlgrab(self.url, self.filename, cache_dir=self.cache_dir)
+        cached = os.path.join(self.cache_dir, 'objects', os.listdir(self.cache_dir + '/objects')[0])
+        self.server.files['/reference'] = b'new data'
+        grabber.urlgrab(self.url, self.filename, cache_dir=self.cache_dir)
+        self.assertEqual(open(self.filename, 'rb').read(), b'new data')
+        self.assertEqual(open(cached, 'rb').read(), reference_data)
+        self.assertEqual(grabber.urlread(self.url, cache_dir=self.cache_dir), b'new data')
+        self.assertEqual(self._conditional(), [False, True, True])
+
+    def test_closed_handle(self):
+        "the status is kept when the curl handle is closed at once"
+        kw = {'cache_dir': self.cache_dir, 'curl_pool_size': 0}
+        for i in range(2):
+            grabber.urlgrab(self.url, self.filename, **kw)
+            self.assertEqual(open(self.filename, 'rb').read(), reference_data)
+            self.assertEqual(grabber.urlread(self.url, **kw), reference_data)
+        self.assertEqual(self._conditional(), [False, True, True, True])
+
+    def test_private_copy(self):
+        "the user file never shares the cached object"
+        grabber.urlgrab(self.url, self.filename, cache_dir=self.cache_dir)
+        cached = os.path.join(self.cache_dir, 'objects', os.listdir(self.cache_dir + '/objects')[0])
+        self.assertNotEqual(os.stat(self.filename).st_ino, os.stat(cached).st_ino)
+        with open(self.filename, 'r+b') as fo:
+            fo.write(b'garbage')
+        self.assertEqual(open(cached, 'rb').read(), reference_data)
+
+    def test_corrupt(self):
+        "a corrupted object is dropped on 304 and fetched again"
+        grabber.urlgrab(self.url, self.filename, cache_dir=self.cache_dir)
+        cached = os.path.join(self.cache_dir, 'objects', os.listdir(self.cache_dir + '/objects')[0])
+        with open(cached, 'r+b') as fo:
+            fo.write(b'garbage')
+        grabber.urlgrab(self.url, self.filename, cache_dir=self.cache_dir)
+        self.assertEqual(open(self.filename, 'rb').read(), reference_data)
+        self.assertEqual(open(cached, 'rb').read(), reference_data)
+        with open(cached, 'r+b') as fo:
+            fo.write(b'garbage')
+        self.assertEqual(grabber.urlread(self.url, cache_dir=self.cache_dir), reference_data)
+        self.assertEqual(open(cached, 'rb').read(), reference_data)
+        self.assertEqual(self._conditional(), [False, True, False, True, False])
+
+    def test_truncated(self):
+        "a cached object of the wrong size is not revalidated"
+        grabber.urlgrab(self.url, self.filename, cache_dir=self.cache_dir)
+        cached = os.path.join(self.cache_dir, 'objects', os.listdir(self.cache_dir + '/objects')[0])
+        with open(cached, 'r+b') as fo:
+            fo.truncate(10)
+        self.assertEqual(grabber.urlread(self.url, cache_dir=self.cache_dir), reference_data)
+        self.assertEqual(open(cached, 'rb').read(), reference_data)
+        self.assertEqual(self._conditional(), [False, False])
+
+class LocalCopyTests(TestCase):
+    def setUp(self):
+        self.src = tempfile.mktemp()
+        with open(self.src, 'wb') as fo:
+            fo.write(reference_data)
+        self.url = 'file://' + self.src
+        self.filename = tempfile.mktemp()
+
+    def tearDown(self):
+        for filename in self.src, self.filename:
+            try: os.unlink(filename)
+            except OSError: pass
+
+    def test_copy(self):
+        "copy_local=1 copies the file and reports progress"
+        meter = []
+        class Meter:
+            def start(self, *args, **kwargs): meter.append(kwargs['size'])
+            def update(self, amount): meter.append(amount)
+            def end(self, amount): meter.append(amount)
+        grabber.urlgrab(self.url, self.filename, copy_local=1, progress_obj=Meter())
+        self.assertEqual(open(self.filename, 'rb').read(), reference_data)
+        self.assertEqual(meter[0], len(reference_data))
+        self.assertEqual(meter[-1], len(reference_data))
+        self.assertEqual(os.stat(self.filename).st_mtime, os.stat(self.src).st_mtime)
+
+    def test_range(self):
+        "local copies honour the range option"
+        grabber.urlgrab(self.url, self.filename, copy_local=1, range=(10, 100))
+        self.assertEqual(open(self.filename, 'rb').read(), reference_data[10:100])
+
+    def test_missing(self):
+        "missing files raise URLGrabError"
+        try:
+            grabber.urlgrab(self.url + 'x', self.filename, copy_local=1)
+        except URLGrabError as e:
+            self.assertEqual(e.errno, 14)
+        else:
+            self.fail('URLGrabError not raised')
+
+class _RecordingPool:
+    """A downloader pool that finishes one transfer per perform()."""
+    def __init__(self):
+        self.running = {}
+        self.started = []
+    def start(self, opts):
+        self.running[len(self.started)] = opts
+        self.started.append(opts.url)
+    def perform(self):
+        opts = self.running.pop(min(self.running))
+        return [(opts, opts.size or 0, None)]
+    def release(self):
+        self.running.clear()
+
+class ParallelOrderTests(TestCase):
+    def setUp(self):
+        self.order = grabber.default_grabber.opts.parallel_order
+        self.filename = tempfile.mktemp()
+
+    def tearDown(self):
+        grabber.default_grabber.opts.parallel_order = self.order
+
+    def _wait(self, reqs):
+        pool = _RecordingPool()
+        for url, size, limit in reqs:
+            key = url.split('/')[2]
+            grabber.urlgrab(url, self.filename, size=size, async_=(key, limit))
+        grabber.parallel_wait(pool=pool)
+        return [url.split(b'//')[1].decode() for url in pool.started]
+
+    def test_busy_host(self):
+        "a host at its limit doesn't block other hosts"
+        started = self._wait([('http://a/1', None, 1), ('http://a/2', None, 1),
+                              ('http://a/3', None, 1), ('http://b/1', None, 1)])
+        self.assertEqual(started, ['a/1', 'b/1', 'a/2', 'a/3'])
+
+    def test_size(self):
+        "parallel_order='size' starts the largest files first"
+        grabber.default_grabber.opts.parallel_order = 'size'
+        started = self._wait([('http://a/1', 10, 2), ('http://a/2', 30, 2),
+                              ('http://a/3', None, 2), ('http://a/4', 20, 2)])
+        self.assertEqual(started, ['a/2', 'a/4', 'a/1', 'a/3'])
+
+    def test_size_queued(self):
+        "requests queued while parallel_wait() runs are sorted in"
+        grabber.default_grabber.opts.parallel_order = 'size'
+        def checkfunc(obj):
+            grabber.urlgrab('http://a/3', self.filename, size=50, async_=('a', 1))
+        grabber.urlgrab('http://a/1', self.filename, size=10, async_=('a', 1),
+                        checkfunc=checkfunc)
+        grabber.urlgrab('http://a/2', self.filename, size=5, async_=('a', 1))
+        pool = _RecordingPool()
+        grabber.parallel_wait(pool=pool)
+        started = [url.split(b'//')[1].decode() for url in pool.started]
+        self.assertEqual(started, ['a/1', 'a/3', 'a/2'])
+
+class CurlPoolTests(TestCase):
+    def setUp(self):
+        self.server = LocalHTTPServer({'/reference': reference_data})
+        self.url = self.server.base + 'reference'
+        grabber.reset_curl_obj()
+
+    def tearDown(self):
+        self.server.stop()
+        grabber.reset_curl_obj()
+
+    def test_keepalive(self):
+        "pooled handles keep their connections"
+        for i in range(5):
+            self.assertEqual(grabber.urlread(self.url), reference_data)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_threads(self):
+        "concurrent grabs from several threads"
+        import threading
+        res = []
+        def fetch():
+            for i in range(5):
+                res.append(grabber.urlread(self.url))
+        threads = [threading.Thread(target=fetch) for i in range(4)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        self.assertEqual(res, [reference_data] * 20)
+        self.assertTrue(self.server.connections <= 4)
+
+    def test_pool_size(self):
+        "handles are closed when the pool is full"
+        for i in range(3):
+            grabber.urlread(self.url, curl_pool_size=0)
+        self.assertEqual(self.server.connections, 3)
+
+    def test_resolve(self):
+        "resolve option pre-seeds the shared DNS cache"
+        port = self.server.server_address[1]
+        url = 'http://urlgrabber.invalid:%d/reference' % port
+        resolve = ['urlgrabber.invalid:%d:127.0.0.1' % port]
+        self.assertEqual(grabber.urlread(url, resolve=resolve), reference_data)
+        # cached, even for a different handle
+        self.assertEqual(grabber.urlread(url, curl_pool_size=0), reference_data)
+        self.assertEqual(grabber.urlread(url), reference_data)
+
+    def test_reset(self):
+        "reset_curl_obj() closes idle handles"
+        grabber.urlread(self.url)
+        grabber.reset_curl_obj()
+        grabber.urlread(self.url)
+        self.assertEqual(self.server.connections, 2)
+
+class ExternalDownloaderTests(TestCase):
+    def setUp(self):
+        self.server = LocalHTTPServer({'/reference': reference_data})
+        self.url = self.server.base + 'reference'
+        self.filenames = []
+        self.helper = tempfile.mktemp()
+        self.old_helper = os.environ.get('URLGRABBER_EXT_DOWN')
+        os.environ['URLGRABBER_EXT_DOWN'] = self.helper
+        self.write_helper()
+
+    def write_helper(self, env=''):
+        top = os.path.dirname(os.path.dirname(os.path.abspath(grabber.__file__)))
+        with open(self.helper, 'w') as f:
+            f.write('#!/bin/sh\n%s\nPYTHONPATH=%s exec %s %s\n' % (env, top,
+                    sys.executable, os.path.join(top, 'scripts', 'urlgrabber-ext-down')))
+        os.chmod(self.helper, 0o755)
+
+    def tearDown(self):
+        if self.old_helper is None:
+            del os.environ['URLGRABBER_EXT_DOWN']
+        else:
+            os.environ['URLGRABBER_EXT_DOWN'] = self.old_helper
+        self.server.stop()
+        for filename in self.filenames + [self.helper]:
+            try: os.unlink(filename)
+            except OSError: pass
+
+    def _opts(self, url):
+        filename = tempfile.mktemp()
+        self.filenames.append(filename)
+        opts = grabber.default_grabber.opts
+        return opts.derive(url=url.encode(), filename=filename,
+                           async_=(self.server.base, 2), tries=1)
+
+    def _run(self, dl, urls):
+        for url in urls:
+            dl.start(self._opts(url))
+            ret = []
+            while not ret:
+                ret = dl.perform()
+            yield ret[0]
+
+    def test_protocol(self):
+        "helpers switch to the framed protocol after the first job"
+        dl = grabber._ExternalDownloader()
+        try:
+            res = list(self._run(dl, [self.url, self.url, self.url + 'x']))
+        finally:
+            dl.abort()
+        self.assertEqual(dl.protocol, 2)
+        self.assertEqual([size for opts, size, err in res],
+                         [len(reference_data)] * 2 + [0])
+        self.assertEqual(res[2][2].code, 404)
+        for opts, size, err in res[:2]:
+            self.assertEqual(open(opts.filename, 'rb').read(), reference_data)
+
+    def test_stats(self):
+        "helpers send the transfer stats back"
+        dl = grabber._ExternalDownloader()
+        try:
+            res = list(self._run(dl, [self.url, self.url + 'x']))
+        finally:
+            dl.abort()
+        stats = res[0][0].stats
+        self.assertEqual(stats.size, len(reference_data))
+        self.assertEqual(stats.url, self.url)
+        self.assertEqual(res[1][0].stats.http_version, '1.1')
+
+    def test_old_helper(self):
+        "helpers that don't know the framed protocol keep working"
+        self.write_helper('unset URLGRABBER_EXT_DOWN_PROTOCOL')
+        dl = grabber._ExternalDownloader()
+        try:
+            res = list(self._run(dl, [self.url, self.url + 'x', self.url]))
+        finally:
+            dl.abort()
+        self.assertEqual(dl.protocol, 1)
+        self.assertEqual(res[1][2].code, 404)
+        self.assertEqual(open(res[2][0].filename, 'rb').read(), reference_data)
+
+    def test_pool(self):
+        "downloader_pool() reuses idle helpers"
+        pool = grabber.downloader_pool()
+        try:
+            res = list(self._run(pool, [self.url, self.url]))
+            pool.release()
+            self.assertEqual(len(pool.cache), 1)
+            (dl,), = pool.cache.values()
+            res += list(self._run(pool, [self.url]))
+            self.assertEqual(list(pool.cache.values()), [[dl]])
+        finally:
+            pool.abort()
+        self.assertEqual(pool.cache, {})
+        self.assertNotEqual(dl.popen.poll(), None)
+        self.assertEqual([size for opts, size, err in res],
+                         [len(reference_data)] * 3)
+
+    def test_pool_per_host(self):
+        "up to the host limit of helpers are kept for a host"
+        pool = grabber.downloader_pool()
+        try:
+            for i in range(3):
+                pool.start(self._opts(self.url))
+            done = []
+            while len(done) < 3:
+                done += pool.perform()
+            idle, = pool.cache.values()
+            self.assertEqual(len(idle), 2)
+        finally:
+            pool.abort()
+        self.assertEqual(pool.cache, {})
+
+    def test_pool_max_idle(self):
+        "helpers over max_idle are stopped"
+        pool = grabber.downloader_pool(max_idle=0)
+        try:
+            list(self._run(pool, [self.url]))
+            self.assertEqual(pool.cache, {})
+        finally:
+            pool.abort()
+
+    def test_checksums(self):
+        "checksums are passed to the helper"
+        dl = grabber._ExternalDownloader()
+        try:
+            opts = self._opts(self.url)
+            opts.checksums = [('sha256', '0' * 64)]
+            dl.start(opts)
+            ret = []
+            while not ret:
+                ret = dl.perform()
+        finally:
+            dl.abort()
+        self.assertEqual(ret[0][2].errno, 17)
+
+    def test_frames(self):
+        "frames split across reads"
+        data = grabber._frame(b'J', {'url': 'a'}) + grabber._frame(b'P', [(1, 2)])
+        reader = grabber._FrameReader()
+        self.assertEqual(reader.feed(data[:3]), [])
+        self.assertEqual(reader.feed(data[3:-1]), [(b'J', {'url': 'a'})])
+        self.assertEqual(reader.feed(data[-1:]), [(b'P', [(1, 2)])])
+
 class HTTPTests(TestCase):
     def test_reference_file(self):
         "download reference file via HTTP"
@@ -196,6 +1226,22 @@ class URLGrabberTestCase(TestCase):
         nopts.opener = None
         self.assertEqual( nopts.opener, None )
 
+    def test_derive(self):
+        """derived options are copied, own options survive a new delegate"""
+        a = URLGrabber(retry=3, timeout=10).opts
+        b = URLGrabber(retry=5, timeout=20).opts
+        opts = a.derive(timeout=30).derive(reget='simple')
+        self.assertTrue('retry' in vars(opts))
+        self.assertEqual((opts.retry, opts.timeout), (3, 30))
+        opts.url = 'http://example.com/'
+        opts.delegate = b.derive(size=100)
+        self.assertEqual((opts.retry, opts.timeout, opts.size), (5, 20, 100))
+        self.assertEqual((opts.reget, opts.url), ('simple', 'http://example.com/'))
+        opts.timeout = 1
+        del opts.timeout
+        self.assertEqual(opts.timeout, 20)
+        self.assertEqual(sorted(opts._own), ['reget', 'url'])
+
     def test_make_callback(self):
         """grabber.URLGrabber._make_callback() tests"""
         def cb(e): pass
@@ -500,19 +1546,22 @@ class FTPRegetTests(RegetTestBase, TestCase):
 class HTTPRegetTests(FTPRegetTests):
     def setUp(self):
         RegetTestBase.setUp(self)
-        self.url = short_ref_http
+        self.server = LocalHTTPServer({'/short_reference': self.ref})
+        self.server.last_modified = 1600000000
+        self.url = self.server.base + 'short_reference'
+
+    def tearDown(self):
+        RegetTestBase.tearDown(self)
+        self.server.stop()
 
     def test_older_check_timestamp(self):
         # define this here rather than in the FTP tests because currently,
         # we get no timestamp information back from ftp servers.
         self._make_half_zero_file()
-        ts = 1600000000 # set local timestamp to 2020
+        ts = 1600000000 # set local timestamp to 2020, same as the server
         os.utime(self.filename, (ts, ts))
 
-        try:
-            self.grabber.urlgrab(self.url, self.filename, reget='check_timestamp')
-        except NotImplementedError:
-            self.skip()
+        self.grabber.urlgrab(self.url, self.filename, reget='check_timestamp')
 
         data = self._read_file()
 
@@ -526,21 +1575,49 @@ class HTTPRegetTests(FTPRegetTests):
         ts = 1 # set local timestamp to 1969
         os.utime(self.filename, (ts, ts))
 
-        try:
-            self.grabber.urlgrab(self.url, self.filename, reget='check_timestamp')
-        except NotImplementedError:
-            self.skip()
+        self.grabber.urlgrab(self.url, self.filename, reget='check_timestamp')
 
         data = self._read_file()
 
         self.assertEqual(data, self.ref)
 
+class CheckTimestampTests(RegetTestBase, TestCase):
+    def setUp(self):
+        RegetTestBase.setUp(self)
+        self.server = LocalHTTPServer({'/short_reference': self.ref})
+        self.server.last_modified = 1600000000
+        self.url = self.server.base + 'short_reference'
+
+    def tearDown(self):
+        RegetTestBase.tearDown(self)
+        self.server.stop()
+
+    def test_changed(self):
+        "a changed file is fetched whole in the same request"
+        self._make_half_zero_file()
+        os.utime(self.filename, (1500000000, 1500000000))
+        self.grabber.urlgrab(self.url, self.filename)
+        self.assertEqual(self._read_file(), self.ref)
+        self.assertEqual(len(self.server.requests), 1)
+        headers = self.server.requests[0][1]
+        self.assertEqual(headers['Range'], 'bytes=%d-' % self.hl)
+        self.assertEqual(headers['If-Range'], 'Fri, 14 Jul 2017 02:40:00 GMT')
+        self.assertEqual(int(os.stat(self.filename).st_mtime), 1600000000)
+
+    def test_partial_timestamp(self):
+        "partial files get the server's timestamp"
+        self.server.files['/short_reference'] = self.ref * 10000
+        self.assertRaises(URLGrabError, self.grabber.urlgrab, self.url,
+                          self.filename, size=len(self.ref) * 100)
+        self.assertEqual(int(os.stat(self.filename).st_mtime), 1600000000)
+
 class FileRegetTests(HTTPRegetTests):
     def setUp(self):
         self.ref = short_reference_data
         tmp = tempfile.mktemp()
         with open(tmp, 'wb') as tmpfo:
             tmpfo.write(self.ref)
+        os.utime(tmp, (1600000000, 1600000000))
         self.tmp = tmp
 
         (url, parts) = grabber.default_grabber.opts.urlparser.parse(
@@ -0,0 +1,140 @@
+#!/usr/bin/python -t
+
+#   This library is free software; you can redistribute it and/or
+#   modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+#
+#   This library is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, write to the
+#      Free Software Foundation, Inc.,
+#      59 Temple Place, Suite 330,
+#      Boston, MA  02111-1307  USA
+
+# This file is part of urlgrabber, a high-level cross-protocol url-grabber
+
+"""metrics.py tests"""
+
+import sys
+import os
+import tempfile
+
+from urlgrabber import metrics
+import urlgrabber.grabber as grabber
+from urlgrabber.grabber import URLGrabber, URLGrabError
+from urlgrabber.mirror import MirrorGroup
+
+from base_test_code import *
+
+class RegistryTests(TestCase):
+    def test_snapshot(self):
+        "counters, gauges and histograms in the text format"
+        r = metrics.Registry(buckets=(0.1, 1))
+        r.inc('reqs_total', host='a')
+        r.inc('reqs_total', 2, host='a')
+        r.set('depth', 5)
+        r.observe('secs', 0.5, host='a"b')
+        self.assertEqual(r.get('reqs_total', host='a'), 3)
+        self.assertEqual(r.get('secs', host='a"b'), (1, 0.5))
+        self.assertEqual(r.snapshot(),
+                         '# TYPE depth gauge\n'
+                         'depth 5\n'
+                         '# TYPE reqs_total counter\n'
+                         'reqs_total{host="a"} 3\n'
+                         '# TYPE secs histogram\n'
+                         'secs_bucket{host="a\\"b",le="0.1"} 0\n'
+                         'secs_bucket{host="a\\"b",le="1"} 1\n'
+                         'secs_bucket{host="a\\"b",le="+Inf"} 1\n'
+                         'secs_sum{host="a\\"b"} 0.5\n'
+                         'secs_count{host="a\\"b"} 1\n')
+
+    def test_callback(self):
+        "the callback sees every update"
+        events = []
+        r = metrics.Registry(callback=lambda *args: events.append(args))
+        r.inc('n', host='a')
+        r.observe('t', 0.2)
+        self.assertEqual(events, [('counter', 'n', {'host': 'a'}, 1),
+                                  ('histogram', 't', {}, 0.2)])
+
+    def test_kind(self):
+        "a name has a single kind"
+        r = metrics.Registry()
+        r.inc('n')
+        self.assertRaises(ValueError, r.set, 'n', 1)
+
+class InstrumentationTests(TestCase):
+    def setUp(self):
+        self.server = LocalHTTPServer({'/reference': reference_data,
+                                       '/good/reference': reference_data})
+        self.url = self.server.base + 'reference'
+        self.host = self.server.base.split('/')[2]
+        self.registry = metrics.enable()
+        self.filename = tempfile.mktemp()
+
+    def tearDown(self):
+        metrics.disable()
+        self.server.stop()
+        try: os.unlink(self.filename)
+        except OSError: pass
+
+    def test_requests(self):
+        "transfers, bytes and latencies are counted per host"
+        grabber.urlgrab(self.url, self.filename)
+        grabber.urlread(self.url)
+        self.assertRaises(URLGrabError, grabber.urlread, self.server.base + 'missing')
+        r = self.registry
+        self.assertEqual(r.get('urlgrabber_requests_total', host=self.host, code='ok'), 2)
+        self.assertEqual(r.get('urlgrabber_requests_total', host=self.host, code='404'), 1)
+        self.assertTrue(r.get('urlgrabber_bytes_total', host=self.host) >= 2 * len(reference_data))
+        self.assertEqual(r.get('urlgrabber_ttfb_seconds', host=self.host)[0], 2)
+        self.assertEqual(r.get('urlgrabber_request_seconds', host=self.host)[0], 3)
+
+    def test_retries(self):
+        "retries are counted"
+        self.assertRaises(URLGrabError, grabber.urlread, self.server.base + 'missing',
+                          retry=3, retrycodes=[14], retry_backoff=0)
+        self.assertEqual(self.registry.get('urlgrabber_retries_total', host=self.host), 2)
+
+    def test_failover(self):
+        "mirror failovers are counted per mirror"
+        bad = self.server.base + 'bad/'
+        mg = MirrorGroup(URLGrabber(), [bad, self.server.base + 'good/'])
+        self.assertEqual(mg.urlread('reference'), reference_data)
+        self.assertEqual(self.registry.get('urlgrabber_mirror_failovers_total',
+                                           mirror=bad), 1)
+
+    def test_parallel(self):
+        "parallel_wait() reports the queue and the transfers in flight"
+        backend = grabber.default_grabber.opts.parallel_backend
+        grabber.default_grabber.opts.parallel_backend = 'curlmulti'
+        depths = []
+        def callback(kind, name, labels, value):
+            if name == 'urlgrabber_queue_depth':
+                depths.append(value)
+        self.registry.callback = callback
+        try:
+            for i in range(3):
+                grabber.urlgrab(self.url, self.filename, async_=('key', 1))
+            grabber.parallel_wait()
+        finally:
+            grabber.default_grabber.opts.parallel_backend = backend
+        self.assertEqual(max(depths), 3)
+        self.assertEqual(depths[-1], 0)
+        self.assertEqual(self.registry.get('urlgrabber_in_flight', host=self.host), 0)
+        self.assertEqual(self.registry.get('urlgrabber_in_flight', host='key'), None)
+        self.assertEqual(self.registry.get('urlgrabber_requests_total',
+                                           host=self.host, code='ok'), 3)
+
+def suite():
+    tl = TestLoader()
+    return tl.loadTestsFromModule(sys.modules[__name__])
+
+if __name__ == '__main__':
+    runner = TextTestRunner(stream=sys.stdout,descriptions=1,verbosity=2)
+    runner.run(suite())
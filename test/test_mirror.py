@@ -24,6 +24,8 @@
 import sys
 import os
 import tempfile, random, os
+import socket
+import time
 
 import urlgrabber.grabber
 from urlgrabber.grabber import URLGrabber, URLGrabError, URLGrabberOptions
@@ -103,6 +105,7 @@ class CallbackTests(TestCase):
         if hasattr(urlgrabber.grabber, '_TH'):
             # test assumes mirrors are not re-ordered
             urlgrabber.grabber._TH.hosts.clear()
+            urlgrabber.grabber._TH.latency.clear()
         self.mg = MirrorGroup(self.g, fullmirrors)
 
     def test_failure_callback(self):
@@ -158,6 +161,201 @@ class FailoverTests(TestCase):
         # data was returned
         self.assertEqual(contents, reference_data)
 
+class CurlMultiFailoverTests(TestCase):
+    def setUp(self):
+        self.server = LocalHTTPServer({'/good/reference': reference_data})
+        self.backend = urlgrabber.grabber.default_grabber.opts.parallel_backend
+        urlgrabber.grabber.default_grabber.opts.parallel_backend = 'curlmulti'
+        self.g  = URLGrabber()
+        fullmirrors = [self.server.base + m + '/' for m in ('bad', 'good')]
+        self.mg = MirrorGroup(self.g, fullmirrors)
+
+    def tearDown(self):
+        urlgrabber.grabber.default_grabber.opts.parallel_backend = self.backend
+        self.server.stop()
+
+    def test_simple_grab(self):
+        """test async MG failover with the curlmulti backend"""
+        filename = tempfile.mktemp()
+        err = []
+        self.mg.urlgrab('reference', filename, async_=True, failfunc=err.append)
+        urlgrabber.grabber.parallel_wait()
+        try:
+            self.assertEqual(err, [])
+            self.assertEqual(open(filename, 'rb').read(), reference_data)
+        finally:
+            os.unlink(filename)
+
+class BreakerFailoverTests(TestCase):
+    def setUp(self):
+        self.cb = urlgrabber.grabber._CB
+        self.saved = self.cb.hosts
+        self.cb.hosts = {}
+        self.open = LocalHTTPServer({'/reference': reference_data})
+        self.server = LocalHTTPServer({'/reference': reference_data})
+        host = self.open.base.split('/')[2]
+        self.cb.hosts[host] = [5, time.time() + 60, 0]
+        self.mg = MirrorGroup(URLGrabber(breaker_threshold=5),
+                              [self.open.base, self.server.base])
+        self.backend = urlgrabber.grabber.default_grabber.opts.parallel_backend
+        urlgrabber.grabber.default_grabber.opts.parallel_backend = 'curlmulti'
+
+    def tearDown(self):
+        urlgrabber.grabber.default_grabber.opts.parallel_backend = self.backend
+        self.cb.hosts = self.saved
+        self.open.stop()
+        self.server.stop()
+
+    def test_failover(self):
+        """a mirror with an open breaker is skipped"""
+        self.assertEqual(self.mg.urlread('reference'), reference_data)
+        self.assertEqual(self.open.requests, [])
+
+    def test_parallel(self):
+        """parallel downloads avoid mirrors with open breakers"""
+        filename = tempfile.mktemp()
+        err = []
+        self.mg.urlgrab('reference', filename, async_=True, failfunc=err.append)
+        urlgrabber.grabber.parallel_wait()
+        try:
+            self.assertEqual(err, [])
+            self.assertEqual(open(filename, 'rb').read(), reference_data)
+            self.assertEqual(self.open.requests, [])
+        finally:
+            os.unlink(filename)
+
+class SegmentedMirrorTests(TestCase):
+    def setUp(self):
+        self.data = os.urandom(100000)
+        self.servers = [LocalHTTPServer({'/big': self.data}) for i in range(2)]
+        self.filename = tempfile.mktemp()
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        try: os.unlink(self.filename)
+        except OSError: pass
+
+    def _grab(self):
+        mg = MirrorGroup(URLGrabber(), [s.base for s in self.servers])
+        mg.urlgrab('big', self.filename, segments=4, min_segment_size=10000)
+        self.assertEqual(open(self.filename, 'rb').read(), self.data)
+        return [len(s.requests) for s in self.servers]
+
+    def test_spread(self):
+        """segments are spread over the mirrors"""
+        # the probe, then two ranges from each mirror
+        self.assertEqual(self._grab(), [3, 2])
+
+    def test_failover(self):
+        """failed segments are resumed from the next mirror"""
+        del self.servers[1].files['/big']
+        self.assertEqual(self._grab(), [5, 2])
+
+    def test_failure_callback(self):
+        """failed segments go through the MirrorGroup failure handling"""
+        del self.servers[1].files['/big']
+        failed = []
+        mg = MirrorGroup(URLGrabber(), [s.base for s in self.servers],
+                         failure_callback=lambda obj: failed.append(obj.mirror))
+        for mirror in mg.mirrors:
+            if mirror['mirror'] == self.servers[1].base.encode():
+                mirror['kwargs'] = {'user_agent': 'mirror-ua'}
+        mg.urlgrab('big', self.filename, segments=4, min_segment_size=10000)
+        self.assertEqual(open(self.filename, 'rb').read(), self.data)
+        self.assertEqual(set(failed), set([self.servers[1].base.encode()]))
+        agents = [headers.get('User-Agent') for path, headers in self.servers[1].requests]
+        self.assertEqual(set(agents), set(['mirror-ua']))
+
+    def test_fail_action(self):
+        """default_action fail=1 ends the segmented grab"""
+        del self.servers[1].files['/big']
+        mg = MirrorGroup(URLGrabber(), [s.base for s in self.servers],
+                         default_action={'fail': 1})
+        try:
+            mg.urlgrab('big', self.filename, segments=4, min_segment_size=10000)
+        except URLGrabError as e:
+            self.assertEqual(e.code, 404)
+            self.assertEqual(len(e.errors), 1)
+        else:
+            self.fail('URLGrabError not raised')
+
+class ExactSizeFailoverTests(TestCase):
+    def setUp(self):
+        self.server = LocalHTTPServer({'/bad/reference': reference_data * 2,
+                                       '/good/reference': reference_data})
+        self.backend = urlgrabber.grabber.default_grabber.opts.parallel_backend
+        urlgrabber.grabber.default_grabber.opts.parallel_backend = 'curlmulti'
+        fullmirrors = [self.server.base + m + '/' for m in ('bad', 'good')]
+        self.mg = MirrorGroup(URLGrabber(), fullmirrors)
+        self.filename = tempfile.mktemp()
+
+    def tearDown(self):
+        urlgrabber.grabber.default_grabber.opts.parallel_backend = self.backend
+        self.server.stop()
+        try: os.unlink(self.filename)
+        except OSError: pass
+
+    def test_failover(self):
+        """a mirror with the wrong size fails over right away"""
+        err = []
+        self.mg.urlgrab('reference', self.filename, async_=True, failfunc=err.append,
+                        size=len(reference_data), exact_size=True)
+        urlgrabber.grabber.parallel_wait()
+        self.assertEqual(err, [])
+        self.assertEqual(open(self.filename, 'rb').read(), reference_data)
+        paths = [path for path, headers in self.server.requests]
+        self.assertEqual(paths, ['/bad/reference', '/good/reference'])
+
+class RaceTests(TestCase):
+    def setUp(self):
+        self.server = LocalHTTPServer({'/good/reference': reference_data})
+        # accepts connections, never answers
+        self.dead = socket.socket()
+        self.dead.bind(('127.0.0.1', 0))
+        self.dead.listen(5)
+        dead = 'http://127.0.0.1:%d/' % self.dead.getsockname()[1]
+        self.mirrors = [dead, self.server.base + 'bad/', self.server.base + 'good/']
+        self.filename = tempfile.mktemp()
+
+    def tearDown(self):
+        self.server.stop()
+        self.dead.close()
+        try: os.unlink(self.filename)
+        except OSError: pass
+
+    def test_dead_mirror(self):
+        """a dead mirror doesn't stall racing requests"""
+        mg = MirrorGroup(URLGrabber(timeout=30), self.mirrors[:1] + self.mirrors[2:],
+                         race=2, race_delay=0.1)
+        start = time.time()
+        self.assertEqual(mg.urlread('reference'), reference_data)
+        self.assertTrue(time.time() - start < 5)
+
+    def test_failure(self):
+        """a failed mirror starts the next one at once"""
+        mg = MirrorGroup(URLGrabber(timeout=30), self.mirrors[1:], race=2, race_delay=10)
+        start = time.time()
+        self.assertEqual(mg.urlgrab('reference', self.filename), self.filename)
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(open(self.filename, 'rb').read(), reference_data)
+        paths = [path for path, headers in self.server.requests]
+        self.assertEqual(paths, ['/bad/reference', '/good/reference'])
+        tmps = [f for f in os.listdir(os.path.dirname(self.filename))
+                if f.startswith(os.path.basename(self.filename) + '.')]
+        self.assertEqual(tmps, [])
+
+    def test_budget(self):
+        """no racing without budget"""
+        mg = MirrorGroup(URLGrabber(timeout=1), self.mirrors[:1] + self.mirrors[2:],
+                         race=2, race_delay=0.1, race_budget=1)
+        start = time.time()
+        fo = mg.urlopen('reference')
+        self.assertTrue(time.time() - start >= 1)
+        self.assertEqual(fo.read(), reference_data)
+        fo.close()
+        self.assertEqual(mg._racing, 0)
+
 class FakeGrabber:
     def __init__(self, resultlist=None):
         self.resultlist = resultlist or []
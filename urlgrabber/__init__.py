@@ -54,4 +54,4 @@ __author__  = 'Michael D. Stenner <mstenner@linux.duke.edu>, ' \
               'Zdenek Pavlas <zpavlas@redhat.com>'
 __url__     = 'http://urlgrabber.baseurl.org/'
 
-from .grabber import urlgrab, urlopen, urlread
+from .grabber import urlgrab, urlgrab_many, urlopen, urlread, urlread_ranges
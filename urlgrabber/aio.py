@@ -0,0 +1,424 @@
+#   This library is free software; you can redistribute it and/or
+#   modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+#
+#   This library is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, write to the
+#      Free Software Foundation, Inc.,
+#      59 Temple Place, Suite 330,
+#      Boston, MA  02111-1307  USA
+
+# This file is part of urlgrabber, a high-level cross-protocol url-grabber
+
+"""asyncio interface to urlgrabber
+
+DESCRIPTION
+
+  This module provides coroutine versions of urlgrab(), urlread() and
+  urlopen().  They take the same arguments and options as their
+  counterparts in urlgrabber.grabber, but the transfers run on a
+  pycurl.CurlMulti handle that is driven by the running event loop,
+  so any number of them can run concurrently without threads.
+
+    from urlgrabber import aio
+
+    async def main():
+        data = await aio.urlread('http://example.com/foo', retry=3)
+        filename = await aio.urlgrab('http://example.com/bar', '/tmp/bar')
+        fo = await aio.urlopen('http://example.com/baz')
+        async for chunk in fo:
+            ...
+        fo.close()
+
+  Retries, failure_callback, checkfunc, failfunc and progress_obj work
+  as usual, the callbacks are called from the event loop.  urlopen()
+  always streams: it returns as soon as the first data arrives, and the
+  transfer is paused whenever stream_bufsize bytes are buffered.  The
+  returned object has coroutine read() and readline() methods and is an
+  async iterator over the body chunks.
+
+  AsyncURLGrabber and AsyncMirrorGroup are the coroutine versions of
+  URLGrabber and MirrorGroup.  AsyncMirrorGroup accepts any URLGrabber
+  instances, only their options are used.  The async_ option and
+  parallel_wait() are not used here, use asyncio.gather() or tasks to
+  run grabs concurrently.
+"""
+
+import asyncio
+
+import pycurl
+
+from .grabber import URLGrabber, URLGrabError, CallbackObject, DEBUG
+from .grabber import PyCurlFileObject, default_grabber
+from .grabber import _run_callback, _do_raise, _to_utf8, _TH, _CB
+from .mirror import MirrorGroup
+
+def _(st):
+    return st
+
+class _Transfer:
+    """A PyCurlFileObject run by _Driver."""
+    def __init__(self, driver, fo):
+        self.driver = driver
+        self.fo = fo
+        self.done = driver.loop.create_future()
+        self.event = asyncio.Event()
+
+    async def wait(self):
+        """wait until the transfer is complete, raise on errors"""
+        return await self.done
+
+    async def more(self):
+        """wait for more data, return False at the end of the body"""
+        if self.done.done():
+            self.done.result() # raise errors
+            return False
+        self.event.clear()
+        await self.event.wait()
+        return True
+
+    def resume(self):
+        """unpause the transfer if the reader has made room"""
+        if self.fo._paused:
+            self.fo._unpause()
+            if not self.fo._paused:
+                self.driver.kick()
+
+    def abort(self):
+        if not self.done.done():
+            self.driver.running.pop(self.fo.curl_obj, None)
+            self.done.cancel()
+        elif not self.done.cancelled():
+            self.done.exception() # retrieved
+        self.fo.close()
+
+class _Driver:
+    """Run PyCurlFileObject transfers on a CurlMulti handle, using
+    the socket interface with the event loop's readers, writers
+    and timers.  There's one per event loop."""
+    def __init__(self, loop):
+        self.loop = loop
+        self.multi = pycurl.CurlMulti()
+        self.multi.setopt(pycurl.M_SOCKETFUNCTION, self._socket)
+        self.multi.setopt(pycurl.M_TIMERFUNCTION, self._timer)
+        self.running = {} # curl_obj => _Transfer
+        self.timer = None
+
+    def start(self, url, filename, opts):
+        # the handles come from the module pool, a user supplied
+        # curl_obj can't be added to the multi handle more than once
+        opts = opts.derive(curl_obj=None)
+        fo = PyCurlFileObject(url, filename, opts, multi=self.multi)
+        t = self.running[fo.curl_obj] = _Transfer(self, fo)
+        return t
+
+    def kick(self):
+        """let libcurl run the timeouts soon"""
+        self.loop.call_soon(self._action, pycurl.SOCKET_TIMEOUT, 0)
+
+    def _socket(self, what, fd, multi, data):
+        if what & pycurl.POLL_IN and what != pycurl.POLL_REMOVE:
+            self.loop.add_reader(fd, self._action, fd, pycurl.CSELECT_IN)
+        else:
+            self.loop.remove_reader(fd)
+        if what & pycurl.POLL_OUT and what != pycurl.POLL_REMOVE:
+            self.loop.add_writer(fd, self._action, fd, pycurl.CSELECT_OUT)
+        else:
+            self.loop.remove_writer(fd)
+
+    def _timer(self, timeout_ms):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if timeout_ms >= 0:
+            self.timer = self.loop.call_later(timeout_ms / 1000.0, self._action,
+                                              pycurl.SOCKET_TIMEOUT, 0)
+
+    def _action(self, fd, events):
+        while True:
+            code, num_active = self.multi.socket_action(fd, events)
+            if code != pycurl.E_CALL_MULTI_PERFORM:
+                break
+        while True:
+            num_q, ok, err = self.multi.info_read()
+            for curl_obj in ok:
+                self._done(curl_obj)
+            for curl_obj, errcode, errmsg in err:
+                self._done(curl_obj, errcode, errmsg)
+            if num_q == 0:
+                break
+        # wake up the readers of streaming transfers
+        for t in self.running.values():
+            t.event.set()
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.multi.close()
+
+    def _done(self, curl_obj, errcode=0, errmsg=''):
+        t = self.running.pop(curl_obj, None)
+        if t is None:
+            return
+        try:
+            t.fo._multi_done(errcode, errmsg)
+        except URLGrabError as e:
+            t.done.set_exception(e)
+        else:
+            t.done.set_result(t.fo)
+        t.event.set()
+
+_drivers = {} # loop => _Driver
+
+def _get_driver():
+    loop = asyncio.get_running_loop()
+    driver = _drivers.get(loop)
+    if driver is None:
+        for old in [old for old in _drivers if old.is_closed()]:
+            _drivers.pop(old).close()
+        driver = _drivers[loop] = _Driver(loop)
+    return driver
+
+class AsyncFileObject:
+    """The body of a streaming transfer, returned by urlopen().
+
+    read(), readline() and readlines() are coroutines, iterating
+    over the object yields the chunks of the body as they arrive.
+    Other attributes (url, hdr, http_code, ...) are those of the
+    PyCurlFileObject.
+    """
+    def __init__(self, transfer):
+        self._transfer = transfer
+        self.fo = transfer.fo
+
+    def __getattr__(self, name):
+        return getattr(self.fo, name)
+
+    async def read(self, amt=-1):
+        """read up to amt bytes, or the whole body.  Returns as soon
+        as some data is available, b'' at the end of the body."""
+        if amt is None: amt = -1
+        buf = self.fo.fo
+        ret = []
+        while True:
+            chunk = buf.read(amt)
+            if chunk:
+                self._transfer.resume()
+                if amt >= 0:
+                    return chunk
+                ret.append(chunk)
+            elif not await self._transfer.more():
+                break
+        return b''.join(ret)
+
+    async def readline(self, limit=-1):
+        if limit is None: limit = -1
+        buf = self.fo.fo
+        ret = []
+        while limit:
+            line = buf.readline(limit)
+            if line:
+                self._transfer.resume()
+                ret.append(line)
+                if line.endswith(b'\n'): break
+                if limit > 0: limit -= len(line)
+            elif not await self._transfer.more():
+                break
+        return b''.join(ret)
+
+    async def readlines(self):
+        lines = []
+        while True:
+            line = await self.readline()
+            if not line: break
+            lines.append(line)
+        return lines
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await self.read(self.fo.opts.stream_bufsize)
+        if not chunk:
+            raise StopAsyncIteration
+        return chunk
+
+    def close(self):
+        self._transfer.abort()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+class AsyncURLGrabber(URLGrabber):
+    """Coroutine version of URLGrabber.  urlgrab(), urlread() and
+    urlopen() are coroutines that take the same arguments."""
+
+    async def _retry(self, opts, func, *args):
+        tries = 0
+        while True:
+            tries = tries + 1
+            if DEBUG: DEBUG.info('attempt %i/%s: %s',
+                                 tries, opts.retry, args[0])
+            try:
+                _CB.check(args[0], opts)
+                r = await func(opts, *args)
+                if DEBUG: DEBUG.info('success')
+                _CB.update(args[0], None, opts)
+                return r
+            except URLGrabError as e:
+                _CB.update(args[0], e, opts)
+                exception = e
+            delay = self._retry_failed(opts, tries, args[0], exception,
+                                       opts.failure_callback)
+            if delay:
+                await asyncio.sleep(delay)
+
+    async def urlopen(self, url, opts=None, **kwargs):
+        """open the url and return an AsyncFileObject"""
+        url = _to_utf8(url)
+        opts = (opts or self.opts).derive(**kwargs)
+        opts.stream = True
+        if DEBUG: DEBUG.debug('combined options: %r' % (opts,))
+        (url,parts) = opts.urlparser.parse(url, opts)
+        opts.find_proxy(url, parts[0])
+        async def retryfunc(opts, url):
+            t = _get_driver().start(url, None, opts)
+            try:
+                # wait for the first data, so that connection
+                # and HTTP errors can be retried
+                while not len(t.fo.fo) and await t.more():
+                    pass
+            except BaseException:
+                t.abort()
+                raise
+            return AsyncFileObject(t)
+        return await self._retry(opts, retryfunc, url)
+
+    async def urlgrab(self, url, filename=None, opts=None, **kwargs):
+        """grab the file at <url> and make a local copy at <filename>"""
+        url = _to_utf8(url)
+        opts = (opts or self.opts).derive(**kwargs)
+        if DEBUG: DEBUG.debug('combined options: %r' % (opts,))
+        url, filename, path = self._parse_grab(url, filename, opts)
+        if path is not None:
+            return path
+
+        async def retryfunc(opts, url, filename):
+            t = _get_driver().start(url, filename, opts)
+            fo = t.fo
+            try:
+                await t.wait()
+                _TH.grabbed(url, fo)
+                if not opts.checkfunc is None:
+                    obj = CallbackObject(filename=filename, url=url, stats=fo.stats)
+                    _run_callback(opts.checkfunc, obj)
+            finally:
+                t.abort()
+            return filename
+
+        try:
+            return await self._retry(opts, retryfunc, url, filename)
+        except URLGrabError as e:
+            _TH.update(url, 0, 0, e)
+            opts.stats = getattr(e, 'stats', None)
+            opts.exception = e
+            return _run_callback(opts.failfunc, opts)
+
+    async def urlread(self, url, limit=None, opts=None, **kwargs):
+        """read the url into a string, up to 'limit' bytes"""
+        url = _to_utf8(url)
+        opts = (opts or self.opts).derive(**kwargs)
+        if DEBUG: DEBUG.debug('combined options: %r' % (opts,))
+        (url,parts) = opts.urlparser.parse(url, opts)
+        opts.find_proxy(url, parts[0])
+        if limit is not None:
+            limit = limit + 1
+
+        async def retryfunc(opts, url, limit):
+            t = _get_driver().start(url, None, opts)
+            try:
+                fo = await t.wait()
+                if limit is None: s = fo.read()
+                else: s = fo.read(limit)
+
+                if not opts.checkfunc is None:
+                    obj = CallbackObject(data=s, url=url, stats=fo.stats)
+                    _run_callback(opts.checkfunc, obj)
+            finally:
+                t.abort()
+            return s
+
+        s = await self._retry(opts, retryfunc, url, limit)
+        if limit and len(s) > limit:
+            err = URLGrabError(8,
+                               _('Exceeded limit (%i): %s') % (limit, url))
+            err.url = url
+            raise err
+
+        return s
+
+_grabber = AsyncURLGrabber()
+
+async def urlgrab(url, filename=None, **kwargs):
+    """coroutine version of urlgrabber.grabber.urlgrab(), using
+    the options of default_grabber"""
+    return await _grabber.urlgrab(url, filename, opts=default_grabber.opts, **kwargs)
+
+async def urlopen(url, **kwargs):
+    """coroutine version of urlgrabber.grabber.urlopen(), using
+    the options of default_grabber"""
+    return await _grabber.urlopen(url, opts=default_grabber.opts, **kwargs)
+
+async def urlread(url, limit=None, **kwargs):
+    """coroutine version of urlgrabber.grabber.urlread(), using
+    the options of default_grabber"""
+    return await _grabber.urlread(url, limit, opts=default_grabber.opts, **kwargs)
+
+class AsyncMirrorGroup(MirrorGroup):
+    """Coroutine version of MirrorGroup.  The grabbers may be plain
+    URLGrabber instances, the transfers are run by AsyncURLGrabber
+    with their options."""
+
+    async def _mirror_try(self, func, url, kw):
+        gr = self._new_gr(func, url, kw)
+
+        tries = 0
+        while True:
+            tries += 1
+            mirrorchoice, fullurl, grabber, opts = self._next_try(gr)
+            func_ref = getattr(_grabber, func)
+            try:
+                return await func_ref( *(fullurl,), opts=opts, **kw )
+            except URLGrabError as e:
+                self._try_failed(gr, mirrorchoice, fullurl, tries, e)
+
+    async def urlgrab(self, url, filename=None, **kwargs):
+        kw = dict(kwargs)
+        kw['filename'] = filename
+        kw.pop('failfunc', None)
+        func = 'urlgrab'
+        try:
+            return await self._mirror_try(func, url, kw)
+        except URLGrabError as e:
+            obj = CallbackObject(url=url, filename=filename, exception=e, **kwargs)
+            return _run_callback(kwargs.get('failfunc', _do_raise), obj)
+
+    async def urlopen(self, url, **kwargs):
+        kw = dict(kwargs)
+        func = 'urlopen'
+        return await self._mirror_try(func, url, kw)
+
+    async def urlread(self, url, limit=None, **kwargs):
+        kw = dict(kwargs)
+        kw['limit'] = limit
+        func = 'urlread'
+        return await self._mirror_try(func, url, kw)
@@ -27,6 +27,7 @@ import ftplib
 import socket
 import sys
 import mimetypes
+import re
 
 try:
     from urllib.request import BaseHandler, FileHandler, FTPHandler, URLError
@@ -470,3 +471,100 @@ def range_tuple_normalize(range_tup):
         raise RangeError(9, 'Invalid byte range: %s-%s' % (fb,lb))
     return (fb,lb)
 
+def range_tuples_coalesce(ranges, gap=0):
+    """Normalize and merge a list of (first_byte,last_byte) range
+    tuples.  Ranges that overlap, or are at most 'gap' bytes apart,
+    become one.  Return a sorted list of (first_byte,last_byte)
+    tuples, the last byte being '' for 'up to the end of the file'.
+    """
+    merged = []
+    for fb, lb in sorted((range_tuple_normalize(r) or (0, '') for r in ranges),
+                         key=lambda r: r[0]):
+        if merged:
+            pfb, plb = merged[-1]
+            if plb == '' or fb <= plb + gap:
+                if plb != '' and (lb == '' or lb > plb):
+                    merged[-1] = (pfb, lb)
+                continue
+        merged.append((fb, lb))
+    return merged
+
+def range_tuples_to_header(ranges):
+    """Convert a list of range tuples to a Range header value.
+    Return a string of the form "bytes=<fb>-<lb>,<fb>-<lb>..." or
+    None if no range is needed.
+    """
+    ranges = range_tuples_coalesce(ranges)
+    if not ranges or ranges == [(0, '')]: return None
+    specs = []
+    for fb, lb in ranges:
+        if lb: lb -= 1
+        specs.append('%s-%s' % (fb, lb))
+    return 'bytes=' + ','.join(specs)
+
+class MultipartByteranges:
+    """Streaming parser of a multipart/byteranges response body.
+
+    Feed it the body as it arrives; feed() returns a list of
+    (offset, data) pairs, where data is a memoryview of the fed
+    buffer, so the part bodies are never copied.  Every part must
+    have a Content-Range header.  'done' is set when the closing
+    delimiter has been seen.
+    """
+    max_header_size = 16384
+
+    def __init__(self, boundary):
+        if not isinstance(boundary, bytes):
+            boundary = boundary.encode('ascii')
+        self.delimiter = b'--' + boundary
+        self.done = False
+        self._head = b''
+        self._offset = 0
+        self._left = 0
+
+    def feed(self, data):
+        data = memoryview(data)
+        ret = []
+        i = 0
+        while i < len(data) and not self.done:
+            if self._left:
+                n = min(self._left, len(data) - i)
+                ret.append((self._offset, data[i:i+n]))
+                self._offset += n
+                self._left -= n
+                i += n
+                continue
+
+            # the delimiter and headers of the next part
+            chunk = data[i:i+self.max_header_size].tobytes()
+            head = self._head + chunk
+            used = self._parse_head(head)
+            if used is None:
+                if len(head) > self.max_header_size:
+                    raise RangeError(9, 'Invalid multipart/byteranges response')
+                self._head = head
+                i += len(chunk)
+            else:
+                i += used - len(self._head)
+                self._head = b''
+        return ret
+
+    def _parse_head(self, head):
+        """Start the part in head.  Return the number of bytes used,
+        or None if head is not complete yet."""
+        start = head.find(self.delimiter)
+        if start < 0: return None
+        start += len(self.delimiter)
+        if len(head) < start + 2: return None
+        if head[start:start+2] == b'--':
+            self.done = True
+            return len(head)
+        end = head.find(b'\r\n\r\n', start)
+        if end < 0: return None
+        m = re.search(br'^content-range:\s*bytes\s+(\d+)-(\d+)/',
+                      head[start:end], re.I | re.M)
+        if not m:
+            raise RangeError(9, 'Invalid multipart/byteranges response')
+        self._offset = int(m.group(1))
+        self._left = int(m.group(2)) + 1 - self._offset
+        return end + 4
@@ -32,7 +32,8 @@ GENERAL ARGUMENTS (kwargs)
     ignored except for file:// urls, in which case it specifies
     whether urlgrab should still make a copy of the file, or simply
     point to the existing copy. The module level default for this
-    option is 0.
+    option is 0.  Copies are made by the kernel, with a reflink when
+    the filesystem supports it, or copy_file_range()/sendfile().
 
   close_connection = 0   [0|1]
 
@@ -73,21 +74,34 @@ GENERAL ARGUMENTS (kwargs)
 
   curl_obj = None
 
-    a pycurl.Curl instance to be used instead of the default module-level
-    instance.
+    a pycurl.Curl instance to be used instead of one from the module-level
+    handle pool.
 
     Note that you don't have to configure the passed instance in any way;
     urlgrabber will do all the necessary work.
 
-    This option exists primarily to allow using urlgrabber from multiple
-    threads in your application, in which case you would want to instantiate a
-    fresh Curl object for each thread, to avoid race conditions.  See the curl
-    documentation on thread safety for more information:
+    The module-level pool is thread-safe: each transfer takes an idle
+    handle for its scheme, host, port, proxy and TLS identity, or creates
+    a new one, and returns it when the transfer is complete.  All pooled
+    handles share the DNS cache and TLS sessions through a
+    pycurl.CurlShare object.  See the curl documentation on thread safety
+    for more information:
     https://curl.haxx.se/libcurl/c/threadsafe.html
 
     Note that connection reuse (keepalive=1) is limited to the Curl instance it
-    was enabled on so if you're using multiple instances in your application,
-    connections won't be shared among them.
+    was enabled on so if you're passing your own instances, connections won't
+    be shared among them.
+
+  curl_pool_size = 8
+
+    the maximum number of idle Curl handles kept in the module-level pool.
+    When a handle is returned to a full pool, the least recently used one
+    is closed.
+
+  curl_pool_idle = 60
+
+    the number of seconds an idle handle is kept in the pool.  Handles
+    idle for longer are closed, and their connections with them.
 
   text = None
 
@@ -152,6 +166,12 @@ GENERAL ARGUMENTS (kwargs)
         local file is newer than or the same age as the server file
         will reget be used.  If the server file is newer, or the
         timestamp is not returned, the entire file will be fetched.
+        For http this is a single conditional request (If-Range):
+        the server sends the rest of the file only if its timestamp
+        is exactly that of the local file, else all of it.
+        Other schemes than http and file:// always get the entire
+        file.  Partial files of failed downloads keep the server's
+        timestamp, so that they can be resumed.
 
     NOTE: urlgrabber can do very little to verify that the partial
     file on disk is identical to the beginning of the remote file.
@@ -197,6 +217,18 @@ GENERAL ARGUMENTS (kwargs)
     requests.  This is equivalent to setting
       http_headers = (('Pragma', 'no-cache'),)
 
+  cache_dir = None
+
+    a directory for an on-disk cache of the http and https urls
+    fetched with urlgrab() and urlread().  Bodies are stored by their
+    sha256 digest, and an index keeps the ETag and Last-Modified
+    validators of each url.  Later requests for a cached url send
+    If-None-Match and If-Modified-Since, and when the server answers
+    304 Not Modified the cached body is used, after checking its
+    digest.  urlgrab() reflinks it to the filename where the
+    filesystem supports that and copies it otherwise.  The cache is
+    not used with range, reget, segments or async_.
+
   prefix = None
 
     a url prefix that will be prepended to all requested urls.  For
@@ -301,35 +333,163 @@ GENERAL ARGUMENTS (kwargs)
     size (in bytes) or Maximum size of the thing being downloaded.
     This is mostly to keep us from exploding with an endless datastream
 
+  exact_size = False
+
+    when true, size is the exact size of the file instead of a
+    maximum.  A Content-Length that disagrees with it, or more data
+    than that, aborts the transfer right away with URLGrabError 18.
+    So does a transfer that ends short.  Ignored if size is not set or
+    with range.  Both options are passed to urlgrabber-ext-down, so in
+    parallel_wait() a mirror serving the wrong file fails over without
+    downloading all of it.
+
   max_header_size = 2097152
 
     Maximum size (in bytes) of the headers.
 
+  stream = False   [False|True]
+
+    only affects urlopen() and urlread().  When true, urlopen()
+    returns as soon as the first data arrives, and the rest of the
+    body is downloaded on demand as the returned file object is read
+    instead of being fetched into memory up front.  When the reader
+    falls behind, the transfer is paused, so at most stream_bufsize
+    bytes (plus one network chunk) are kept in memory.  Note that
+    file:// transfers can't be paused and are buffered in full.
+
+  stream_bufsize = 262144
+
+    the number of bytes a streaming urlopen() buffers before the
+    transfer is paused.
+
+  seekable = False   [False|True]
+
+    only affects urlopen().  When true, it returns a file object with
+    working seek(), tell(), read() and readinto() (an io.RawIOBase).
+    Aligned blocks of an http or https file are fetched on demand
+    with range requests and the recently used ones are cached, so a
+    zip or tar reader only transfers the bytes it touches.  When
+    misses are sequential, each request reads ahead twice as many
+    blocks as the previous one, up to 16.  file:// urls are opened
+    directly; other schemes, and servers without byte ranges, are
+    downloaded to a temporary file.
+
+  seekable_block_size = 131072
+
+    the size of the blocks of a seekable urlopen().
+
+  seekable_cache_size = 8388608
+
+    the number of bytes of blocks a seekable urlopen() keeps in
+    memory.
+
+  segments = 1
+
+    when greater than 1, urlgrab() downloads an http or https file in
+    up to this many byte ranges at once, each on its own connection.
+    The ranges are written in place at their offsets in the local file.
+    A request for the first byte checks that the server supports ranges
+    and gets the size of the file; if it doesn't, the file is downloaded
+    in one piece.  When grabbing through a MirrorGroup, the ranges are
+    spread over its mirrors, faster mirrors (as estimated from the
+    timedhosts data) get bigger ranges, and a failed range is resumed
+    from the next mirror.  Ignored for async_ requests.
+
+  min_segment_size = 1048576
+
+    files are not split into ranges smaller than this.
+
+  segment_mirrors = None
+
+    set by MirrorGroup for segmented downloads: a list of
+    (url, opts, speed, mirror) tuples of the mirrors to fetch ranges
+    from.  opts are the options of the mirror's grabber with its
+    kwargs, the kwargs of the grab are applied on top of them.  A
+    failed range goes through the failure_callback and default_action
+    of the MirrorGroup, like a failed async_ request.
+
   ip_resolve = 'whatever'
 
     What type of name to IP resolving to use, default is to do both IPV4 and
     IPV6.
 
+  dns_cache_timeout = 60
+
+    the number of seconds resolved names are kept in the DNS cache.
+    The cache is shared by all Curl handles urlgrabber creates, so
+    it's not limited to a single connection or transfer.  0 disables
+    caching, -1 keeps the entries forever.
+
+  resolve = None
+
+    a list of 'host:port:address[,address]...' strings, see
+    CURLOPT_RESOLVE.  The given addresses are used instead of resolving
+    host for connections to that port, eg:
+
+      resolve = ['mirror.example.com:443:192.0.2.10']
+
+    The entries are added to the shared DNS cache, so they stay in
+    effect for later transfers that don't set this option.
+
   async_ = (key, limit)
 
     When this option is set, the urlgrab() is not processed immediately
     but queued.  parallel_wait() then processes grabs in parallel, limiting
     the numer of connections in each 'key' group to at most 'limit'.
 
+  batch = None
+
+    a Batch to queue the async_ request to, instead of the module queue
+    that parallel_wait() processes.  Each Batch has its own queue and
+    downloaders, so independent sets of requests can run at the same
+    time, and it yields the requests as they finish.
+    URLGrabber.urlgrab_many() grabs a list of urls in a new Batch.
+
   max_connections
 
     The global connection limit.
 
+  parallel_backend = 'external'   [ 'external' | 'curlmulti' ]
+
+    How parallel_wait() runs the queued downloads.  'external' forks
+    one urlgrabber-ext-down process per host.  'curlmulti' runs all
+    transfers in the calling process on a single pycurl.CurlMulti
+    handle, reusing a small pool of Curl handles, and multiplexes
+    HTTP/2 streams when libcurl supports it.  Both backends honour
+    max_connections, async_ limits, retries and mirror failover.
+    Like max_connections, this is read from default_grabber, a Batch
+    can have its own.
+
+  downloader_pool = None
+
+    a pool created by downloader_pool() that parallel_wait() uses when
+    no pool is passed to it.  Idle helper processes (or, with the
+    curlmulti backend, the multi handle and its connections) are kept
+    in the pool between parallel_wait() calls instead of being torn
+    down at the end of every batch.  Read from default_grabber.
+
+  parallel_order = 'fifo'   [ 'fifo' | 'size' ]
+
+    The order in which parallel_wait() starts queued requests.  Each
+    host has its own queue, and a host that reached its connection
+    limit does not delay requests for other hosts.  With 'fifo' the
+    requests are started in the order they were queued, 'size' starts
+    the largest ones (by the size option) first so that the batch
+    doesn't end waiting for one big file.  Read from default_grabber,
+    a Batch can have its own.
+
   timedhosts
 
     The filename of the host download statistics.  If defined, urlgrabber
     will update the stats at the end of every download.  At the end of
     parallel_wait(), the updated stats are saved.  If synchronous grabs
-    are used, you should call th_save().
+    are used, you should call th_save().  Several processes can share
+    the file: saves take a lock (on the file name + '.lock') and merge
+    in what the others have saved in the meantime.
 
-  default_speed, half_life
+  default_speed, default_latency, half_life
 
-    These options only affect the async mirror selection code.
+    These options only affect the mirror selection code.
     The default_speed option sets the speed estimate for mirrors
     we have never downloaded from, and defaults to 1 MBps.
 
@@ -337,6 +497,14 @@ GENERAL ARGUMENTS (kwargs)
     actually measured to the default speed, with default
     period of 30 days.
 
+    The connect, TLS and time to first byte latencies of every
+    transfer, whatever its size, are kept in quantile sketches whose
+    weights decay with the same half life.  Mirrors are ranked by
+    the expected time to get the file: the median time to first
+    byte plus the size (1MB if unknown) at the estimated speed.
+    default_latency, 0.2 seconds by default, is used for mirrors
+    without latency data.
+
   ftp_disable_epsv = False
 
     False, True
@@ -368,6 +536,51 @@ RETRY RELATED ARGUMENTS
       if 12 not in retrycodes:
           retrycodes.append(12)
 
+  retry_backoff = 0
+
+    the base of the exponential backoff between tries, in seconds.
+    Before try n+1, a random time between 0 and
+    retry_backoff * 2**(n-1) is waited ("full jitter"), so that
+    clients which failed together do not retry together.  Zero (the
+    default) retries at once, as older versions did.  Either way, if
+    a 429 or 503 response has a Retry-After header, at least that
+    long is waited.
+
+  retry_backoff_max = 30
+
+    the longest wait before a retry, in seconds.  If the server asks
+    to wait longer with Retry-After, the request fails right away
+    instead, so that a MirrorGroup moves on to the next mirror.
+
+  breaker_threshold = 0
+
+    the number of failures in a row after which the circuit breaker
+    of a host opens.  Timeouts, connection errors and 429 and 5xx
+    responses are failures, any other response closes the breaker.
+    The breakers are per host and shared by all the requests of the
+    process, sync, async and parallel.  While the breaker of a host
+    is open, requests to it fail at once with URLGrabError 19, and
+    a MirrorGroup moves on to the next mirror.  A failure with
+    a Retry-After header opens the breaker for that long, too.  Zero
+    (the default) disables the breakers.
+
+  breaker_cooldown = 30
+
+    the seconds an opened breaker stays open.  Then it is half-open:
+    one request is let through, and the breaker closes if that one
+    succeeds, or opens again if it fails.
+
+  checksums = None
+
+    a list of (algorithm, hexdigest) tuples, eg.
+    [('sha256', '9f86d08...')].  The algorithms are names known to
+    hashlib.  The digests are computed as the data arrives and are
+    compared when the transfer ends, before checkfunc is called.  A
+    mismatch raises URLGrabError 17 and truncates the local file.  When
+    regetting, the part of the file that is already there is hashed
+    once before the transfer.  Add 17 to retrycodes to retry on
+    mismatch.
+
   checkfunc = None
 
     a function to do additional checks. This defaults to None, which
@@ -386,7 +599,10 @@ RETRY RELATED ARGUMENTS
     argument: a CallbackObject instance with the .url attribute
     defined and either .filename (for urlgrab) or .data (for urlread).
     For urlgrab, .filename is the name of the local file.  For
-    urlread, .data is the actual string data.  If you need other
+    urlread, .data is the actual string data.  .stats is the
+    TransferStats of the transfer (DNS, connect, TLS and first byte
+    times, whether the connection was reused, ...), or None if
+    libcurl was not used.  If you need other
     arguments passed to the callback (program state of some sort), you
     can do so like this:
 
@@ -432,7 +648,10 @@ RETRY RELATED ARGUMENTS
     Callback syntax is identical to failure_callback.
 
     Contrary to failure_callback, it's called only once.  It's primary
-    purpose is to use urlgrab() without a try/except block.
+    purpose is to use urlgrab() without a try/except block.  .stats
+    is the TransferStats of the last try, if it got to libcurl.
+    After a urlgrab() or urlread() without async, the stats are also
+    in the stats attribute of the grabber.
 
   interrupt_callback = None
 
@@ -547,6 +766,19 @@ from ftplib import parse150
 import socket, select, fcntl
 from io import BytesIO
 import numbers
+import collections
+import threading
+import marshal
+import struct
+import re
+import errno
+import random
+import hashlib
+import email.utils
+import io
+import tempfile
+import math
+import bisect
 
 try:
     import urllib.parse as urlparse
@@ -574,6 +806,9 @@ else:
 from six import text_type, string_types
 
 from .byterange import range_tuple_normalize, range_tuple_to_header, RangeError
+from .byterange import range_tuples_coalesce, range_tuples_to_header
+from .byterange import MultipartByteranges
+from . import metrics
 
 try:
     import xattr
@@ -744,6 +979,9 @@ class URLGrabError(IOError):
         14   - HTTPError (includes .code and .exception attributes)
         15   - user abort
         16   - error writing to local file
+        17   - checksum mismatch
+        18   - size mismatch (see exact_size)
+        19   - host circuit breaker is open (see breaker_threshold)
 
       MirrorGroup error codes (256 -- 511)
         256  - No more mirrors left to try
@@ -794,6 +1032,85 @@ class CallbackObject:
     def __init__(self, **kwargs):
         self.__dict__.update(kwargs)
 
+class TransferStats:
+    """Timing and connection details of a transfer, from libcurl.
+
+    The times are in seconds since the start of the transfer:
+
+      namelookup   - name resolved
+      connect      - TCP connection established
+      tls          - TLS handshake done, 0 without TLS
+      ttfb         - first byte received
+      total        - transfer done
+
+    and the rest:
+
+      size         - bytes downloaded
+      url          - the effective url, after redirects
+      redirects    - the number of redirects followed
+      http_version - '1.0', '1.1', '2' or '3', None if not http or unknown
+      reused       - True if an open connection was reused
+
+    The stats of a grab are passed to checkfunc and failfunc as
+    .stats, and are kept in URLGrabber.stats.
+    """
+    _fields = ('namelookup', 'connect', 'tls', 'ttfb', 'total',
+               'size', 'url', 'redirects', 'http_version', 'reused')
+
+    def __init__(self, **kwargs):
+        for name in self._fields:
+            setattr(self, name, kwargs.get(name))
+
+    def __repr__(self):
+        return 'TransferStats(%s)' % ', '.join('%s=%r' % (name, getattr(self, name))
+                                               for name in self._fields)
+
+    @staticmethod
+    def _from_curl(curl_obj):
+        versions = {1: '1.0', 2: '1.1', 3: '2', 30: '3'}
+        info = curl_obj.getinfo
+        http_version = getattr(pycurl, 'INFO_HTTP_VERSION', None)
+        if http_version is not None: # libcurl >= 7.50
+            http_version = versions.get(info(http_version))
+        return TransferStats(
+            namelookup = info(pycurl.NAMELOOKUP_TIME),
+            connect = info(pycurl.CONNECT_TIME),
+            tls = info(pycurl.APPCONNECT_TIME),
+            ttfb = info(pycurl.STARTTRANSFER_TIME),
+            total = info(pycurl.TOTAL_TIME),
+            size = int(info(getattr(pycurl, 'SIZE_DOWNLOAD_T', pycurl.SIZE_DOWNLOAD))),
+            url = info(pycurl.EFFECTIVE_URL),
+            redirects = info(pycurl.REDIRECT_COUNT),
+            http_version = http_version,
+            reused = not info(pycurl.NUM_CONNECTS) and bool(info(pycurl.PRIMARY_IP)))
+
+    def _dict(self):
+        """the fields, for the external downloader"""
+        return dict((name, getattr(self, name)) for name in self._fields)
+
+def _count_transfer(url, stats, ug_err, baseurl=None):
+    """Record a finished transfer in the metrics registry"""
+    registry = metrics.REGISTRY
+    if registry is None:
+        return
+    host = _TH._host(url, baseurl) or ''
+    if ug_err is None:
+        code = 'ok'
+    else:
+        code = getattr(ug_err, 'code', None)
+        if isinstance(code, int) and code >= 100:
+            code = str(code)
+        elif code:
+            code = 'curl#%s' % code
+        else:
+            code = 'errno#%s' % ug_err.errno
+    registry.inc('urlgrabber_requests_total', host=host, code=code)
+    if stats is not None:
+        registry.inc('urlgrabber_bytes_total', stats.size or 0, host=host)
+        registry.observe('urlgrabber_request_seconds', stats.total, host=host)
+        if ug_err is None:
+            registry.observe('urlgrabber_ttfb_seconds', stats.ttfb, host=host)
+
 def urlgrab(url, filename=None, **kwargs):
     """grab the file at <url> and make a local copy at <filename>
     If filename is none, the basename of the url is used.
@@ -804,6 +1121,14 @@ def urlgrab(url, filename=None, **kwargs):
     """
     return default_grabber.urlgrab(url, filename, **kwargs)
 
+def urlgrab_many(requests, **kwargs):
+    """grab several files in parallel, yielding the results as they
+    finish.
+
+    See URLGrabber.urlgrab_many() and Batch.
+    """
+    return default_grabber.urlgrab_many(requests, **kwargs)
+
 def urlopen(url, **kwargs):
     """open the url and return a file object
     If a progress object or throttle specifications exist, then
@@ -824,6 +1149,15 @@ def urlread(url, limit=None, **kwargs):
     """
     return default_grabber.urlread(url, limit, **kwargs)
 
+def urlread_ranges(url, ranges, **kwargs):
+    """read several (start, end) byte ranges of the url, with a single
+    request if the server can.  Yields (offset, data) pairs.
+
+    See URLGrabber.urlread_ranges() and the module documentation for
+    a description of possible kwargs.
+    """
+    return default_grabber.urlread_ranges(url, ranges, **kwargs)
+
 
 class URLParser:
     """Process the URLs before passing them to urllib2.
@@ -940,23 +1274,46 @@ class URLParser:
             return 0
         return 1
 
-class URLGrabberOptions:
-    """Class to ease kwargs handling."""
+class URLGrabberOptions(object):
+    """Class to ease kwargs handling.
+
+    derive() copies the options of the delegate into the new instance,
+    so an option is a plain attribute however long the chain of
+    derive() calls.  Each instance remembers the options set on it:
+    assigning a new delegate replaces all the others.  Changes made to
+    the delegate after derive() are not seen by the derived instance.
+    """
 
     def __init__(self, delegate=None, **kwargs):
         """Initialize URLGrabberOptions object.
         Set default values for all options and then update options specified
         in kwargs.
         """
+        self.__dict__['_own'] = set()
         self.delegate = delegate
         if delegate is None:
             self._set_defaults()
         self._set_attributes(**kwargs)
 
-    def __getattr__(self, name):
-        if self.delegate and hasattr(self.delegate, name):
-            return getattr(self.delegate, name)
-        raise AttributeError(name)
+    def __setattr__(self, name, value):
+        d = self.__dict__
+        if name == 'delegate':
+            own = dict((k, d[k]) for k in d['_own'])
+            d.clear()
+            if value is not None:
+                d.update(value.__dict__)
+            d.update(own)
+            d['_own'] = set(own)
+        else:
+            d['_own'].add(name)
+        d[name] = value
+
+    def __delattr__(self, name):
+        d = self.__dict__
+        del d[name]
+        d['_own'].discard(name)
+        if d['delegate'] is not None and name in d['delegate'].__dict__:
+            d[name] = d['delegate'].__dict__[name]
 
     def raw_throttle(self):
         """Calculate raw throttle value from throttle and bandwidth
@@ -1014,10 +1371,12 @@ class URLGrabberOptions:
     def _set_attributes(self, **kwargs):
         """Update object attributes with those provided in kwargs."""
         self.__dict__.update(kwargs)
+        self._own.update(kwargs)
         if 'range' in kwargs:
             # normalize the supplied range value
             self.range = range_tuple_normalize(self.range)
         if 'async' in kwargs:
+            self._own.discard('async')
             self.async_ = self.__dict__.pop('async')
         if not self.reget in [None, 'simple', 'check_timestamp']:
             raise URLGrabError(11, _('Illegal reget mode: %s')
@@ -1031,17 +1390,26 @@ class URLGrabberOptions:
         self.progress_obj = None
         self.multi_progress_obj = None
         self.curl_obj = None
+        self.curl_pool_size = 8
+        self.curl_pool_idle = 60
         self.throttle = 1.0
         self.bandwidth = 0
         self.retry = None
         self.retrycodes = [-1,2,4,5,6,7]
+        self.retry_backoff = 0
+        self.retry_backoff_max = 30
+        self.breaker_threshold = 0
+        self.breaker_cooldown = 30
         self.checkfunc = None
+        self.checksums = None
         self.failfunc = _do_raise
         self.copy_local = 0
         self.close_connection = 0
         self.range = None
         self.user_agent = 'urlgrabber/%s' % __version__
         self.ip_resolve = None
+        self.dns_cache_timeout = 60
+        self.resolve = None
         self.keepalive = 1
         self.proxies = None
         self.libproxy = False
@@ -1073,25 +1441,37 @@ class URLGrabberOptions:
         self.ssl_key_pass = None # password to access the key
         self.size = None # if we know how big the thing we're getting is going
                          # to be. this is ultimately a MAXIMUM size for the file
+        self.exact_size = False
         self.max_header_size = 2097152 #2mb seems reasonable for maximum header size
+        self.stream = False
+        self.stream_bufsize = 256 * 1024
+        self.seekable = False
+        self.seekable_block_size = 128 * 1024
+        self.seekable_cache_size = 8 * 1024 * 1024
+        self.segments = 1
+        self.min_segment_size = 1024 * 1024
+        self.segment_mirrors = None
         self.async_ = None # blocking by default
+        self.batch = None
         self.mirror_group = None
         self.max_connections = 5
+        self.parallel_backend = 'external'
+        self.downloader_pool = None
+        self.parallel_order = 'fifo'
         self.timedhosts = None
         self.half_life = 30*24*60*60 # 30 days
         self.default_speed = 500e3 # 500 kBps
+        self.default_latency = 0.2
         self.ftp_disable_epsv = False
         self.no_cache = False
+        self.cache_dir = None
         self.retry_no_cache = False
 
     def __repr__(self):
         return self.format()
 
     def format(self, indent='  '):
-        keys = self.__dict__.keys()
-        if self.delegate is not None:
-            keys.remove('delegate')
-        keys.sort()
+        keys = sorted(self._own)
         s = '{\n'
         for k in keys:
             s = s + indent + '%-15r: %r,\n' % (k, self.__dict__[k])
@@ -1104,6 +1484,9 @@ class URLGrabberOptions:
 def _do_raise(obj):
     raise obj.exception
 
+def _do_nothing(obj):
+    pass
+
 def _run_callback(cb, obj):
     if not cb:
         return
@@ -1123,6 +1506,13 @@ class URLGrabber(object):
 
     def __init__(self, **kwargs):
         self.opts = URLGrabberOptions(**kwargs)
+        self._local = threading.local()
+
+    @property
+    def stats(self):
+        """The TransferStats of the last urlgrab() or urlread() of
+        this thread, None if it did not transfer with libcurl."""
+        return getattr(self._local, 'stats', None)
 
     def _retry(self, opts, func, *args):
         tries = 0
@@ -1142,10 +1532,13 @@ class URLGrabber(object):
             if DEBUG: DEBUG.info('attempt %i/%s: %s',
                                  tries, opts.retry, args[0])
             try:
+                _CB.check(args[0], opts)
                 r = func(opts, *args)
                 if DEBUG: DEBUG.info('success')
+                _CB.update(args[0], None, opts)
                 return r
             except URLGrabError as e:
+                _CB.update(args[0], e, opts)
                 exception = e
                 callback = opts.failure_callback
             except KeyboardInterrupt as e:
@@ -1154,25 +1547,44 @@ class URLGrabber(object):
                 if not callback:
                     raise
 
-            if DEBUG: DEBUG.info('exception: %s', exception)
-            if callback:
-                if DEBUG: DEBUG.info('calling callback: %s', callback)
-                obj = CallbackObject(exception=exception, url=args[0],
-                                     tries=tries, retry=opts.retry,
-                                     retry_no_cache=opts.retry_no_cache)
-                _run_callback(callback, obj)
-
-            if (opts.retry is None) or (tries == opts.retry):
-                if DEBUG: DEBUG.info('retries exceeded, re-raising')
-                raise exception
-
-            retrycode = getattr(exception, 'errno', None)
-            if (retrycode is not None) and (retrycode not in opts.retrycodes):
-                if DEBUG: DEBUG.info('retrycode (%i) not in list %s, re-raising',
-                                     retrycode, opts.retrycodes)
+            delay = self._retry_failed(opts, tries, args[0], exception, callback)
+            if delay:
+                time.sleep(delay)
+
+    def _retry_failed(self, opts, tries, url, exception, callback):
+        """Handle a failed attempt of _retry().  Runs the callback,
+        then re-raises the exception unless another try is allowed.
+        Returns the seconds to wait before the next try."""
+        if DEBUG: DEBUG.info('exception: %s', exception)
+        if callback:
+            if DEBUG: DEBUG.info('calling callback: %s', callback)
+            obj = CallbackObject(exception=exception, url=url,
+                                 tries=tries, retry=opts.retry,
+                                 retry_no_cache=opts.retry_no_cache)
+            _run_callback(callback, obj)
+
+        if (opts.retry is None) or (tries == opts.retry):
+            if DEBUG: DEBUG.info('retries exceeded, re-raising')
+            raise exception
+
+        retrycode = getattr(exception, 'errno', None)
+        if (retrycode is not None) and (retrycode not in opts.retrycodes):
+            if DEBUG: DEBUG.info('retrycode (%i) not in list %s, re-raising',
+                                 retrycode, opts.retrycodes)
+            raise exception
+        delay = 0
+        if retrycode is not None:
+            delay = _retry_delay(opts, tries, exception)
+            if delay is None:
+                if DEBUG: DEBUG.info('Retry-After %ss is too long, re-raising',
+                                     exception.retry_after)
                 raise exception
-            if retrycode is not None and retrycode < 0 and opts.retry_no_cache:
-                opts.no_cache = True
+            if DEBUG: DEBUG.info('retrying in %.3fs', delay)
+            if metrics.REGISTRY:
+                metrics.REGISTRY.inc('urlgrabber_retries_total', host=_TH._host(url) or '')
+        if retrycode is not None and retrycode < 0 and opts.retry_no_cache:
+            opts.no_cache = True
+        return delay
 
     def urlopen(self, url, opts=None, **kwargs):
         """open the url and return a file object
@@ -1187,6 +1599,8 @@ class URLGrabber(object):
         (url,parts) = opts.urlparser.parse(url, opts)
         opts.find_proxy(url, parts[0])
         def retryfunc(opts, url):
+            if opts.seekable:
+                return _SeekableFile(self, url, opts)
             return PyCurlFileObject(url, filename=None, opts=opts)
         return self._retry(opts, retryfunc, url)
 
@@ -1199,6 +1613,111 @@ class URLGrabber(object):
         url = _to_utf8(url)
         opts = (opts or self.opts).derive(**kwargs)
         if DEBUG: DEBUG.debug('combined options: %r' % (opts,))
+        url, filename, path = self._parse_grab(url, filename, opts)
+        if path is not None:
+            return path
+
+        if opts.async_:
+            opts.url = url
+            opts.filename = filename
+            opts.size = int(opts.size or 0)
+            if opts.batch is not None:
+                opts.batch.queue.append(opts)
+            else:
+                _async_queue.append(opts)
+            return filename
+
+        def retryfunc(opts, url, filename):
+            self._local.stats = None
+            if urlparse.urlsplit(url)[0] == b'file':
+                _copy_local(url, filename, opts)
+                if not opts.checkfunc is None:
+                    obj = CallbackObject(filename=filename, url=url, stats=None)
+                    _run_callback(opts.checkfunc, obj)
+                return filename
+
+            cache = _DownloadCache.get(opts, url)
+            if (cache is None and opts.segments > 1
+                and not opts.range and not opts.reget):
+                sources = [(url, opts, _TH.estimate(url)[0], None)]
+                removed = opts.mirror_group and opts.mirror_group[3] or ()
+                for mirror_url, mirror_opts, speed, key in opts.segment_mirrors or ():
+                    mirror_opts = mirror_opts.derive(**kwargs)
+                    mirror_url, parts = mirror_opts.urlparser.parse(
+                        _to_utf8(mirror_url), mirror_opts)
+                    if mirror_url == url:
+                        sources[0] = url, opts, sources[0][2], key
+                    elif key not in removed:
+                        mirror_opts.find_proxy(mirror_url, parts[0])
+                        sources.append((mirror_url, mirror_opts, speed, key))
+                if _SegmentedGrab(filename, opts, sources).run():
+                    if not opts.checkfunc is None:
+                        obj = CallbackObject(filename=filename, url=url, stats=None)
+                        _run_callback(opts.checkfunc, obj)
+                    return filename
+
+            if cache is None:
+                fo = PyCurlFileObject(url, filename, opts)
+            else:
+                # download to a temporary file, filename is replaced
+                # by it, or by the cached body on 304
+                entry = cache.lookup(url)
+                tmp = _grab_tmpname(url, filename)
+                try:
+                    fo = PyCurlFileObject(url, tmp, cache.request_opts(opts, entry))
+                except URLGrabError:
+                    try: os.unlink(tmp)
+                    except OSError: pass
+                    raise
+            try:
+                fo._do_grab()
+                self._local.stats = fo.stats
+                if cache is not None:
+                    cache.grabbed(url, entry, fo, filename, opts)
+                _TH.grabbed(url, fo)
+                if not opts.checkfunc is None:
+                    obj = CallbackObject(filename=filename, url=url, stats=fo.stats)
+                    _run_callback(opts.checkfunc, obj)
+            except:
+                if cache is not None:
+                    try: os.unlink(tmp)
+                    except OSError: pass
+                raise
+            finally:
+                fo.close()
+            return filename
+
+        try:
+            return self._retry(opts, retryfunc, url, filename)
+        except URLGrabError as e:
+            _TH.update(url, 0, 0, e)
+            if getattr(e, 'stats', None) is not None:
+                self._local.stats = e.stats
+            opts.stats = self.stats
+            opts.exception = e
+            return _run_callback(opts.failfunc, opts)
+
+    def urlgrab_many(self, requests, max_connections=None, meter=None,
+                     pool=None, parallel_backend=None, parallel_order=None,
+                     **kwargs):
+        """grab several files in parallel, in a Batch of their own.
+        requests are urls or (url, filename) pairs, kwargs apply to
+        all of them.  Returns an iterator over the results, see Batch.
+        """
+        batch = Batch(max_connections, pool, meter, parallel_backend,
+                      parallel_order)
+        for request in requests:
+            if isinstance(request, tuple):
+                url, filename = request
+            else:
+                url, filename = request, None
+            batch.urlgrab(url, filename, grabber=self, **kwargs)
+        return iter(batch)
+
+    def _parse_grab(self, url, filename, opts):
+        """Parse the url and pick the local filename for urlgrab().
+        Returns (url, filename, path), path is the name of the local
+        file to return instead of making a copy, or None."""
         (url,parts) = opts.urlparser.parse(url, opts)
         (scheme, host, path, parm, query, frag) = parts
         opts.find_proxy(url, scheme)
@@ -1210,9 +1729,7 @@ class URLGrabber(object):
         if scheme == 'file' and not opts.copy_local:
             # just return the name of the local file - don't make a
             # copy currently
-            path = url2pathname(path)
-            if host:
-                path = os.path.normpath('//' + host + path)
+            path = _local_path(url)
             if not os.path.exists(path):
                 err = URLGrabError(2,
                       _('Local file does not exist: %s') % (path, ))
@@ -1226,38 +1743,10 @@ class URLGrabber(object):
 
             elif not opts.range:
                 if not opts.checkfunc is None:
-                    obj = CallbackObject(filename=path, url=url)
-                    _run_callback(opts.checkfunc, obj)
-                return path
-
-        if opts.async_:
-            opts.url = url
-            opts.filename = filename
-            opts.size = int(opts.size or 0)
-            _async_queue.append(opts)
-            return filename
-
-        def retryfunc(opts, url, filename):
-            fo = PyCurlFileObject(url, filename, opts)
-            try:
-                fo._do_grab()
-                if fo._tm_last:
-                    dlsz = fo._tm_last[0] - fo._tm_first[0]
-                    dltm = fo._tm_last[1] - fo._tm_first[1]
-                    _TH.update(url, dlsz, dltm, None)
-                if not opts.checkfunc is None:
-                    obj = CallbackObject(filename=filename, url=url)
+                    obj = CallbackObject(filename=path, url=url, stats=None)
                     _run_callback(opts.checkfunc, obj)
-            finally:
-                fo.close()
-            return filename
-
-        try:
-            return self._retry(opts, retryfunc, url, filename)
-        except URLGrabError as e:
-            _TH.update(url, 0, 0, e)
-            opts.exception = e
-            return _run_callback(opts.failfunc, opts)
+                return url, filename, path
+        return url, filename, None
 
     def urlread(self, url, limit=None, opts=None, **kwargs):
         """read the url into a string, up to 'limit' bytes
@@ -1275,7 +1764,13 @@ class URLGrabber(object):
             limit = limit + 1
 
         def retryfunc(opts, url, limit):
-            fo = PyCurlFileObject(url, filename=None, opts=opts)
+            self._local.stats = None
+            fo_opts = opts
+            cache = _DownloadCache.get(opts, url)
+            if cache is not None:
+                entry = cache.lookup(url)
+                fo_opts = cache.request_opts(opts, entry)
+            fo = PyCurlFileObject(url, filename=None, opts=fo_opts)
             s = ''
             try:
                 # this is an unfortunate thing.  Some file-like objects
@@ -1284,9 +1779,12 @@ class URLGrabber(object):
                 # now, we just force the default if necessary.
                 if limit is None: s = fo.read()
                 else: s = fo.read(limit)
+                self._local.stats = fo.stats
+                if cache is not None:
+                    s = cache.read(url, entry, fo, s, limit, opts)
 
                 if not opts.checkfunc is None:
-                    obj = CallbackObject(data=s, url=url)
+                    obj = CallbackObject(data=s, url=url, stats=fo.stats)
                     _run_callback(opts.checkfunc, obj)
             finally:
                 fo.close()
@@ -1301,6 +1799,66 @@ class URLGrabber(object):
 
         return s
 
+    def urlread_ranges(self, url, ranges, opts=None, **kwargs):
+        """read several byte ranges of the url
+        'ranges' is a list of (start, end) tuples, like the range
+        option.  http urls get a single multi-range request; if the
+        server doesn't answer with multipart/byteranges, what is
+        missing is fetched with single range requests, ranges less
+        than 64k apart merged into one.
+
+        This is a generator of (offset, data) pairs, in the order
+        the data arrives.  data is a memoryview of the received
+        buffer and a range may come in several pieces.  Overlapping
+        ranges are merged, so every byte is returned once.
+        """
+        url = _to_utf8(url)
+        opts = (opts or self.opts).derive(**kwargs)
+        if DEBUG: DEBUG.debug('combined options: %r' % (opts,))
+        (url,parts) = opts.urlparser.parse(url, opts)
+        opts.find_proxy(url, parts[0])
+        opts = opts.derive(stream=True, size=None, checksums=None, cache_dir=None)
+
+        def retryfunc(opts, url, want):
+            if len(want) == 1:
+                return PyCurlFileObject(url, None, opts.derive(range=want[0]))
+            headers = tuple(opts.http_headers or ())
+            headers += (('Range', range_tuples_to_header(want)),)
+            return PyCurlFileObject(url, None, opts.derive(http_headers=headers))
+
+        todo = range_tuples_coalesce(ranges)
+        multi = urlparse.urlsplit(url)[0] in (b'http', b'https')
+        while todo:
+            if multi and len(todo) > 1:
+                want = todo
+            else:
+                want = range_tuples_coalesce(todo, _RANGE_GAP)[:1]
+            multi = False
+            fo = self._retry(opts, retryfunc, url, want)
+            got = []
+            try:
+                for offset, data in _range_pieces(fo, want):
+                    for piece in _clip_pieces(offset, data, todo):
+                        start, end = piece[0], piece[0] + len(piece[1])
+                        if got and got[-1][1] == start:
+                            start = got.pop()[0]
+                        got.append((start, end))
+                        yield piece
+                    if todo[-1][1] != '' and offset + len(data) >= todo[-1][1]:
+                        break # don't read the rest of a full body
+            finally:
+                fo.close()
+            left = _range_tuples_subtract(todo, got)
+            if left and left[-1][1] == '' and left[-1][0] in [e for b, e in got]:
+                # the end of the file
+                left.pop()
+            if left == todo:
+                err = URLGrabError(9, _('Requested byte range not satisfied: %s')
+                                   % _urlunquote_convert(url))
+                err.url = url
+                raise err
+            todo = left
+
     def _make_callback(self, callback_obj):
         # not used, left for compatibility
         if callable(callback_obj):
@@ -1313,8 +1871,164 @@ class URLGrabber(object):
 default_grabber = URLGrabber()
 
 
+class _StreamBuffer(object):
+    """A bounded FIFO of received chunks, used by streaming urlopen().
+
+    PyCurlFileObject._retrieve() appends to it, read() and readline()
+    drain it and call 'fill' to run the transfer when it runs dry.
+    'fill' returns False once there is nothing more to come.
+    """
+    def __init__(self, fill, maxsize):
+        self._fill = fill
+        self._chunks = collections.deque()
+        self._size = 0
+        self.maxsize = maxsize
+
+    def __len__(self):
+        return self._size
+
+    def full(self):
+        return self._size >= self.maxsize
+
+    def write(self, buf):
+        if buf:
+            self._chunks.append(buf)
+            self._size += len(buf)
+
+    def truncate(self, size=0):
+        self._chunks.clear()
+        self._size = 0
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.truncate()
+
+    def _pop(self, amt):
+        chunk = self._chunks.popleft()
+        if 0 <= amt < len(chunk):
+            self._chunks.appendleft(chunk[amt:])
+            chunk = chunk[:amt]
+        self._size -= len(chunk)
+        return chunk
+
+    def read(self, amt=-1):
+        if amt is None: amt = -1
+        ret = []
+        while amt:
+            if not self._chunks:
+                # don't block if we have something to return
+                if ret and amt > 0 or not self._fill(): break
+                continue
+            chunk = self._pop(amt)
+            ret.append(chunk)
+            if amt > 0: amt -= len(chunk)
+        return b''.join(ret)
+
+    def readline(self, limit=-1):
+        if limit is None: limit = -1
+        ret = []
+        while limit:
+            if not self._chunks:
+                if not self._fill(): break
+                continue
+            i = self._chunks[0].find(b'\n') + 1 or len(self._chunks[0])
+            if limit > 0:
+                i = min(i, limit)
+                limit -= i
+            chunk = self._pop(i)
+            ret.append(chunk)
+            if chunk.endswith(b'\n'): break
+        return b''.join(ret)
+
+    def readlines(self, hint=-1):
+        lines = []
+        while True:
+            line = self.readline()
+            if not line: break
+            lines.append(line)
+        return lines
+
+    def chunks(self):
+        """yield the received chunks as they are, until the end"""
+        while True:
+            if not self._chunks:
+                if not self._fill(): return
+                continue
+            yield self._pop(-1)
+
+_RANGE_GAP = 64 * 1024
+
+def _range_pieces(fo, want):
+    """the (offset, data) pieces of a ranged response to the streaming
+    PyCurlFileObject fo, which asked for the ranges in want"""
+    if len(want) == 1:
+        # a single range is also emulated when the server sends it all
+        offset = want[0][0]
+        for chunk in fo.fo.chunks():
+            yield offset, memoryview(chunk)
+            offset += len(chunk)
+        return
+
+    hdr = fo._hdr_dump
+    parser = offset = None
+    if re.match(br'HTTP/\S+ 206 ', hdr):
+        m = re.search(br'^content-type:\s*multipart/byteranges;.*boundary="?([^"\s;]+)',
+                      hdr, re.I | re.M)
+        if m:
+            parser = MultipartByteranges(m.group(1))
+        else:
+            # the server sent a single range
+            m = re.search(br'^content-range:\s*bytes\s+(\d+)-', hdr, re.I | re.M)
+            offset = m and int(m.group(1))
+    elif re.match(br'HTTP/\S+ 200 ', hdr):
+        offset = 0
+    if parser is None and offset is None:
+        err = URLGrabError(9, _('Invalid range response from %s')
+                           % _urlunquote_convert(fo.url))
+        err.url = fo.url
+        raise err
+
+    for chunk in fo.fo.chunks():
+        if parser is not None:
+            for piece in parser.feed(chunk):
+                yield piece
+        else:
+            yield offset, memoryview(chunk)
+            offset += len(chunk)
+
+def _clip_pieces(offset, data, ranges):
+    """the parts of data, which starts at offset, that fall into the
+    sorted, disjoint (start, end) ranges"""
+    end = offset + len(data)
+    for fb, lb in ranges:
+        if lb != '' and lb <= offset: continue
+        if fb >= end: break
+        start = max(fb, offset)
+        stop = lb == '' and end or min(lb, end)
+        yield start, data[start - offset:stop - offset]
+
+def _range_tuples_subtract(ranges, got):
+    """what is left of the sorted, disjoint ranges after removing
+    the (start, end) tuples in got"""
+    left = []
+    got = range_tuples_coalesce(got)
+    for fb, lb in ranges:
+        for gfb, glb in got:
+            if glb != '' and glb <= fb or lb != '' and gfb >= lb:
+                continue
+            if gfb > fb:
+                left.append((fb, gfb))
+            fb = glb
+            if fb == '' or lb != '' and fb >= lb: break
+        else:
+            left.append((fb, lb))
+    return left
+
 class PyCurlFileObject(object):
-    def __init__(self, url, filename, opts):
+    def __init__(self, url, filename, opts, multi=None, curl_obj=None,
+                 output=None):
         self.fo = None
         self._hdr_dump = b''
         self._parsed_hdr = None
@@ -1324,8 +2038,6 @@ class PyCurlFileObject(object):
         self.append = False
         self.reget_time = None
         self.opts = opts
-        if self.opts.reget == 'check_timestamp':
-            raise NotImplementedError("check_timestamp regets are not implemented in this ver of urlgrabber. Please report this.")
         self._complete = False
         self._rbuf = b''
         self._rbufsize = 1024*8
@@ -1340,6 +2052,17 @@ class PyCurlFileObject(object):
         self._hdr_ended = False
         self._tm_first = None
         self._tm_last = None
+        self._checksums = []
+        self._timing = None
+        self.stats = None
+        self._http_code = None # saved before the handle is released
+        self._stream = self.opts.stream and filename is None
+        self._multi = multi
+        self._own_multi = False
+        self._paused = False
+        self.curl_obj = curl_obj
+        self._pool_key = None
+        self._output = output
         self._do_open()
 
 
@@ -1354,6 +2077,13 @@ class PyCurlFileObject(object):
 
     def _retrieve(self, buf):
         try:
+            if self._stream and self.fo.full() and self.scheme != b'file':
+                # the reader fell behind.  libcurl keeps this chunk
+                # and passes it in again when the transfer is resumed.
+                # (file:// transfers can't be paused)
+                self._paused = True
+                return pycurl.WRITEFUNC_PAUSE
+
             tm = self._amount_read + len(buf), time.time()
             if self._tm_first is None:
                 self._tm_first = tm
@@ -1372,6 +2102,10 @@ class PyCurlFileObject(object):
                     self.opts.progress_obj.update(self._amount_read)
 
             self._amount_read += len(buf)
+            expected = self._expected_size()
+            if expected is not None and self._amount_read > expected:
+                self._cb_error = _size_mismatch(self.url, self._amount_read, self.opts.size)
+                return -1
             try:
                 if self._range:
                     # client-side ranges
@@ -1379,9 +2113,9 @@ class PyCurlFileObject(object):
                     start = self._range[0] - pos
                     stop = self._range[1] - pos
                     if start < len(buf) and stop > 0:
-                        self.fo.write(buf[max(start, 0):stop])
+                        self._write(buf[max(start, 0):stop])
                 else:
-                    self.fo.write(buf)
+                    self._write(buf)
             except IOError as e:
                 self._cb_error = URLGrabError(16, exception2msg(e))
                 return -1
@@ -1406,6 +2140,14 @@ class PyCurlFileObject(object):
                 if buf.lower().find(b'content-length:') != -1:
                     length = buf.split(b':')[1]
                     self.size = int(length)
+                    expected = self._expected_size()
+                    if (expected is not None
+                        and re.match(br'HTTP/\S+ 20[06] ', self._hdr_dump)
+                        and self.size + self._reget_length != expected):
+                        # don't download the wrong file
+                        self._cb_error = _size_mismatch(self.url, self.size + self._reget_length,
+                                                      self.opts.size)
+                        return -1
                 elif (self.append or self.opts.range) and not self._hdr_dump and b' 200 ' in buf:
                     # reget was attempted but server sends it all
                     # undo what we did in _build_range()
@@ -1415,6 +2157,7 @@ class PyCurlFileObject(object):
                     self._reget_length = 0
                     self._range = self.opts.range
                     self.fo.truncate(0)
+                    self._start_checksums()
             elif self.scheme in [b'ftp']:
                 s = None
                 if buf.startswith(b'213 '):
@@ -1453,8 +2196,12 @@ class PyCurlFileObject(object):
         return self._parsed_hdr
 
     hdr = property(_return_hdr_obj)
-    http_code = property(fget=
-                 lambda self: self.curl_obj.getinfo(pycurl.RESPONSE_CODE))
+    def _get_http_code(self):
+        if self._http_code is not None:
+            return self._http_code
+        return self.curl_obj.getinfo(pycurl.RESPONSE_CODE)
+
+    http_code = property(fget=_get_http_code)
 
     def _set_opts(self, opts={}):
         # XXX
@@ -1488,6 +2235,9 @@ class PyCurlFileObject(object):
                 self.curl_obj.setopt(pycurl.IPRESOLVE, pycurl.IPRESOLVE_V4)
             if ipr == 'ipv6':
                 self.curl_obj.setopt(pycurl.IPRESOLVE, pycurl.IPRESOLVE_V6)
+        self.curl_obj.setopt(pycurl.DNS_CACHE_TIMEOUT, opts.dns_cache_timeout)
+        if opts.resolve:
+            self.curl_obj.setopt(pycurl.RESOLVE, list(opts.resolve))
 
         # maybe to be options later
         self.curl_obj.setopt(pycurl.FOLLOWLOCATION, True)
@@ -1522,6 +2272,13 @@ class PyCurlFileObject(object):
             if opts.ssl_key_pass:
                 self.curl_obj.setopt(pycurl.SSLKEYPASSWD, opts.ssl_key_pass)
 
+        # ranges:
+        range_str = None
+        if opts.range or opts.reget:
+            range_str = self._build_range()
+            if range_str:
+                self.curl_obj.setopt(pycurl.RANGE, range_str)
+
         #headers:
         if self.scheme in (b'http', b'https'):
             headers = []
@@ -1530,15 +2287,16 @@ class PyCurlFileObject(object):
                     headers.append('%s:%s' % (tag, content))
             if opts.no_cache:
                 headers.append('Pragma:no-cache')
+            if (range_str and self.reget_time is not None
+                and opts.reget == 'check_timestamp'):
+                # the server sends the rest only if the file has not
+                # changed since, else all of it (the 200 is handled
+                # in _hdr_retrieve)
+                headers.append('If-Range:%s' % email.utils.formatdate(
+                    self.reget_time, usegmt=True))
             if headers:
                 self.curl_obj.setopt(pycurl.HTTPHEADER, headers)
 
-        # ranges:
-        if opts.range or opts.reget:
-            range_str = self._build_range()
-            if range_str:
-                self.curl_obj.setopt(pycurl.RANGE, range_str)
-
         # throttle/bandwidth
         if hasattr(opts, 'raw_throttle') and opts.raw_throttle():
             self.curl_obj.setopt(pycurl.MAX_RECV_SPEED_LARGE, int(opts.raw_throttle()))
@@ -1579,6 +2337,28 @@ class PyCurlFileObject(object):
         try:
             self.curl_obj.perform()
         except pycurl.error as e:
+            self._transfer_done(e)
+        else:
+            self._transfer_done(None)
+
+    def _transfer_done(self, e):
+        """Raise the appropriate URLGrabError for a finished transfer.
+        e is the pycurl.error the transfer failed with, or None.  Its
+        TransferStats are kept in self.stats and on the error."""
+        self._http_code = self.curl_obj.getinfo(pycurl.RESPONSE_CODE)
+        self.stats = TransferStats._from_curl(self.curl_obj)
+        try:
+            self._check_transfer(e)
+        except URLGrabError as err:
+            err.stats = self.stats
+            _count_transfer(self.url, self.stats, err)
+            raise
+        _count_transfer(self.url, self.stats, None)
+
+    def _check_transfer(self, e):
+        if e is None:
+            self._timing = _curl_timing(self.stats)
+        if e is not None:
             # XXX - break some of these out a bit more clearly
             # to other URLGrabErrors from
             # http://curl.haxx.se/libcurl/c/libcurl-errors.html
@@ -1591,7 +2371,7 @@ class PyCurlFileObject(object):
             if self._error[0]:
                 errcode = self._error[0]
 
-            if errcode == 23 and 200 <= code <= 299:
+            if errcode == 23 and (200 <= code <= 299 or hasattr(self, '_cb_error')):
                 # this is probably wrong but ultimately this is what happens
                 # we have a legit http code and a pycurl 'writer failed' code
                 # which almost always means something aborted it from outside
@@ -1672,6 +2452,8 @@ class PyCurlFileObject(object):
                 err = URLGrabError(14, msg)
                 err.url = errurl
                 err.code = code
+                if code in (429, 503):
+                    err.retry_after = _retry_after(self._hdr_dump)
                 raise err
 
         else:
@@ -1680,21 +2462,145 @@ class PyCurlFileObject(object):
                 err = URLGrabError(14, msg)
                 err.url = _urlunquote_convert(self.url)
                 raise err
+            if self.scheme in (b'http', b'https') and self.http_code == 304:
+                return # the caller has the body
+            expected = self._expected_size()
+            if expected is not None and self._amount_read != expected:
+                raise _size_mismatch(self.url, self._amount_read, self.opts.size)
+            for name, h, hexdigest in self._checksums:
+                if hexdigest is not None and h.hexdigest() != hexdigest.lower():
+                    if isinstance(self.filename, string_types) and self.filename:
+                        self.fo.truncate(0) # don't reget it
+                    err = URLGrabError(17, _('%s checksum mismatch for %s: %s != %s')
+                                       % (name, _urlunquote_convert(self.url),
+                                          h.hexdigest(), hexdigest))
+                    err.url = _urlunquote_convert(self.url)
+                    raise err
 
     def _do_open(self):
-        if hasattr(self.opts, 'curl_obj') and self.opts.curl_obj is not None:
+        if self.curl_obj is not None:
+            pass # supplied by the owner of the multi handle
+        elif hasattr(self.opts, 'curl_obj') and self.opts.curl_obj is not None:
             self.curl_obj = self.opts.curl_obj
         else:
-            self.curl_obj = _curl_cache
+            self._pool_key = self._get_pool_key()
+            self.curl_obj = _curl_pool.acquire(self._pool_key)
         self.curl_obj.reset() # reset all old settings away, just in case
         # setup any ranges
-        self._set_opts()
-        self._do_grab()
+        try:
+            self._set_opts()
+        except Exception:
+            self._release_curl()
+            raise
+        if self._multi is not None:
+            # the owner of the multi handle runs the transfer
+            # and calls _multi_done() when it's finished
+            self._open_output()
+            self._multi.add_handle(self.curl_obj)
+        elif self._stream:
+            self._do_stream()
+        else:
+            self._do_grab()
         return self.fo
 
+    def _do_stream(self):
+        """start the transfer on a private multi handle and return as
+        soon as some data (or an error) has arrived.  The rest of the
+        body is fetched on demand by read() and readline()."""
+        self._open_output()
+        self._multi = pycurl.CurlMulti()
+        self._own_multi = True
+        self._multi.add_handle(self.curl_obj)
+        # connection and HTTP errors are raised here, so that
+        # urlopen() can retry them
+        self._stream_perform()
+
+    def _stream_perform(self):
+        """run the transfer until more data is buffered or it ends.
+        Returns False if the transfer has already ended."""
+        if self._complete or not self._own_multi:
+            # or it's run by the owner of the multi handle
+            return False
+        self._unpause()
+
+        size = len(self.fo)
+        while True:
+            while True:
+                ret, num_handles = self._multi.perform()
+                if ret != pycurl.E_CALL_MULTI_PERFORM: break
+            queued, ok, failed = self._multi.info_read()
+            if failed:
+                curl_obj, errcode, errmsg = failed[0]
+                self._multi_done(errcode, errmsg)
+                return True
+            if ok:
+                self._multi_done()
+                return True
+            if len(self.fo) > size or self._paused:
+                return True
+            self._multi.select(1.0)
+
+    def _unpause(self):
+        """resume a paused streaming transfer once the buffer has room"""
+        if self._paused and not self.fo.full():
+            self._paused = False
+            self.curl_obj.pause(pycurl.PAUSE_CONT)
+
+    def _multi_done(self, errcode=0, errmsg=''):
+        """finish a transfer driven by a multi handle"""
+        self._multi.remove_handle(self.curl_obj)
+        if self._own_multi:
+            self._multi.close()
+            self._own_multi = False
+        self._multi = None
+        if self._stream:
+            self._complete = True
+        try:
+            try:
+                if errcode:
+                    self._transfer_done(pycurl.error(errcode, errmsg))
+                else:
+                    self._transfer_done(None)
+            except URLGrabError:
+                if not self._stream:
+                    self._abort_output()
+                raise
+            if not self._stream:
+                self._close_output()
+        finally:
+            self._release_curl()
+
+    def _get_pool_key(self):
+        """connections of handles with the same key are interchangeable"""
+        opts = self.opts
+        return (self.scheme, urlparse.urlsplit(self.url)[1], opts.proxy,
+                opts.ssl_ca_cert, opts.ssl_cert, opts.ssl_key,
+                opts.ssl_verify_peer, opts.ssl_verify_host)
+
+    def _release_curl(self):
+        """return the pooled handle once the transfer is over"""
+        if self._pool_key is not None:
+            _curl_pool.release(self._pool_key, self.curl_obj, self.opts)
+            self._pool_key = None
+
     def _add_headers(self):
         pass
 
+    def _reget_stale(self, mtime):
+        """True if reget='check_timestamp' must not resume a partial
+        file with this mtime.  http servers decide that themselves,
+        with If-Range; file:// urls are compared here and other
+        schemes, without timestamps, are always fetched whole."""
+        if (self.opts.reget != 'check_timestamp'
+            or self.scheme in (b'http', b'https')):
+            return False
+        if self.scheme == b'file':
+            try:
+                return int(os.stat(_local_path(self.url)).st_mtime) > mtime
+            except OSError:
+                return False # let curl report it
+        return True
+
     def _build_range(self):
         reget_length = 0
         rt = None
@@ -1703,8 +2609,8 @@ class PyCurlFileObject(object):
             try:
                 s = os.stat(self.filename)
             except OSError:
-                pass
-            else:
+                s = None
+            if s is not None and not self._reget_stale(s[stat.ST_MTIME]):
                 self.reget_time = s[stat.ST_MTIME]
                 reget_length = s[stat.ST_SIZE]
 
@@ -1792,9 +2698,28 @@ class PyCurlFileObject(object):
 
         if self._complete:
             return
-        _was_filename = False
-        if isinstance(self.filename, string_types) and self.filename:
-            _was_filename = True
+        try:
+            self._open_output()
+            try:
+                self._do_perform()
+            except URLGrabError as e:
+                self._abort_output()
+                raise e
+            self._close_output()
+        finally:
+            self._release_curl()
+
+    def _open_output(self):
+        if self._output is not None:
+            # supplied by the caller, eg. a _SegmentWriter
+            self._prog_reportname = 'MEMORY'
+            self._prog_basename = 'MEMORY'
+            self.fo = self._output
+        elif self._stream:
+            self._prog_reportname = 'MEMORY'
+            self._prog_basename = 'MEMORY'
+            self.fo = _StreamBuffer(self._stream_perform, self.opts.stream_bufsize)
+        elif isinstance(self.filename, string_types) and self.filename:
             self._prog_reportname = str(self.filename)
             self._prog_basename = os.path.basename(self.filename)
 
@@ -1822,14 +2747,51 @@ class PyCurlFileObject(object):
             #fh, self._temp_name = mkstemp()
             #self.fo = open(self._temp_name, 'wb')
 
-        try:
-            self._do_perform()
-        except URLGrabError as e:
-            self.fo.flush()
-            self.fo.close()
-            raise e
+        self._start_checksums()
+
+    def _expected_size(self):
+        """the size the file must have, or None"""
+        if self.opts.exact_size and self.opts.size and not self.opts.range:
+            return int(self.opts.size)
+
+    def _start_checksums(self):
+        """(re)start the digests of the checksums option.  When
+        regetting, the existing part of the file is hashed first."""
+        self._checksums = [(name, hashlib.new(name), hexdigest)
+                           for name, hexdigest in self.opts.checksums or ()]
+        if self._checksums and self.append:
+            try:
+                _hash_file(self.filename, [h for name, h, hexdigest in self._checksums])
+            except IOError as e:
+                err = URLGrabError(16, _('error reading local file %s, IOError: %s')
+                                   % (self.filename, e))
+                err.url = self.url
+                raise err
+
+    def _write(self, buf):
+        self.fo.write(buf)
+        for name, h, hexdigest in self._checksums:
+            h.update(buf)
+
+    def _abort_output(self):
+        """close the output of a failed transfer.  With
+        reget='check_timestamp' the partial file gets the server's
+        timestamp, so that the If-Range of the next try matches."""
+        self.fo.flush()
+        self.fo.close()
+        if (self.opts.reget == 'check_timestamp' and self._output is None
+            and isinstance(self.filename, string_types) and self.filename):
+            mod_time = self.curl_obj.getinfo(pycurl.INFO_FILETIME)
+            if mod_time != -1:
+                try:
+                    os.utime(self.filename, (mod_time, mod_time))
+                except OSError:
+                    pass
 
-        if _was_filename:
+    def _close_output(self):
+        if self._output is not None:
+            pass # the caller owns it
+        elif isinstance(self.filename, string_types) and self.filename:
             # close it up
             self.fo.flush()
             self.fo.close()
@@ -1884,7 +2846,8 @@ class PyCurlFileObject(object):
         # if we've made it here, then we don't have enough in the buffer
         # and we need to read more.
 
-        if not self._complete: self._do_grab() #XXX cheater - change on ranges
+        if not self._complete and not self._stream:
+            self._do_grab() #XXX cheater - change on ranges
 
         buf = [self._rbuf]
         bufsize = len(self._rbuf)
@@ -1901,6 +2864,9 @@ class PyCurlFileObject(object):
             else:           readamount = min(amt, self._rbufsize)
             try:
                 new = self.fo.read(readamount)
+            except URLGrabError:
+                # a streaming transfer failed
+                raise
             except socket.error as e:
                 err = URLGrabError(4, _('Socket Error on %s: %s') % (self.url, e))
                 err.url = self.url
@@ -1923,7 +2889,8 @@ class PyCurlFileObject(object):
             buf.append(new)
             bufsize = bufsize + newsize
             self._tsize = newsize
-            self._amount_read = self._amount_read + newsize
+            if not self._stream: # _retrieve() counts what's streamed
+                self._amount_read = self._amount_read + newsize
             #if self.opts.progress_obj:
             #    self.opts.progress_obj.update(self._amount_read)
 
@@ -1968,15 +2935,18 @@ class PyCurlFileObject(object):
         return s
 
     def readline(self, limit=-1):
-        if not self._complete: self._do_grab()
-        return self.fo.readline()
+        if not self._stream:
+            if not self._complete: self._do_grab()
+            return self.fo.readline()
+        if not self._rbuf:
+            return self.fo.readline(limit)
 
-        i = self._rbuf.find('\n')
+        i = self._rbuf.find(b'\n')
         while i < 0 and not (0 < limit <= len(self._rbuf)):
             L = len(self._rbuf)
             self._fill_buffer(L + self._rbufsize)
             if not len(self._rbuf) > L: break
-            i = self._rbuf.find('\n', L)
+            i = self._rbuf.find(b'\n', L)
 
         if i < 0: i = len(self._rbuf)
         else: i = i+1
@@ -1988,6 +2958,14 @@ class PyCurlFileObject(object):
     def close(self):
         if self._prog_running:
             self.opts.progress_obj.end(self._amount_read)
+        if self._multi is not None:
+            # abort an unfinished transfer
+            self._multi.remove_handle(self.curl_obj)
+            if self._own_multi:
+                self._multi.close()
+                self._own_multi = False
+            self._multi = None
+            self._release_curl()
         self.fo.close()
 
     def geturl(self):
@@ -1998,29 +2976,941 @@ class PyCurlFileObject(object):
 if hasattr(pycurl, 'GLOBAL_ACK_EINTR'):
     # fail immediately on ctrl-c
     pycurl.global_init(pycurl.GLOBAL_DEFAULT | pycurl.GLOBAL_ACK_EINTR)
-_curl_cache = pycurl.Curl() # make one and reuse it over and over and over
+
+class _CurlPool:
+    """Thread-safe pool of idle Curl handles.
+
+    Handles are keyed by the connection they were last used for, and
+    acquire() prefers a handle with a matching key, so keepalive
+    connections stay warm.  All handles share the DNS cache and TLS
+    sessions via a CurlShare object.  libcurl does not support sharing
+    the connection cache between threads, so connections stay with
+    the handle that opened them.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.idle = collections.OrderedDict() # curl_obj => key, release time
+        self.busy = {} # curl_obj => share
+        self.share = None # created on first use
+
+    @staticmethod
+    def _new_share():
+        share = pycurl.CurlShare()
+        share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        if hasattr(pycurl, 'LOCK_DATA_SSL_SESSION'):
+            share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+        return share
+
+    def acquire(self, key):
+        with self.lock:
+            match = other = None
+            for curl_obj, (idle_key, tm) in self.idle.items():
+                if idle_key == key:
+                    match = curl_obj # the most recently used one
+                elif other is None:
+                    other = curl_obj # the least recently used one
+            if match is None:
+                match = other
+            if match is not None:
+                del self.idle[match]
+            else:
+                match = self.new()
+            self.busy[match] = self.share
+            return match
+
+    def new(self):
+        """create a handle using the shared data"""
+        with self.lock:
+            if self.share is None:
+                self.share = self._new_share()
+            curl_obj = pycurl.Curl()
+            # curl_obj.reset() keeps the share
+            curl_obj.setopt(pycurl.SHARE, self.share)
+            return curl_obj
+
+    def release(self, key, curl_obj, opts):
+        now = time.time()
+        close = []
+        with self.lock:
+            if self.busy.pop(curl_obj) is self.share:
+                self.idle[curl_obj] = key, now
+            else:
+                close.append(curl_obj) # acquired before clear()
+            # evict expired and least recently used handles
+            for idle_obj, (idle_key, tm) in list(self.idle.items()):
+                if (len(self.idle) > opts.curl_pool_size
+                    or tm + opts.curl_pool_idle < now):
+                    del self.idle[idle_obj]
+                    close.append(idle_obj)
+        for idle_obj in close:
+            if DEBUG: DEBUG.debug('closing idle curl handle')
+            idle_obj.close()
+
+    def clear(self):
+        with self.lock:
+            close = list(self.idle)
+            self.idle.clear()
+            self.share = None
+        for curl_obj in close:
+            curl_obj.close()
+
+_curl_pool = _CurlPool()
 
 def reset_curl_obj():
     """To make sure curl has reread the network/dns info we force a reload"""
-    global _curl_cache
-    _curl_cache.close()
-    _curl_cache = pycurl.Curl()
+    _curl_pool.clear()
 
 _libproxy_cache = None
 
 
 #####################################################################
-# DEPRECATED FUNCTIONS
-def set_throttle(new_throttle):
-    """Deprecated. Use: default_grabber.throttle = new_throttle"""
-    default_grabber.throttle = new_throttle
+#  Local copies
+#####################################################################
 
-def set_bandwidth(new_bandwidth):
-    """Deprecated. Use: default_grabber.bandwidth = new_bandwidth"""
-    default_grabber.bandwidth = new_bandwidth
+_FICLONE = 0x40049409 # linux/fs.h
+_COPY_CHUNK = 8 * 1024 * 1024
+
+def _local_path(url):
+    """the name of the local file of a file:// url"""
+    scheme, host, path = urlparse.urlsplit(url)[:3]
+    path = url2pathname(path)
+    if host:
+        if not isinstance(host, text_type):
+            host = host.decode('utf8')
+        path = os.path.normpath('//' + host + path)
+    return path
+
+def _size_mismatch(url, size, expected):
+    """the URLGrabError for a file that doesn't have the exact_size"""
+    err = URLGrabError(18, _('Size mismatch for %s: %s != %s')
+                       % (_urlunquote_convert(url), size, expected))
+    err.url = _urlunquote_convert(url)
+    return err
+
+def _hash_file(filename, hashes):
+    """update hashes with the contents of filename"""
+    with open(filename, 'rb') as fo:
+        while True:
+            buf = fo.read(_COPY_CHUNK)
+            if not buf:
+                break
+            for h in hashes:
+                h.update(buf)
+
+def _verify_file(filename, url, checksums):
+    """Check the checksums option for a file that was not written by
+    PyCurlFileObject."""
+    if not checksums:
+        return
+    hashes = [hashlib.new(name) for name, hexdigest in checksums]
+    _hash_file(filename, hashes)
+    for (name, hexdigest), h in zip(checksums, hashes):
+        if h.hexdigest() != hexdigest.lower():
+            open(filename, 'wb').close()
+            err = URLGrabError(17, _('%s checksum mismatch for %s: %s != %s')
+                               % (name, _urlunquote_convert(url),
+                                  h.hexdigest(), hexdigest))
+            err.url = url
+            raise err
 
-def set_progress_obj(new_progress_obj):
-    """Deprecated. Use: default_grabber.progress_obj = new_progress_obj"""
+def _copy_fds(src, dst, pos, end, update):
+    """Copy bytes pos..end of src to the file position of dst, calls
+    update(n) after each chunk.  Uses the fastest way that works."""
+    use_copy_file_range = hasattr(os, 'copy_file_range')
+    use_sendfile = hasattr(os, 'sendfile')
+    while pos < end:
+        count = min(end - pos, _COPY_CHUNK)
+        n = None
+        if use_copy_file_range:
+            try:
+                n = os.copy_file_range(src, dst, count, pos)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                   errno.EOPNOTSUPP, errno.EPERM):
+                    raise
+                use_copy_file_range = False
+        if n is None and use_sendfile:
+            try:
+                n = os.sendfile(dst, src, pos, count)
+            except OSError as e:
+                if e.errno not in (errno.ENOSYS, errno.EINVAL):
+                    raise
+                use_sendfile = False
+        if n is None:
+            os.lseek(src, pos, os.SEEK_SET)
+            buf = os.read(src, count)
+            n = len(buf)
+            while buf:
+                buf = buf[os.write(dst, buf):]
+        if not n:
+            break # the file got shorter
+        pos += n
+        update(n)
+
+def _copy_local(url, filename, opts):
+    """Copy the file of a file:// url to filename without libcurl.
+    Honours the range, reget, size, checksums and progress_obj options.
+    Returns the number of bytes copied."""
+    path = _local_path(url)
+    try:
+        src = os.open(path, os.O_RDONLY)
+    except OSError as e:
+        err = URLGrabError(14, 'curl#37 - "%s"' % (_("Could not open file %s") % path))
+        err.url = url
+        err.code = 37
+        raise err
+
+    try:
+        st = os.fstat(src)
+        start, end = range_tuple_normalize(opts.range) or (0, '')
+        if end == '' or end > st.st_size:
+            end = st.st_size
+
+        reget_length = 0
+        flags = os.O_WRONLY | os.O_CREAT
+        if opts.reget:
+            try:
+                local = os.stat(filename)
+            except OSError:
+                pass
+            else:
+                if (opts.reget != 'check_timestamp'
+                    or int(local.st_mtime) >= int(st.st_mtime)):
+                    reget_length = local.st_size
+        if reget_length:
+            start += reget_length
+        else:
+            flags |= os.O_TRUNC
+        end = max(start, end)
+
+        size = opts.size and int(opts.size)
+        if size and opts.exact_size and not opts.range and st.st_size != size:
+            raise _size_mismatch(url, st.st_size, size)
+        if size and end - start > int(float(size) * 1.10):
+            err = URLGrabError(14, _("Downloaded more than max size for %s: %s > %s")
+                               % (_urlunquote_convert(url), end - start, size))
+            err.url = url
+            err.code = pycurl.E_FILESIZE_EXCEEDED
+            raise err
+
+        try:
+            dst = os.open(filename, flags, 0o666)
+        except OSError as e:
+            err = URLGrabError(16, _('error opening local file from %s, IOError: %s')
+                               % (url, e))
+            err.url = url
+            raise err
+
+        progress_obj = opts.progress_obj
+        if progress_obj:
+            progress_obj.start(str(filename), _urlunquote_convert(url),
+                               os.path.basename(filename),
+                               size=reget_length + end - start, text=opts.text)
+            progress_obj.update(reget_length)
+        amount = [reget_length]
+        def update(n):
+            amount[0] += n
+            if progress_obj:
+                progress_obj.update(amount[0])
+
+        try:
+            try:
+                if start == 0 and end == st.st_size:
+                    try:
+                        # share the blocks on CoW filesystems
+                        fcntl.ioctl(dst, _FICLONE, src)
+                    except (IOError, OSError):
+                        pass
+                    else:
+                        if DEBUG: DEBUG.info('cloned %s', path)
+                        start = end
+                        update(end)
+                os.lseek(dst, reget_length, os.SEEK_SET)
+                _copy_fds(src, dst, start, end, update)
+            except OSError as e:
+                err = URLGrabError(16, _('error copying %s to %s: %s')
+                                   % (path, filename, e))
+                err.url = url
+                raise err
+        finally:
+            os.close(dst)
+            if progress_obj:
+                progress_obj.end(amount[0])
+    finally:
+        os.close(src)
+
+    # Set the URL where we got it from, and the time
+    if xattr is not None:
+        try:
+            xattr.set(filename, 'user.xdg.origin.url', url)
+        except:
+            pass
+    try:
+        os.utime(filename, (st.st_mtime, st.st_mtime))
+    except OSError as e:
+        err = URLGrabError(16, _('error setting timestamp on file %s from %s, OSError: %s')
+                           % (filename, url, e))
+        err.url = url
+        raise err
+    _verify_file(filename, url, opts.checksums)
+    return amount[0] - reget_length
+
+
+#####################################################################
+#  Download cache
+#####################################################################
+
+def _tmpname(path):
+    """Create an empty temporary file next to path, returns its name.
+    Each call gets a new file, like tempfile.mkstemp(), but with the
+    permissions of a plain open() since the file is renamed to path."""
+    while True:
+        tmp = '%s.%s.tmp' % (path, hashlib.sha1(os.urandom(16)).hexdigest()[:8])
+        try:
+            os.close(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))
+            return tmp
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+def _grab_tmpname(url, filename):
+    """_tmpname() of the local file of a grab of url"""
+    try:
+        return _tmpname(filename)
+    except OSError as e:
+        err = URLGrabError(16, _('error opening local file from %s, IOError: %s')
+                           % (url, e))
+        err.url = url
+        raise err
+
+def _link_file(src, dst):
+    """Replace dst with a copy of src: a reflink if the filesystem can
+    do it, else a real copy.  Never a hardlink, a write to one of the
+    files must not change the other."""
+    tmp = _tmpname(dst)
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(tmp, os.O_WRONLY | os.O_TRUNC)
+        try:
+            try:
+                fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+            except (IOError, OSError):
+                # no reflinks here, or another filesystem
+                _copy_fds(src_fd, dst_fd, 0, os.fstat(src_fd).st_size, lambda n: None)
+        finally:
+            os.close(dst_fd)
+        os.rename(tmp, dst)
+    except OSError:
+        try: os.unlink(tmp)
+        except OSError: pass
+        raise
+    finally:
+        os.close(src_fd)
+
+class _DownloadCache:
+    """The cache_dir option.
+
+    objects/<sha256> are the cached bodies, index/<sha256 of url> has
+    the (etag, last_modified, sha256, size) of a url, as written by
+    _dumps().
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        for d in 'objects', 'index':
+            try:
+                os.makedirs(os.path.join(cache_dir, d))
+            except OSError as e:
+                if e.errno != errno.EEXIST: raise
+
+    @staticmethod
+    def get(opts, url):
+        """the cache to use for url, or None"""
+        if (not opts.cache_dir or opts.range or opts.reget
+            or urlparse.urlsplit(url)[0] not in (b'http', b'https')):
+            return None
+        return _DownloadCache(opts.cache_dir)
+
+    def _index(self, url):
+        return os.path.join(self.cache_dir, 'index', hashlib.sha256(url).hexdigest())
+
+    def _object(self, digest):
+        return os.path.join(self.cache_dir, 'objects', digest)
+
+    def lookup(self, url):
+        """the index entry of url, if its body is cached.  Only the
+        size is checked here, the digest when the body is used."""
+        try:
+            with open(self._index(url)) as f:
+                entry = _loads(f.read())
+            if os.path.getsize(self._object(entry[2])) == entry[3]:
+                return entry
+        except (IOError, OSError, ValueError):
+            return None
+        self._drop(url, entry)
+        return None
+
+    def _drop(self, url, entry):
+        if DEBUG: DEBUG.info('dropping the corrupt cached body of %s', url)
+        for path in self._object(entry[2]), self._index(url):
+            try: os.unlink(path)
+            except OSError: pass
+
+    def _intact(self, url, entry):
+        """whether the cached body matches its digest, drops it if not"""
+        h = hashlib.sha256()
+        try:
+            _hash_file(self._object(entry[2]), [h])
+        except (IOError, OSError):
+            pass
+        if h.hexdigest() == entry[2]:
+            return True
+        self._drop(url, entry)
+        return False
+
+    def request_opts(self, opts, entry):
+        """opts with the conditional headers for entry, and with the
+        sha256 of the body computed during the transfer"""
+        headers = list(opts.http_headers or ())
+        if entry:
+            etag, last_modified, digest, size = entry
+            if etag:
+                headers.append(('If-None-Match', etag))
+            if last_modified:
+                headers.append(('If-Modified-Since', last_modified))
+        checksums = list(opts.checksums or ())
+        checksums.append(('sha256', None))
+        return opts.derive(http_headers=tuple(headers), checksums=checksums)
+
+    def _verify(self, url, entry, opts):
+        """check a cached body against the size and checksums options"""
+        etag, last_modified, digest, size = entry
+        if opts.exact_size and opts.size and size != int(opts.size):
+            raise _size_mismatch(url, size, opts.size)
+        if opts.checksums:
+            path = self._object(digest)
+            hashes = [hashlib.new(name) for name, hexdigest in opts.checksums]
+            _hash_file(path, hashes)
+            for (name, hexdigest), h in zip(opts.checksums, hashes):
+                if h.hexdigest() != hexdigest.lower():
+                    err = URLGrabError(17, _('%s checksum mismatch for %s: %s != %s')
+                                       % (name, _urlunquote_convert(url),
+                                          h.hexdigest(), hexdigest))
+                    err.url = url
+                    raise err
+
+    def _store(self, url, fo, filename=None, data=None):
+        """cache the body of a 200 response"""
+        hdr = fo._hdr_dump
+        validators = []
+        for name in b'etag', b'last-modified':
+            m = re.search(br'^' + name + br':[ \t]*(.*?)\s*$', hdr, re.I | re.M)
+            validators.append(m and m.group(1).decode('latin-1'))
+        if fo.http_code != 200 or validators == [None, None]:
+            return
+        digest = fo._checksums[-1][1].hexdigest()
+        path = self._object(digest)
+        try:
+            if not os.path.exists(path):
+                if filename is not None:
+                    _link_file(filename, path)
+                else:
+                    tmp = _tmpname(path)
+                    try:
+                        with open(tmp, 'wb') as f:
+                            f.write(data)
+                        os.rename(tmp, path)
+                    except (IOError, OSError):
+                        os.unlink(tmp)
+                        raise
+            if data is None:
+                size = os.path.getsize(filename)
+            else:
+                size = len(data)
+            tmp = _tmpname(self._index(url))
+            try:
+                with open(tmp, 'w') as f:
+                    f.write(_dumps(tuple(validators) + (digest, size)))
+                os.rename(tmp, self._index(url))
+            except (IOError, OSError):
+                os.unlink(tmp)
+                raise
+        except (IOError, OSError) as e:
+            if DEBUG: DEBUG.info('not caching %s: %s', url, e)
+
+    def grabbed(self, url, entry, fo, filename, opts):
+        """after urlgrab() to _tmpname(filename), put the cached body
+        in place on 304, or the new one, and cache it"""
+        if fo.http_code == 304 and entry is not None and not self._intact(url, entry):
+            # fetch it again, unconditionally
+            fo = PyCurlFileObject(url, fo.filename, self.request_opts(opts, None))
+            try:
+                fo._do_grab()
+            finally:
+                fo.close()
+            entry = None
+        try:
+            if fo.http_code != 304 or entry is None:
+                os.rename(fo.filename, filename)
+                self._store(url, fo, filename=filename)
+                return
+            os.unlink(fo.filename)
+            self._verify(url, entry, opts)
+            if DEBUG: DEBUG.info('not modified, using the cached %s', url)
+            _link_file(self._object(entry[2]), filename)
+        except OSError as e:
+            err = URLGrabError(16, _('error writing local file %s: %s')
+                               % (filename, e))
+            err.url = url
+            raise err
+
+    def read(self, url, entry, fo, data, limit, opts):
+        """after urlread(), returns the cached body on 304, or caches
+        the new one"""
+        if fo.http_code == 304 and entry is not None and not self._intact(url, entry):
+            # fetch it again, unconditionally
+            fo = PyCurlFileObject(url, None, self.request_opts(opts, None))
+            try:
+                if limit is None: data = fo.read()
+                else: data = fo.read(limit)
+            finally:
+                fo.close()
+            entry = None
+        if fo.http_code != 304 or entry is None:
+            if limit is None or len(data) < limit:
+                self._store(url, fo, data=data)
+            return data
+        self._verify(url, entry, opts)
+        if DEBUG: DEBUG.info('not modified, using the cached %s', url)
+        with open(self._object(entry[2]), 'rb') as f:
+            return f.read()
+
+
+#####################################################################
+#  Seekable files
+#####################################################################
+
+_content_range_re = re.compile(br'^content-range:\s*bytes\s+(\d+)-(\d+)/(\d+)', re.I | re.M)
+
+class _SeekableFile(io.RawIOBase):
+    """The file object of a seekable urlopen().
+
+    Blocks of the remote file are fetched on demand with range
+    requests, through the grabber's retries, and kept in an LRU
+    cache.  When the server doesn't do ranges, or the url is not
+    http, the file is read from a local (temporary) file instead.
+    """
+    max_ahead = 16
+
+    def __init__(self, grabber, url, opts):
+        io.RawIOBase.__init__(self)
+        self.url = url
+        self.opts = opts.derive(seekable=False, size=None,
+                                checksums=None, cache_dir=None, progress_obj=None)
+        self._grabber = grabber
+        self._block_size = int(opts.seekable_block_size)
+        self._max_blocks = max(int(opts.seekable_cache_size) // self._block_size, 1)
+        self._blocks = collections.OrderedDict()
+        self._pos = 0
+        self._ahead = 1
+        self._next_miss = None
+        self._spool = None
+        self.size = None
+
+        scheme = urlparse.urlsplit(url)[0]
+        if scheme == b'file':
+            path = _local_path(url)
+            try:
+                self._spool = open(path, 'rb')
+            except IOError:
+                err = URLGrabError(14, 'curl#37 - "%s"' % (_("Could not open file %s") % path))
+                err.url = url
+                err.code = 37
+                raise err
+            self.size = os.fstat(self._spool.fileno()).st_size
+            return
+
+        try:
+            # streaming, to spool the body if it's all of the file
+            fo = self._request(0, self._block_size, stream=True)
+        except URLGrabError as e:
+            if getattr(e, 'code', None) != 416:
+                raise
+            self.size = 0 # nothing to get
+            return
+        try:
+            m = _content_range_re.search(fo._hdr_dump)
+            if (scheme in (b'http', b'https') and m
+                and re.match(br'HTTP/\S+ 206 ', fo._hdr_dump)):
+                self.size = int(m.group(3))
+                self._store(0, b''.join(fo.fo.chunks()))
+            else:
+                if DEBUG: DEBUG.info('no byte ranges, spooling %s', url)
+                self._spool = tempfile.TemporaryFile()
+                for chunk in fo.fo.chunks():
+                    self._spool.write(chunk)
+                self.size = self._spool.tell()
+        finally:
+            fo.close()
+
+    def _request(self, start, end, stream=False):
+        """a transfer of the bytes from start to end.  Streaming ones
+        have their own multi handle, so only the others keep the
+        connection warm."""
+        headers = tuple(self.opts.http_headers or ())
+        headers += (('Range', 'bytes=%d-%d' % (start, end - 1)),)
+        return PyCurlFileObject(self.url, None, self.opts.derive(http_headers=headers,
+                                                                 stream=stream))
+
+    def _store(self, index, block):
+        self._blocks[index] = block
+        while len(self._blocks) > self._max_blocks:
+            self._blocks.popitem(last=False)
+
+    def _fetch(self, index):
+        """get the block at index and, when the misses are sequential,
+        some of the following ones"""
+        if index == self._next_miss:
+            self._ahead = min(self._ahead * 2, self.max_ahead, self._max_blocks)
+        else:
+            self._ahead = 1
+        count = 1
+        while (count < self._ahead and index + count not in self._blocks
+               and (index + count) * self._block_size < self.size):
+            count += 1
+        self._next_miss = index + count
+
+        start = index * self._block_size
+        end = min(start + count * self._block_size, self.size)
+        if DEBUG: DEBUG.debug('seekable %s: bytes %d-%d', self.url, start, end - 1)
+        def retryfunc(opts, url):
+            fo = self._request(start, end)
+            try:
+                if not re.match(br'HTTP/\S+ 206 ', fo._hdr_dump):
+                    err = URLGrabError(9, _('Byte ranges no longer supported for %s')
+                                       % _urlunquote_convert(url))
+                    err.url = url
+                    raise err
+                data = fo.read()
+            finally:
+                fo.close()
+            if len(data) != end - start:
+                raise _size_mismatch(url, len(data), end - start)
+            return data
+        data = self._grabber._retry(self.opts, retryfunc, self.url)
+        for i in range(count):
+            self._store(index + i, data[i * self._block_size:(i + 1) * self._block_size])
+
+    def _block(self, index):
+        block = self._blocks.pop(index, None)
+        if block is None:
+            self._fetch(index)
+            block = self._blocks.pop(index)
+        self._blocks[index] = block # most recently used
+        return block
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        elif whence != os.SEEK_SET:
+            raise ValueError('invalid whence (%r)' % (whence,))
+        if offset < 0:
+            raise ValueError('negative seek position %r' % (offset,))
+        self._pos = offset
+        return offset
+
+    def readinto(self, b):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        b = memoryview(b)
+        if b.format != 'B':
+            b = b.cast('B') # Python 3 only, bytearrays need no cast
+        if self._spool is not None:
+            self._spool.seek(self._pos)
+            n = self._spool.readinto(b)
+            self._pos += n
+            return n
+        n = 0
+        while n < len(b) and self._pos < self.size:
+            index, skip = divmod(self._pos, self._block_size)
+            block = self._block(index)
+            count = min(len(b) - n, len(block) - skip)
+            b[n:n+count] = block[skip:skip+count]
+            n += count
+            self._pos += count
+        return n
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = max(self.size - self._pos, 0)
+        b = bytearray(size)
+        n = self.readinto(b)
+        del b[n:]
+        return bytes(b)
+
+    def readall(self):
+        return self.read()
+
+    def close(self):
+        if self._spool is not None:
+            self._spool.close()
+        self._blocks.clear()
+        io.RawIOBase.close(self)
+
+
+#####################################################################
+#  Segmented downloads
+#####################################################################
+
+class _SegmentWriter:
+    """Write one byte range of the local file in place."""
+    def __init__(self, fd, offset, end):
+        self.fd = fd
+        self.start = self.offset = offset
+        self.end = end
+
+    def write(self, buf):
+        if self.offset + len(buf) > self.end:
+            raise IOError(_('more data than requested'))
+        while buf:
+            if hasattr(os, 'pwrite'):
+                n = os.pwrite(self.fd, buf, self.offset)
+            else:
+                os.lseek(self.fd, self.offset, os.SEEK_SET)
+                n = os.write(self.fd, buf)
+            self.offset += n
+            buf = buf[n:]
+
+    def truncate(self, size=0):
+        # the server ignored the range, _retrieve() now writes
+        # just our part of the body
+        self.offset = self.start
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+class _Segment:
+    """A byte range of a segmented download, and the progress_obj
+    of its transfers."""
+    def __init__(self, grab, offset, stop, source):
+        self.grab = grab
+        self.offset = offset
+        self.stop = stop
+        self.source = source
+        self.tries = 0
+        self.amount = 0
+        self.fo = None
+
+    def open(self, multi):
+        url, opts, speed, key = self.grab.sources[self.source]
+        if DEBUG: DEBUG.info('segment %d-%d: %s', self.offset, self.stop, url)
+        self.writer = _SegmentWriter(self.grab.fd, self.offset, self.stop)
+        fo_opts = opts.derive(range=(self.offset, self.stop), reget=None,
+                              size=None, stream=False, checksums=None,
+                              progress_obj=self.grab.opts.progress_obj and self)
+        self.fo = PyCurlFileObject(url, None, fo_opts, multi=multi,
+                                   output=self.writer)
+        return self.fo.curl_obj
+
+    def done(self, errcode=0, errmsg=''):
+        """Finish the current transfer.  Returns False if the rest of
+        the range should be fetched again, raises when out of mirrors."""
+        url, opts, speed, key = self.grab.sources[self.source]
+        fo, self.fo = self.fo, None
+        try:
+            fo._multi_done(errcode, errmsg)
+            if self.writer.offset < self.stop:
+                err = URLGrabError(14, _('Short read of %s') % _urlunquote_convert(url))
+                err.url = url
+                raise err
+            _TH.grabbed(url, fo)
+            return True
+        except URLGrabError as e:
+            if DEBUG: DEBUG.info('segment %d-%d failed: %s', self.offset, self.stop, e)
+            _TH.update(url, 0, 0, e)
+            self.tries += 1
+            # resume from the next mirror
+            self.source = self.grab.failover(self, e)
+            self.amount += self.writer.offset - self.offset
+            self.offset = self.writer.offset
+            return False
+
+    def start(self, *args, **kwargs):
+        pass
+
+    def update(self, amount_read):
+        self.grab.update(self, amount_read)
+
+    def end(self, amount_read):
+        self.grab.update(self, amount_read)
+
+class _SegmentedGrab:
+    """Download a file in byte ranges over several connections.
+
+    sources is a list of (url, opts, speed, mirror) tuples, the first
+    one is used to probe the file.  The ranges are sized by the
+    estimated speeds of the sources.  mirror is the MirrorGroup key of
+    the source, or None.
+    """
+    def __init__(self, filename, opts, sources):
+        self.filename = filename
+        self.opts = opts
+        self.sources = sources
+        self.amounts = {}
+        self.fd = None
+
+    def probe(self):
+        """Returns the size of the file, or None if the server doesn't
+        do byte ranges."""
+        url, opts, speed, key = self.sources[0]
+        if urlparse.urlsplit(url)[0] not in (b'http', b'https'):
+            return None
+        fo = PyCurlFileObject(url, None, opts.derive(range=(0, 1), size=None,
+                                                     stream=True, progress_obj=None,
+                                                     checksums=None))
+        try:
+            hdr = fo._hdr_dump
+        finally:
+            fo.close()
+        if not re.match(br'HTTP/\S+ 206 ', hdr):
+            return None
+        m = re.search(br'^content-range:\s*bytes\s+\d+-\d+/(\d+)', hdr, re.I | re.M)
+        return m and int(m.group(1))
+
+    def plan(self, size):
+        """Split the file, faster sources get bigger ranges."""
+        count = min(self.opts.segments, size // max(self.opts.min_segment_size, 1))
+        if count < 2:
+            return []
+        slots = [i % len(self.sources) for i in range(count)]
+        weights = [self.sources[i][2] / slots.count(i) for i in slots]
+        total = sum(weights)
+        segments = []
+        start = acc = 0
+        for i, weight in zip(slots, weights):
+            acc += weight
+            end = len(segments) == count - 1 and size or int(size * acc / total)
+            segments.append(_Segment(self, start, end, i))
+            start = end
+        return segments
+
+    def run(self):
+        """Returns False if the file can't be split, the caller should
+        download it in one piece."""
+        size = self.probe()
+        if size and self.opts.exact_size and self.opts.size and size != int(self.opts.size):
+            raise _size_mismatch(self.sources[0][0], size, self.opts.size)
+        segments = size and self.plan(size)
+        if not segments:
+            return False
+        if DEBUG: DEBUG.info('%d segments of %s', len(segments), self.filename)
+
+        try:
+            self.fd = os.open(self.filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+            os.ftruncate(self.fd, size)
+        except OSError as e:
+            err = URLGrabError(16, _('error opening local file from %s, IOError: %s')
+                               % (self.sources[0][0], e))
+            err.url = self.sources[0][0]
+            if self.fd is not None:
+                os.close(self.fd)
+            raise err
+
+        progress_obj = self.opts.progress_obj
+        if progress_obj:
+            progress_obj.start(str(self.filename),
+                               _urlunquote_convert(self.sources[0][0]),
+                               os.path.basename(self.filename),
+                               size=size, text=self.opts.text)
+        try:
+            self.perform(segments)
+        finally:
+            os.close(self.fd)
+            if progress_obj:
+                progress_obj.end(sum(self.amounts.values()))
+        _verify_file(self.filename, self.sources[0][0], self.opts.checksums)
+        return True
+
+    def perform(self, segments):
+        multi = pycurl.CurlMulti()
+        running = {} # curl_obj => segment
+        try:
+            for segment in segments:
+                running[segment.open(multi)] = segment
+            while running:
+                if multi.select(1.0) == -1:
+                    time.sleep(0.01)
+                while True:
+                    code, num_active = multi.perform()
+                    if code != pycurl.E_CALL_MULTI_PERFORM:
+                        break
+                while True:
+                    num_q, ok, err = multi.info_read()
+                    for curl_obj, errcode, errmsg in [(c, 0, '') for c in ok] + err:
+                        segment = running.pop(curl_obj)
+                        if not segment.done(errcode, errmsg):
+                            running[segment.open(multi)] = segment
+                    if num_q == 0:
+                        break
+        finally:
+            for segment in running.values():
+                segment.fo.close()
+            multi.close()
+
+    def failover(self, segment, e):
+        """Returns the index of the source to resume a failed segment
+        from.  With a MirrorGroup, the failure goes through its
+        failure_callback and default_action.  Raises e when the grab
+        has failed for good."""
+        url, opts, speed, key = self.sources[segment.source]
+        removed = ()
+        if self.opts.mirror_group:
+            obj = opts.derive(url=url, relative_url=self.opts.relative_url,
+                              mirror_group=self.opts.mirror_group)
+            if not _mirror_failed(obj, key, e):
+                raise e
+            removed = self.opts.mirror_group[3]
+        elif segment.tries >= len(self.sources):
+            raise e
+        for i in range(1, len(self.sources) + 1):
+            source = (segment.source + i) % len(self.sources)
+            if self.sources[source][3] not in removed:
+                return source
+        err = URLGrabError(256, _('No more mirrors to try.'))
+        err.errors = self.opts.mirror_group[1]
+        raise err
+
+    def update(self, segment, amount_read):
+        self.amounts[segment] = segment.amount + amount_read
+        if self.opts.progress_obj:
+            self.opts.progress_obj.update(sum(self.amounts.values()))
+
+
+#####################################################################
+# DEPRECATED FUNCTIONS
+def set_throttle(new_throttle):
+    """Deprecated. Use: default_grabber.throttle = new_throttle"""
+    default_grabber.throttle = new_throttle
+
+def set_bandwidth(new_bandwidth):
+    """Deprecated. Use: default_grabber.bandwidth = new_bandwidth"""
+    default_grabber.bandwidth = new_bandwidth
+
+def set_progress_obj(new_progress_obj):
+    """Deprecated. Use: default_grabber.progress_obj = new_progress_obj"""
     default_grabber.progress_obj = new_progress_obj
 
 def set_user_agent(new_user_agent):
@@ -2128,11 +4018,62 @@ def _loads(s):
 def _readlines(fd):
     buf = os.read(fd, 4096)
     if not buf: return None
+    return _readlines_more(fd, buf)
+
+def _readlines_more(fd, buf):
     # whole lines only, no buffering
     while not buf.endswith(b'\n'):
         buf += os.read(fd, 4096)
     return buf[:-1].split(b'\n')
 
+#####################################################################
+#  Framed protocol (version 2)
+#
+# Each frame is a 4-byte big-endian length, a type byte and a marshal
+# payload.  Frames always start with a zero byte and v1 lines never
+# do, so both ends can tell the protocols apart.  The parent sets
+# URLGRABBER_EXT_DOWN_PROTOCOL=2 in the helper's environment, and a
+# helper that supports it answers in frames.  The first job is always
+# sent as a v1 line, the following ones as frames once the helper has
+# answered in frames.  Old helpers ignore the variable and keep
+# talking v1.
+#
+#   parent => helper
+#     'J' {option: value}  a new job.  Only options that differ from
+#                          the previous job are sent, None resets an
+#                          option to its default.
+#   helper => parent
+#     'P' [(id, size)...]  progress updates
+#     'D' (id, size, dlsz, dltm, errno, code, msg)
+#                          a job is done.  errno is None on success.
+#
+#####################################################################
+
+_PROTOCOL = 2
+
+def _frame(ftype, obj):
+    data = ftype + marshal.dumps(obj, 2)
+    return struct.pack('!I', len(data)) + data
+
+class _FrameReader:
+    """Split the data read from a pipe into (type, obj) frames."""
+    def __init__(self):
+        self.buf = b''
+
+    def feed(self, data):
+        buf = self.buf + data
+        frames = []
+        pos = 0
+        while len(buf) - pos >= 4:
+            size, = struct.unpack_from('!I', buf, pos)
+            end = pos + 4 + size
+            if end > len(buf):
+                break
+            frames.append((buf[pos + 4:pos + 5], marshal.loads(buf[pos + 5:end])))
+            pos = end
+        self.buf = buf[pos:]
+        return frames
+
 import subprocess
 
 class _ExternalDownloader:
@@ -2144,15 +4085,23 @@ class _ExternalDownloader:
             raise OSError('"/usr/libexec/urlgrabber-ext-down" is not installed')
         urlgrabber_path = (os.getenv('URLGRABBER_EXT_DOWN', None)
                            or '/usr/libexec/urlgrabber-ext-down')
+        env = dict(os.environ)
+        env['URLGRABBER_EXT_DOWN_PROTOCOL'] = str(_PROTOCOL)
         self.popen = subprocess.Popen(
             urlgrabber_path,
             stdin = subprocess.PIPE,
             stdout = subprocess.PIPE,
+            env = env,
         )
         self.stdin  = self.popen.stdin.fileno()
         self.stdout = self.popen.stdout.fileno()
         self.running = {}
         self.cnt = 0
+        self.protocol = 1 # until the helper answers in frames
+        self.reader = _FrameReader()
+        self.sent = {} # options the helper has
+        if metrics.REGISTRY:
+            metrics.REGISTRY.inc('urlgrabber_helpers_spawned_total')
 
     # list of options we pass to downloader
     _options = (
@@ -2167,11 +4116,24 @@ class _ExternalDownloader:
         'ssl_key_pass',
         'ssl_verify_peer', 'ssl_verify_host',
         'size', 'max_header_size', 'ip_resolve',
+        'dns_cache_timeout', 'resolve',
+        'checksums', 'exact_size',
         'ftp_disable_epsv',
         'no_cache',
     )
 
     def start(self, opts):
+        if DEBUG: DEBUG.info('attempt %i/%s: %s', opts.tries, opts.retry, opts.url)
+        if self.protocol == 1:
+            data = self._start_v1(opts)
+        else:
+            data = self._start_v2(opts)
+
+        self.cnt += 1
+        self.running[self.cnt] = opts
+        os.write(self.stdin, data)
+
+    def _start_v1(self, opts):
         arg = []
         for k in self._options:
             v = getattr(opts, k)
@@ -2180,18 +4142,53 @@ class _ExternalDownloader:
         if opts.progress_obj and opts.multi_progress_obj:
             arg.append('progress_obj=True')
         arg = ' '.join(arg)
-        if DEBUG: DEBUG.info('attempt %i/%s: %s', opts.tries, opts.retry, opts.url)
+        return (arg +'\n').encode('utf8')
 
-        self.cnt += 1
-        self.running[self.cnt] = opts
-        os.write(self.stdin, (arg +'\n').encode('utf8'))
+    def _job_options(self, opts):
+        ret = dict((k, getattr(opts, k)) for k in self._options)
+        ret['progress_obj'] = bool(opts.progress_obj and opts.multi_progress_obj) or None
+        return ret
+
+    def _start_v2(self, opts):
+        delta = {}
+        for k, v in self._job_options(opts).items():
+            if self.sent.get(k) != v:
+                delta[k] = self.sent[k] = v
+        return _frame(b'J', delta)
 
     def perform(self):
         ret = []
-        lines = _readlines(self.stdout)
-        if not lines:
+        buf = os.read(self.stdout, 65536)
+        if not buf:
             if DEBUG: DEBUG.info('downloader died')
             raise KeyboardInterrupt
+        if self.protocol == 1 and buf[:1] == b'\0':
+            if DEBUG: DEBUG.info('downloader protocol %d', _PROTOCOL)
+            self.protocol = _PROTOCOL
+            # the first job was sent as a v1 line
+            self.sent = self._job_options(self.running[self.cnt])
+        if self.protocol == 1:
+            return self._perform_v1(_readlines_more(self.stdout, buf))
+        for ftype, obj in self.reader.feed(buf):
+            if ftype == b'P':
+                for _id, size in obj:
+                    self.running[_id]._progress.update(size)
+            elif ftype == b'D':
+                # older downloaders send no stats
+                _id, size, dlsz, dltm, errno, code, msg = obj[:7]
+                stats = len(obj) > 7 and obj[7] or None
+                ug_err = None
+                if errno is not None:
+                    ug_err = URLGrabError(errno, msg)
+                    if code:
+                        ug_err.code = code
+                if stats is not None:
+                    stats = TransferStats(**stats)
+                ret.append(self._done(_id, size, dlsz, dltm, ug_err, stats))
+        return ret
+
+    def _perform_v1(self, lines):
+        ret = []
         for line in lines:
             # parse downloader output
             line = line.split(b' ', 6)
@@ -2200,33 +4197,55 @@ class _ExternalDownloader:
                 self.running[_id]._progress.update(size)
                 continue
             # job done
-            opts = self.running.pop(_id)
             if line[4] == b'OK':
                 ug_err = None
-                if DEBUG: DEBUG.info('success')
             else:
                 ug_err = URLGrabError(int(line[4]), line[6])
                 if line[5] != b'0':
                     ug_err.code = int(line[5])
-                if DEBUG: DEBUG.info('failure: %s', ug_err)
-            _TH.update(opts.url, int(line[2]), float(line[3]), ug_err, opts.async_[0])
-            ret.append((opts, size, ug_err))
+            ret.append(self._done(_id, size, int(line[2]), float(line[3]), ug_err))
         return ret
 
+    def _done(self, _id, size, dlsz, dltm, ug_err, stats=None):
+        opts = self.running.pop(_id)
+        opts.stats = stats
+        _count_transfer(opts.url, stats, ug_err, opts.async_[0])
+        timing = None
+        if ug_err is None:
+            if DEBUG: DEBUG.info('success')
+            if stats is not None:
+                timing = _curl_timing(stats)
+        else:
+            if DEBUG: DEBUG.info('failure: %s', ug_err)
+        _TH.update(opts.url, dlsz, dltm, ug_err, opts.async_[0], timing)
+        return opts, size, ug_err
+
     def abort(self):
         self.popen.stdin.close()
         self.popen.stdout.close()
         self.popen.wait()
 
 class _ExternalDownloaderPool:
-    def __init__(self):
+    def __init__(self, max_idle=None, idle_ttl=None):
         self.epoll = select.epoll()
         self.running = {}
-        self.cache = {}
+        self.cache = {} # host => idle downloaders, least recently used first
+        self.max_idle = max_idle
+        self.idle_ttl = idle_ttl
 
     def start(self, opts):
+        self.expire()
         host = urlparse.urlsplit(opts.url).netloc
-        dl = self.cache.pop(host, None)
+        idle = self.cache.get(host, [])
+        dl = None
+        while idle and not dl:
+            dl = idle.pop()
+            if dl.popen.poll() is not None:
+                # exited while idle
+                dl.abort()
+                dl = None
+        if not idle:
+            self.cache.pop(host, None)
         if not dl:
             dl = _ExternalDownloader()
             fl = fcntl.fcntl(dl.stdin, fcntl.F_GETFD)
@@ -2235,9 +4254,11 @@ class _ExternalDownloaderPool:
         self.running[dl.stdout] = dl
         dl.start(opts)
 
-    def perform(self):
+    def perform(self, timeout=None):
         ret = []
-        for fd, event in self.epoll.poll():
+        if timeout is None:
+            timeout = -1
+        for fd, event in self.epoll.poll(timeout):
             if event & select.EPOLLHUP:
                 if DEBUG: DEBUG.info('downloader died')
                 raise KeyboardInterrupt
@@ -2247,19 +4268,185 @@ class _ExternalDownloaderPool:
             assert len(done) == 1
             ret.extend(done)
 
-            # dl finished, move it to the cache
-            host = urlparse.urlsplit(done[0][0].url).netloc
-            if host in self.cache: self.cache[host].abort()
+            # dl finished, move it to the cache.  keep at most as
+            # many idle downloaders for the host as its async_ limit
+            opts = done[0][0]
+            host = urlparse.urlsplit(opts.url).netloc
             self.epoll.unregister(fd)
-            self.cache[host] = self.running.pop(fd)
+            dl = self.running.pop(fd)
+            dl.idle_since = time.time()
+            idle = self.cache.setdefault(host, [])
+            idle.append(dl)
+            while len(idle) > (opts.async_[1] or 2):
+                idle.pop(0).abort()
+        self.expire()
         return ret
 
-    def abort(self):
+    def expire(self):
+        """abort downloaders idle for too long, and the least recently
+        used ones when there are more than max_idle"""
+        now = time.time()
+        idle = sorted(((dl.idle_since, host, dl)
+                       for host in self.cache for dl in self.cache[host]),
+                      key=lambda item: item[0])
+        for n, (idle_since, host, dl) in enumerate(idle):
+            if (self.max_idle is not None and len(idle) - n > self.max_idle
+                or self.idle_ttl is not None and idle_since + self.idle_ttl < now):
+                self.cache[host].remove(dl)
+                if not self.cache[host]:
+                    del self.cache[host]
+                dl.abort()
+
+    def release(self):
+        """end of a batch, abort the running jobs but keep idle downloaders"""
         for dl in self.running.values():
             self.epoll.unregister(dl.stdout)
             dl.abort()
-        for dl in self.cache.values():
-            dl.abort()
+        self.running.clear()
+        self.expire()
+
+    def abort(self):
+        self.release()
+        for idle in self.cache.values():
+            for dl in idle:
+                dl.abort()
+        self.cache.clear()
+
+
+#####################################################################
+#  In-process downloader
+#####################################################################
+
+class _ProxyProgress:
+    """Forward the progress of one transfer to its multi-file meter."""
+    def __init__(self, opts):
+        self.opts = opts
+    def start(self, *d1, **d2):
+        pass
+    def update(self, _amount_read):
+        self.opts._progress.update(_amount_read)
+    def end(self, _amount_read):
+        pass
+
+class _CurlMultiDownloaderPool:
+    """Run parallel_wait() transfers on a single CurlMulti handle.
+
+    Same interface as _ExternalDownloaderPool, but no helper
+    processes are spawned.  Curl handles of finished transfers are
+    kept and reused, the connection cache belongs to the multi handle.
+    """
+    def __init__(self, max_idle=None, idle_ttl=None):
+        self.multi = None
+        self.running = {} # curl_obj => opts, PyCurlFileObject, URLGrabError
+        self.handles = [] # idle Curl objects
+        self.max_idle = max_idle
+        self.idle_ttl = idle_ttl
+        self.idle_since = time.time()
+
+    def start(self, opts):
+        self.expire()
+        if self.multi is None:
+            self.multi = pycurl.CurlMulti()
+            if hasattr(pycurl, 'M_PIPELINING') and hasattr(pycurl, 'PIPE_MULTIPLEX'):
+                self.multi.setopt(pycurl.M_PIPELINING, pycurl.PIPE_MULTIPLEX)
+        if DEBUG: DEBUG.info('attempt %i/%s: %s', opts.tries, opts.retry, opts.url)
+        progress_obj = None
+        if opts.progress_obj and opts.multi_progress_obj:
+            progress_obj = _ProxyProgress(opts)
+        fo_opts = opts.derive(progress_obj=progress_obj, curl_obj=None)
+        curl_obj = self.handles and self.handles.pop() or _curl_pool.new()
+        try:
+            fo = PyCurlFileObject(opts.url, opts.filename, fo_opts,
+                                  multi=self.multi, curl_obj=curl_obj)
+        except URLGrabError as e:
+            # failed to start, report it from the next perform()
+            self.running[curl_obj] = opts, None, e
+            return
+        self.running[curl_obj] = opts, fo, None
+
+    def _done(self, curl_obj, errcode=0, errmsg=''):
+        opts, fo, ug_err = self.running.pop(curl_obj)
+        self.handles.append(curl_obj)
+        self.idle_since = time.time()
+        try:
+            if ug_err: raise ug_err
+            fo._multi_done(errcode, errmsg)
+            fo.fo.close()
+            size = fo._amount_read
+            ug_err = None
+            opts.stats = fo.stats
+            if DEBUG: DEBUG.info('success')
+            _TH.grabbed(opts.url, fo, opts.async_[0])
+        except URLGrabError as e:
+            size = 0
+            ug_err = e
+            opts.stats = getattr(e, 'stats', None)
+            if DEBUG: DEBUG.info('failure: %s', ug_err)
+            _TH.update(opts.url, 0, 0, ug_err, opts.async_[0])
+        return opts, size, ug_err
+
+    def perform(self, timeout=None):
+        ret = [self._done(curl_obj)
+               for curl_obj, (opts, fo, ug_err) in list(self.running.items())
+               if fo is None]
+        if ret:
+            return ret
+        if timeout is None or timeout > 1.0:
+            timeout = 1.0
+        if self.multi.select(timeout) == -1:
+            # no file descriptors yet, libcurl is resolving
+            time.sleep(0.01)
+        while True:
+            code, num_active = self.multi.perform()
+            if code != pycurl.E_CALL_MULTI_PERFORM:
+                break
+        while True:
+            num_q, ok, err = self.multi.info_read()
+            for curl_obj in ok:
+                ret.append(self._done(curl_obj))
+            for curl_obj, errcode, errmsg in err:
+                ret.append(self._done(curl_obj, errcode, errmsg))
+            if num_q == 0:
+                break
+        return ret
+
+    def expire(self):
+        """close the multi handle and its connections when idle for too
+        long, and the Curl handles over max_idle"""
+        if self.running:
+            return
+        if (self.idle_ttl is not None and self.multi is not None
+            and self.idle_since + self.idle_ttl < time.time()):
+            self.multi.close()
+            self.multi = None
+            self.handles, close = [], self.handles
+        elif self.max_idle is not None:
+            close = self.handles[self.max_idle:]
+            del self.handles[self.max_idle:]
+        else:
+            close = []
+        for curl_obj in close:
+            curl_obj.close()
+
+    def release(self):
+        """end of a batch, abort the running jobs but keep the multi
+        handle with its connections"""
+        for curl_obj, (opts, fo, ug_err) in self.running.items():
+            if fo is not None:
+                fo.close()
+            self.handles.append(curl_obj)
+        self.running.clear()
+        self.idle_since = time.time()
+        self.expire()
+
+    def abort(self):
+        self.release()
+        for curl_obj in self.handles:
+            curl_obj.close()
+        del self.handles[:]
+        if self.multi is not None:
+            self.multi.close()
+            self.multi = None
 
 
 #####################################################################
@@ -2268,13 +4455,125 @@ class _ExternalDownloaderPool:
 
 _async_queue = []
 
-def parallel_wait(meter=None):
+def downloader_pool(max_idle=5, idle_ttl=60):
+    """Create a downloader pool that outlives parallel_wait() calls.
+
+    Pass it to parallel_wait(pool=...) or set it as the downloader_pool
+    option of default_grabber.  At most max_idle idle downloaders are
+    kept, for at most idle_ttl seconds.  The backend is selected by the
+    parallel_backend option of default_grabber when the pool is created.
+    """
+    if default_grabber.opts.parallel_backend == 'curlmulti':
+        return _CurlMultiDownloaderPool(max_idle, idle_ttl)
+    return _ExternalDownloaderPool(max_idle, idle_ttl)
+
+def parallel_wait(meter=None, pool=None):
     '''Process queued requests in parallel.
+
+    If a pool from downloader_pool() is given (or set as the
+    downloader_pool option), its idle downloaders are reused and
+    kept for the next call.
     '''
+    try:
+        for opts in _parallel(_async_queue, pool or default_grabber.opts.downloader_pool):
+            pass
+    finally:
+        del _async_queue[:]
+
+class Batch:
+    """A set of async_ requests with its own queue and downloaders.
+
+        batch = Batch(max_connections=10)
+        batch.urlgrab('http://example.com/a', '/tmp/a')
+        mirror_group.urlgrab('b', '/tmp/b', async_=(key, 2), batch=batch)
+        for opts in batch:
+            if opts.exception:
+                ...
+
+    Iterating over the batch processes its requests like parallel_wait()
+    does, and yields the options of each request as it finishes.  They
+    are those passed to failfunc: url, filename, exception (None if the
+    grab succeeded) and stats.  The batch is empty again afterwards.
+
+    Batches don't share a queue or downloaders, several of them can
+    run at the same time in different threads; the host statistics,
+    circuit breakers and Curl handles they do share are locked.
+
+    pool is a pool from downloader_pool() to use and keep, else the
+    batch starts its own downloaders and stops them at the end.
+    max_connections, parallel_backend and parallel_order default to
+    those of default_grabber.
+    """
+
+    def __init__(self, max_connections=None, pool=None, meter=None,
+                 parallel_backend=None, parallel_order=None):
+        self.queue = []
+        self.max_connections = max_connections
+        self.pool = pool
+        self.meter = meter
+        self.parallel_backend = parallel_backend
+        self.parallel_order = parallel_order
+
+    def urlgrab(self, url, filename=None, grabber=None, **kwargs):
+        """queue a urlgrab() of (grabber or default_grabber) to the batch
+
+        async_ defaults to (host, None).  With a meter, the request uses
+        it as multi_progress_obj.  Failures are reported in the results
+        only, unless a failfunc is given.
+        """
+        if not kwargs.get('async_'):
+            parts = urlparse.urlsplit(_to_utf8(url))
+            kwargs['async_'] = parts[0] + b'://' + parts[1], None
+        if self.meter is not None:
+            kwargs.setdefault('progress_obj', self.meter)
+            kwargs.setdefault('multi_progress_obj', self.meter)
+        kwargs.setdefault('failfunc', _do_nothing)
+        kwargs['batch'] = self
+        return (grabber or default_grabber).urlgrab(url, filename, **kwargs)
+
+    def __len__(self):
+        return len(self.queue)
+
+    def __iter__(self):
+        queue, self.queue = self.queue, []
+        return _parallel(queue, self.pool, self.max_connections,
+                         self.parallel_backend, self.parallel_order)
+
+def _mirror_failed(opts, key, ug_err):
+    """Record the failure of a MirrorGroup request on mirror key.
+    Returns True to retry it on another mirror, else sets the errors
+    attribute of ug_err."""
+    mg, errors, failed, removed = opts.mirror_group
+    errors.append((opts.url, exception2msg(ug_err)))
+    failed[key] = failed.get(key, 0) + 1
+    if metrics.REGISTRY:
+        metrics.REGISTRY.inc('urlgrabber_mirror_failovers_total',
+                             mirror=_bytes_repr(key))
+    opts.mirror = key
+    opts.exception = ug_err
+    action = mg.default_action or {}
+    if mg.failure_callback:
+        opts.tries = len(errors)
+        action = dict(action) # update only the copy
+        action.update(_run_callback(mg.failure_callback, opts) or {})
+    if not action.get('fail', 0):
+        # mask this mirror and retry
+        if action.get('remove', 1):
+            removed.add(key)
+        return True
+    # fail=1 from callback
+    ug_err.errors = errors
+    return False
+
+def _parallel(queue, pool=None, max_connections=None, parallel_backend=None,
+              parallel_order=None):
+    """Process the requests in queue, yield them as they finish.
+    A pool is released at the end, downloaders started here are
+    aborted.  The defaults come from default_grabber."""
 
     # calculate total sizes
     meters = {}
-    for opts in _async_queue:
+    for opts in queue:
         if opts.progress_obj and opts.multi_progress_obj:
             count, total = meters.get(opts.multi_progress_obj) or (0, 0)
             meters[opts.multi_progress_obj] = count + 1, total + opts.size
@@ -2284,23 +4583,47 @@ def parallel_wait(meter=None):
         count, total = meters[meter]
         meter.start(count, total)
 
-    dl = _ExternalDownloaderPool()
+    if max_connections is None:
+        max_connections = default_grabber.opts.max_connections
+    if parallel_backend is None:
+        parallel_backend = default_grabber.opts.parallel_backend
+    if parallel_order is None:
+        parallel_order = default_grabber.opts.parallel_order
+    dl = pool
+    if dl is None:
+        if parallel_backend == 'curlmulti':
+            dl = _CurlMultiDownloaderPool()
+        else:
+            dl = _ExternalDownloaderPool()
     host_con = {} # current host connection counts
+    in_flight = {} # the same, by metrics host label
     single = set() # hosts in single connection mode
-    retry_queue = []
+    retry_queue = [] # (opts, tries) to assign to hosts again
+    delayed = [] # (time, opts) of retries waiting for their backoff
+    finished = [] # requests to yield
 
     def start(opts, tries):
         opts.tries = tries
+        try:
+            _CB.check(opts.url, opts)
+        except URLGrabError as e:
+            failure(opts, e) # fail fast, or over to another mirror
+            return
         try:
             dl.start(opts)
         except OSError as e:
             # can't spawn downloader, give up immediately
             opts.exception = URLGrabError(5, exception2msg(e))
             _run_callback(opts.failfunc, opts)
+            finished.append(opts)
             return
 
         key, limit = opts.async_
         host_con[key] = host_con.get(key, 0) + 1
+        if metrics.REGISTRY:
+            host = _TH._host(opts.url, key)
+            in_flight[host] = in_flight.get(host, 0) + 1
+            metrics.REGISTRY.set('urlgrabber_in_flight', in_flight[host], host=host)
         if opts.progress_obj:
             if opts.multi_progress_obj:
                 opts._progress = opts.multi_progress_obj.newMeter()
@@ -2308,10 +4631,19 @@ def parallel_wait(meter=None):
             else:
                 opts._progress = time.time() # no updates
 
-    def perform():
-        for opts, size, ug_err in dl.perform():
+    def perform(timeout=None):
+        if timeout is None:
+            done = dl.perform()
+        else:
+            done = dl.perform(timeout) # wake up for the next retry
+        for opts, size, ug_err in done:
             key, limit = opts.async_
             host_con[key] -= 1
+            if metrics.REGISTRY:
+                host = _TH._host(opts.url, key)
+                in_flight[host] = in_flight.get(host, 1) - 1
+                metrics.REGISTRY.set('urlgrabber_in_flight', in_flight[host], host=host)
+            _CB.update(opts.url, ug_err, opts)
 
             if ug_err is None:
                 if opts.checkfunc:
@@ -2334,227 +4666,682 @@ def parallel_wait(meter=None):
                     opts.progress_obj.end(size)
                 del opts._progress
 
-            if ug_err is None:
-                continue
-            if limit != 1 and key not in single and ug_err.errno in (12, 14):
-                # One possible cause is connection-limited server.
-                # Turn on the max_connections=1 override. BZ 853432
-                if DEBUG: DEBUG.info('max_connections(%s) %s => 1', key, limit)
-                single.add(key)
-                # When using multi-downloader the parent's _curl_cache
-                # object is idle. Kill it, as it might use keepalive=1.
-                reset_curl_obj()
-
-            retry = opts.retry or 0
-            if opts.failure_callback:
-                opts.exception = ug_err
-                try:
-                    _run_callback(opts.failure_callback, opts)
-                except URLGrabError as e:
-                    ug_err = e
-                    retry = 0 # no retries
-            if opts.tries < retry and ug_err.errno in opts.retrycodes:
+            if ug_err is not None:
+                failure(opts, ug_err)
+            else:
+                opts.exception = None
+                finished.append(opts)
+
+    def failure(opts, ug_err):
+        key, limit = opts.async_
+        if limit != 1 and key not in single and ug_err.errno in (12, 14):
+            # One possible cause is connection-limited server.
+            # Turn on the max_connections=1 override. BZ 853432
+            if DEBUG: DEBUG.info('max_connections(%s) %s => 1', key, limit)
+            single.add(key)
+            # When using multi-downloader the parent's pooled
+            # handles are idle. Kill them, as they might use keepalive=1.
+            reset_curl_obj()
+
+        retry = opts.retry or 0
+        if opts.failure_callback:
+            opts.exception = ug_err
+            try:
+                _run_callback(opts.failure_callback, opts)
+            except URLGrabError as e:
+                ug_err = e
+                retry = 0 # no retries
+        if opts.tries < retry and ug_err.errno in opts.retrycodes:
+            delay = _retry_delay(opts, opts.tries, ug_err)
+            if delay is not None:
                 if ug_err.errno < 0 and opts.retry_no_cache:
                     opts.no_cache = True
-                start(opts, opts.tries + 1) # simple retry
-                continue
+                if DEBUG: DEBUG.info('retrying in %.3fs', delay)
+                if metrics.REGISTRY:
+                    metrics.REGISTRY.inc('urlgrabber_retries_total', host=_TH._host(opts.url, key))
+                delayed.append((time.time() + delay, opts))
+                return
 
-            if opts.mirror_group:
-                mg, errors, failed, removed = opts.mirror_group
-                errors.append((opts.url, exception2msg(ug_err)))
-                failed[key] = failed.get(key, 0) + 1
-                opts.mirror = key
-                opts.exception = ug_err
-                action = mg.default_action or {}
-                if mg.failure_callback:
-                    opts.tries = len(errors)
-                    action = dict(action) # update only the copy
-                    action.update(_run_callback(mg.failure_callback, opts))
-                if not action.get('fail', 0):
-                    # mask this mirror and retry
-                    if action.get('remove', 1):
-                        removed.add(key)
-                    retry_queue.append(opts)
-                    continue
-                # fail=1 from callback
-                ug_err.errors = errors
+        if opts.mirror_group and _mirror_failed(opts, key, ug_err):
+            retry_queue.append((opts, 1))
+            return
 
-            # urlgrab failed
-            opts.exception = ug_err
+        # urlgrab failed
+        opts.exception = ug_err
+        _run_callback(opts.failfunc, opts)
+        finished.append(opts)
+
+    def choose_mirror(opts):
+        mg, errors, failed, removed = opts.mirror_group
+
+        # find the best mirror
+        best = None
+        best_speed = None
+        for mirror in mg.mirrors:
+            key = mirror['mirror']
+            if key in removed: continue
+
+            # estimate the time to get the file, requests already
+            # queued for the mirror count as connections
+            speed, fail = _TH.estimate(key)
+            cost = _TH.cost(key, opts.size,
+                            host_con.get(key, 0) + len(ready.get(key, ())))
+
+            # order by: breaker closed, least failures, private flag,
+            # least time.  ignore 'private' flag if there were failures
+            private = not fail and mirror.get('kwargs', {}).get('private', False)
+            speed = not _CB.is_open(key), -failed.get(key, 0), private, -cost
+            if best is None or speed > best_speed:
+                best = mirror
+                best_speed = speed
+
+        if best is None:
+            opts.exception = URLGrabError(256, _('No more mirrors to try.'))
+            opts.exception.errors = errors
             _run_callback(opts.failfunc, opts)
+            finished.append(opts)
+            return False
 
-    try:
-        retry_idx = idx = 0
-        while True:
-            if retry_idx < len(retry_queue):
-                # retries first
-                opts = retry_queue[retry_idx]
-                retry_idx += 1
-            elif idx < len(_async_queue):
-                # handle next request
-                opts = _async_queue[idx]
-                idx += 1
-            else:
-                # both queues are empty
-                if not dl.running: break
-                perform()
-                continue
+        # update the grabber object, apply mirror kwargs
+        grabber = best.get('grabber') or mg.grabber
+        opts.delegate = grabber.opts.derive(**best.get('kwargs', {}))
 
-            # check global limit
-            while len(dl.running) >= default_grabber.opts.max_connections:
-                perform()
-            if DEBUG:
-                DEBUG.info('max_connections: %d/%d', len(dl.running), default_grabber.opts.max_connections)
-
-            if opts.mirror_group:
-                mg, errors, failed, removed = opts.mirror_group
-
-                # find the best mirror
-                best = None
-                best_speed = None
-                for mirror in mg.mirrors:
-                    key = mirror['mirror']
-                    if key in removed: continue
-
-                    # estimate mirror speed
-                    speed, fail = _TH.estimate(key)
-                    speed /= 1 + host_con.get(key, 0)
-
-                    # order by: least failures, private flag, best speed
-                    # ignore 'private' flag if there were failures
-                    private = not fail and mirror.get('kwargs', {}).get('private', False)
-                    speed = -failed.get(key, 0), private, speed
-                    if best is None or speed > best_speed:
-                        best = mirror
-                        best_speed = speed
-
-                if best is None:
-                    opts.exception = URLGrabError(256, _('No more mirrors to try.'))
-                    opts.exception.errors = errors
-                    _run_callback(opts.failfunc, opts)
-                    continue
+        # update the current mirror and limit
+        key = best['mirror']
+        limit = best.get('kwargs', {}).get('max_connections')
+        opts.async_ = key, limit
 
-                # update the grabber object, apply mirror kwargs
-                grabber = best.get('grabber') or mg.grabber
-                opts.delegate = grabber.opts.derive(**best.get('kwargs', {}))
+        # update URL and proxy
+        url = mg._join_url(key, opts.relative_url)
+        url, parts = opts.urlparser.parse(url, opts)
+        opts.find_proxy(url, parts[0])
+        opts.url = url
+        return True
 
-                # update the current mirror and limit
-                key = best['mirror']
-                limit = best.get('kwargs', {}).get('max_connections')
-                opts.async_ = key, limit
+    def host_limit(key, opts):
+        if key in single:
+            return 1
+        return opts.async_[1] or 2
 
-                # update URL and proxy
-                url = mg._join_url(key, opts.relative_url)
-                url, parts = opts.urlparser.parse(url, opts)
-                opts.find_proxy(url, parts[0])
-                opts.url = url
+    # Requests wait in per-host queues of (order, opts, tries), sorted
+    # by order, so that a host at its connection limit does not block
+    # the others.  The head with the lowest order is started first,
+    # retries before new requests.  The queue may grow meanwhile, eg.
+    # from callbacks, so it's read as we go rather than sorted first.
+    ready = {} # key => sorted list of (order, opts, tries)
+    retries = 0
 
-            # check host limit, then start
-            key, limit = opts.async_
-            if key in single:
-                limit = 1
-            while host_con.get(key, 0) >= (limit or 2):
-                perform()
+    try:
+        idx = 0
+        while True:
+            while finished:
+                yield finished.pop(0)
+
+            # queue the retries that have waited long enough
+            now = time.time()
+            for item in [item for item in delayed if item[0] <= now]:
+                delayed.remove(item)
+                retry_queue.append((item[1], item[1].tries + 1))
+
+            # assign new requests and retries to hosts.  Retries stay
+            # on their mirror, failovers choose another one
+            while retry_queue or idx < len(queue):
+                if retry_queue:
+                    opts, tries = retry_queue.pop(0)
+                    order = 0, retries
+                    retries += 1
+                else:
+                    opts, tries = queue[idx], 1
+                    if parallel_order == 'size':
+                        order = 1, -(opts.size or 0), idx
+                    else:
+                        order = 1, idx
+                    idx += 1
+                if opts.mirror_group and tries == 1 and not choose_mirror(opts):
+                    continue
+                key, limit = opts.async_
+                bisect.insort(ready.setdefault(key, []), (order, opts, tries))
+
+            if metrics.REGISTRY:
+                depth = len(delayed) + sum(len(q) for q in ready.values())
+                metrics.REGISTRY.set('urlgrabber_queue_depth', depth)
+
+            # pick the first request of a host with a free slot
+            best = None
+            if len(dl.running) < max_connections:
+                for key in ready:
+                    order, opts, tries = ready[key][0]
+                    if host_con.get(key, 0) >= host_limit(key, opts):
+                        continue
+                    if best is None or order < best[0]:
+                        best = order, key
+            elif DEBUG:
+                DEBUG.info('max_connections: %d/%d', len(dl.running), max_connections)
+
+            if best is None:
+                if finished:
+                    continue
+                timeout = None
+                if delayed:
+                    timeout = max(min(item[0] for item in delayed) - time.time(), 0)
+                if not dl.running:
+                    if timeout is None:
+                        # all queues are empty
+                        break
+                    time.sleep(timeout)
+                    continue
+                perform(timeout)
+                continue
+
+            order, key = best
+            order, opts, tries = ready[key].pop(0)
+            if not ready[key]:
+                del ready[key]
+            if opts.mirror_group and key in opts.mirror_group[3]:
+                # the mirror was removed while this request waited
+                retry_queue.append((opts, 1))
+                continue
             if DEBUG:
-                DEBUG.info('max_connections(%s): %d/%s', key, host_con.get(key, 0), limit)
+                DEBUG.info('max_connections(%s): %d/%s', key, host_con.get(key, 0), opts.async_[1])
 
-            start(opts, 1)
+            start(opts, tries)
     except IOError as e:
         if e.errno != 4: raise
         raise KeyboardInterrupt
 
     finally:
-        dl.abort()
+        if dl is pool:
+            dl.release()
+        else:
+            dl.abort()
         for meter in meters:
             meter.end()
-        del _async_queue[:]
         _TH.save()
 
 
+#####################################################################
+#  Mirror racing
+#####################################################################
+
+class _MirrorRace:
+    """Run a urlgrab(), urlread() or urlopen() on several mirrors at
+    once, for MirrorGroup racing.  The first transfer that gets a 2xx
+    reply (or, without headers, data) wins and the others are
+    cancelled.  urlgrab() racers write to temporary files, the
+    winner's is renamed to the filename at the end."""
+
+    def __init__(self, func, kw):
+        self.func = func
+        self.kw = dict(kw)
+        self.filename = self.kw.pop('filename', None)
+        self.limit = self.kw.pop('limit', None)
+        self.multi = pycurl.CurlMulti()
+        self.running = {} # curl_obj => key, url, opts, PyCurlFileObject, tmp
+        self.started = 0
+        self.winner = None
+        self.done = False
+        self.result = None
+
+    def start(self, key, grabber, url, opts):
+        """start the transfer of url, key identifies it in the results"""
+        opts = opts.derive(**self.kw)
+        url = _to_utf8(url)
+        tmp = None
+        if self.func == 'urlgrab':
+            url, self.filename, path = grabber._parse_grab(url, self.filename, opts)
+        else:
+            (url, parts) = opts.urlparser.parse(url, opts)
+            opts.find_proxy(url, parts[0])
+        _CB.check(url, opts)
+        if DEBUG: DEBUG.info('race: starting %s', _bytes_repr(url))
+        self.started += 1
+        if self.func == 'urlgrab':
+            tmp = _grab_tmpname(url, self.filename)
+        try:
+            fo = PyCurlFileObject(url, tmp, opts, multi=self.multi)
+        except URLGrabError:
+            self._unlink(tmp)
+            raise
+        self.running[fo.curl_obj] = key, url, opts, fo, tmp
+
+    def _unlink(self, tmp):
+        if tmp is not None:
+            try: os.unlink(tmp)
+            except OSError: pass
+
+    def _cancel(self, curl_obj):
+        key, url, opts, fo, tmp = self.running.pop(curl_obj)
+        if DEBUG: DEBUG.info('race: cancelled %s', _bytes_repr(url))
+        fo.close()
+        self._unlink(tmp)
+
+    def _won(self, fo):
+        if fo.scheme in (b'http', b'https'):
+            return fo._hdr_ended and 200 <= fo.http_code <= 299
+        return fo._amount_read > 0
+
+    def perform(self, timeout):
+        """Run the transfers for up to timeout seconds.  Returns the
+        (key, url, URLGrabError) of the transfers that failed."""
+        failed = []
+        if self.multi.select(timeout) == -1:
+            time.sleep(min(timeout, 0.01))
+        while True:
+            code, num_active = self.multi.perform()
+            if code != pycurl.E_CALL_MULTI_PERFORM:
+                break
+        while True:
+            num_q, ok, err = self.multi.info_read()
+            for curl_obj in ok:
+                self._finish(curl_obj, 0, '', failed)
+            for curl_obj, errcode, errmsg in err:
+                self._finish(curl_obj, errcode, errmsg, failed)
+            if num_q == 0:
+                break
+        if self.winner is None:
+            for curl_obj, (key, url, opts, fo, tmp) in list(self.running.items()):
+                if self._won(fo):
+                    self._win(curl_obj)
+                    break
+        return failed
+
+    def _win(self, curl_obj):
+        if DEBUG: DEBUG.info('race: %s won', _bytes_repr(self.running[curl_obj][1]))
+        self.winner = curl_obj
+        for other in list(self.running):
+            if other is not curl_obj:
+                self._cancel(other)
+
+    def _finish(self, curl_obj, errcode, errmsg, failed):
+        if not errcode and self.winner is None:
+            self._win(curl_obj)
+        key, url, opts, fo, tmp = self.running.pop(curl_obj)
+        try:
+            fo._multi_done(errcode, errmsg)
+            self.result = self._result(url, opts, fo, tmp)
+        except URLGrabError as e:
+            fo.close()
+            _TH.update(url, 0, 0, e)
+            _CB.update(url, e, opts)
+            self._unlink(tmp)
+            failed.append((key, url, e))
+            if self.winner is curl_obj:
+                self.winner = None
+        else:
+            self.done = True
+            if self.func != 'urlopen':
+                fo.close()
+
+    def _result(self, url, opts, fo, tmp):
+        """what the grabber method returns, from the finished winner"""
+        _TH.grabbed(url, fo)
+        _CB.update(url, None, opts)
+        if self.func == 'urlopen':
+            return fo
+        if self.func == 'urlgrab':
+            try:
+                os.rename(tmp, self.filename)
+            except OSError as e:
+                err = URLGrabError(16, _('error renaming %s to %s: %s')
+                                   % (tmp, self.filename, e))
+                err.url = url
+                raise err
+            obj = CallbackObject(filename=self.filename, url=url, stats=fo.stats)
+            ret = self.filename
+        else:
+            ret = fo.read()
+            if self.limit is not None and len(ret) > self.limit:
+                err = URLGrabError(8, _('Exceeded limit (%i): %s') % (self.limit, url))
+                err.url = url
+                raise err
+            obj = CallbackObject(data=ret, url=url, stats=fo.stats)
+        if not opts.checkfunc is None:
+            _run_callback(opts.checkfunc, obj)
+        return ret
+
+    def close(self):
+        """cancel what is still running"""
+        for curl_obj in list(self.running):
+            self._cancel(curl_obj)
+        self.multi.close()
+
+
 #####################################################################
 #  Host bandwidth estimation
 #####################################################################
 
+def _curl_timing(stats):
+    """The (connect, tls, ttfb) seconds of a transfer, from its
+    TransferStats.  tls is 0 without TLS or on a reused connection."""
+    return stats.connect, max(stats.tls - stats.connect, 0), stats.ttfb
+
+class _LatencySketch:
+    """A streaming quantile sketch of latencies: a histogram with
+    buckets 10% apart, whose weights decay with scale()."""
+    base = 1e-3
+    growth = 1.1
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets or {}
+
+    def add(self, value):
+        i = int(math.log(max(value, self.base) / self.base, self.growth))
+        self.buckets[i] = self.buckets.get(i, 0) + 1
+
+    def scale(self, k):
+        for i in list(self.buckets):
+            w = self.buckets[i] * k
+            if w < 0.01:
+                del self.buckets[i]
+            else:
+                self.buckets[i] = w
+
+    def quantile(self, q):
+        """The q-quantile, or None if there are no samples"""
+        total = sum(self.buckets.values())
+        if not total: return None
+        left = total * q
+        for i in sorted(self.buckets):
+            left -= self.buckets[i]
+            if left <= 0: break
+        return self.base * self.growth ** (i + 0.5)
+
+    def dumps(self):
+        return ','.join('%d=%.3g' % (i, w) for i, w in sorted(self.buckets.items())) or '-'
+
+    @staticmethod
+    def loads(s):
+        buckets = {}
+        if s != '-':
+            for item in s.split(','):
+                i, w = item.split('=')
+                buckets[int(i)] = float(w)
+        return _LatencySketch(buckets)
+
 class _TH:
+    """The speeds, failures and latencies of the hosts, shared by all
+    the requests of the process, and saved to the timedhosts file."""
     hosts = {}
+    latency = {} # host => ts, [connect, tls, ttfb] sketches
+    updated = set() # hosts updated since the last save
     dirty = None
+    lock = threading.RLock()
+
+    @staticmethod
+    def _read(filename, hosts, latency):
+        """parse the timedhosts file into the hosts and latency dicts"""
+        try:
+            f = open(filename)
+        except IOError:
+            return
+        now = int(time.time())
+        with f:
+            for line in f:
+                try:
+                    if ' latency ' in line:
+                        # older versions skip these lines
+                        host, tag, ts, sketches = line.split(' ', 3)
+                        latency[host] = (min(int(ts), now),
+                                         [_LatencySketch.loads(sk)
+                                          for sk in sketches.split()])
+                        continue
+                    host, speed, fail, ts = line.rsplit(' ', 3)
+                    hosts[host] = int(speed), int(fail), min(int(ts), now)
+                except ValueError:
+                    if DEBUG: DEBUG.info('Error parsing timedhosts: line "%s"', line)
 
     @staticmethod
     def load():
         filename = default_grabber.opts.timedhosts
-        if filename and _TH.dirty is None:
-            try:
-                now = int(time.time())
-                for line in open(filename):
-                    try:
-                        host, speed, fail, ts = line.rsplit(' ', 3)
-                        _TH.hosts[host] = int(speed), int(fail), min(int(ts), now)
-                    except ValueError:
-                        if DEBUG: DEBUG.info('Error parsing timedhosts: line "%s"', line)
-            except IOError: pass
-            _TH.dirty = False
+        with _TH.lock:
+            if filename and _TH.dirty is None:
+                # saves replace the file atomically, no file lock is needed
+                _TH._read(filename, _TH.hosts, _TH.latency)
+                _TH.dirty = False
 
     @staticmethod
     def save():
+        """Merge our updates into the timedhosts file.  Other processes
+        may have saved since we loaded it, so it's read again under
+        a lock, and only the hosts we have updated since, and have
+        newer data for, are replaced."""
         filename = default_grabber.opts.timedhosts
-        if filename and _TH.dirty is True:
-            tmp = '%s.%d' % (filename, os.getpid())
-            try:
-                f = open(tmp, 'w')
-                for host in _TH.hosts:
-                    f.write(host + ' %d %d %d\n' % _TH.hosts[host])
-                f.close()
-                os.rename(tmp, filename)
-            except IOError: pass
-            _TH.dirty = False
+        with _TH.lock:
+            if filename and _TH.dirty is True:
+                tmp = '%s.%d.%d' % (filename, os.getpid(),
+                                    threading.current_thread().ident)
+                lock = None
+                try:
+                    lock = open(filename + '.lock', 'a')
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                    hosts, latency = {}, {}
+                    _TH._read(filename, hosts, latency)
+                    for host in _TH.updated:
+                        if host in _TH.hosts and _TH.hosts[host][2] >= hosts.get(host, (0, 0, 0))[2]:
+                            hosts[host] = _TH.hosts[host]
+                        if host in _TH.latency and _TH.latency[host][0] >= latency.get(host, (0,))[0]:
+                            latency[host] = _TH.latency[host]
+                    f = open(tmp, 'w')
+                    for host in hosts:
+                        f.write(host + ' %d %d %d\n' % hosts[host])
+                    for host in latency:
+                        ts, sketches = latency[host]
+                        f.write('%s latency %d %s\n' % (host, ts,
+                                ' '.join(sk.dumps() for sk in sketches)))
+                    f.close()
+                    os.rename(tmp, filename)
+                    # we now have what the others measured, too
+                    _TH.hosts, _TH.latency = hosts, latency
+                except IOError: pass
+                finally:
+                    if lock is not None:
+                        lock.close() # releases the lock
+                _TH.updated.clear()
+                _TH.dirty = False
+
+    @staticmethod
+    def _host(url, baseurl=None):
+        """The key of url: the hostname, or baseurl if it has none"""
+        host = urlparse.urlsplit(url).netloc.split(b'@')[-1] or baseurl
+        if isinstance(host, bytes):
+            host = host.decode('utf8', 'replace')
+        return host
 
     @staticmethod
-    def update(url, dl_size, dl_time, ug_err, baseurl=None):
+    def grabbed(url, fo, baseurl=None):
+        """update() after a successful transfer by fo"""
+        dlsz = dltm = 0
+        if fo._tm_last:
+            dlsz = fo._tm_last[0] - fo._tm_first[0]
+            dltm = fo._tm_last[1] - fo._tm_first[1]
+        _TH.update(url, dlsz, dltm, None, baseurl, fo._timing)
+
+    @staticmethod
+    def update(url, dl_size, dl_time, ug_err, baseurl=None, timing=None):
         # Use hostname from URL.  If it's a file:// URL, use baseurl.
         # If no baseurl, do not update timedhosts.
-        host = urlparse.urlsplit(url).netloc.split(b'@')[-1] or baseurl
+        host = _TH._host(url, baseurl)
         if not host: return
 
-        _TH.load()
-        speed, fail, ts = _TH.hosts.get(host) or (0, 0, 0)
-        now = time.time()
+        with _TH.lock:
+            _TH.load()
+            now = time.time()
 
-        if ug_err is None:
-            # defer first update if the file was small.  BZ 851178.
-            if not ts and dl_size < 1e6: return
-            # k1: the older, the less useful
-            # k2: <500ms readings are less reliable
-            # speeds vary, use 10:1 smoothing
-            k1 = 2**((ts - now) / default_grabber.opts.half_life)
-            k2 = min(dl_time / .500, 1.0) / 10
-            if k2 > 0:
-                speed = (k1 * speed + k2 * dl_size / dl_time) / (k1 + k2)
-            fail = 0
-        elif getattr(ug_err, 'code', None) == 404:
-            if not ts: return # 1st update, avoid speed=0
-            fail = 0 # alive, at least
-        else:
-            fail += 1 # seems dead
+            if ug_err is None and timing is not None:
+                # latencies are recorded for files of any size
+                ts, sketches = _TH.latency.get(host) or (0, None)
+                if sketches is None:
+                    sketches = [_LatencySketch() for i in timing]
+                else:
+                    k = 2**((ts - now) / default_grabber.opts.half_life)
+                    for sk in sketches: sk.scale(k)
+                for sk, value in zip(sketches, timing):
+                    sk.add(value)
+                _TH.latency[host] = now, sketches
+                _TH.updated.add(host)
+                _TH.dirty = True
+
+            speed, fail, ts = _TH.hosts.get(host) or (0, 0, 0)
 
-        _TH.hosts[host] = speed, fail, now
-        _TH.dirty = True
+            if ug_err is None:
+                # defer first update if the file was small.  BZ 851178.
+                if not ts and dl_size < 1e6: return
+                if not dl_time: return # nothing measured
+                # k1: the older, the less useful
+                # k2: <500ms readings are less reliable
+                # speeds vary, use 10:1 smoothing
+                k1 = 2**((ts - now) / default_grabber.opts.half_life)
+                k2 = min(dl_time / .500, 1.0) / 10
+                if k2 > 0:
+                    speed = (k1 * speed + k2 * dl_size / dl_time) / (k1 + k2)
+                fail = 0
+            elif getattr(ug_err, 'code', None) == 404:
+                if not ts: return # 1st update, avoid speed=0
+                fail = 0 # alive, at least
+            else:
+                fail += 1 # seems dead
+
+            _TH.hosts[host] = speed, fail, now
+            _TH.updated.add(host)
+            _TH.dirty = True
 
     @staticmethod
     def estimate(baseurl):
         _TH.load()
 
         # Use just the hostname, unless it's a file:// baseurl.
-        host = urlparse.urlsplit(baseurl).netloc.split(b'@')[-1] or baseurl
+        host = _TH._host(baseurl, baseurl)
 
         default_speed = default_grabber.opts.default_speed
-        try: speed, fail, ts = _TH.hosts[host]
-        except KeyError: return default_speed, 0
+        with _TH.lock:
+            try: speed, fail, ts = _TH.hosts[host]
+            except KeyError: return default_speed, 0
 
         speed *= 2**-fail
         k = 2**((ts - time.time()) / default_grabber.opts.half_life)
         speed = k * speed + (1 - k) * default_speed
         return speed, fail
 
+    @staticmethod
+    def quantiles(baseurl, q=0.5):
+        """The q-quantiles of the (connect, tls, ttfb) latencies of
+        the host of baseurl in seconds, None where unknown."""
+        _TH.load()
+        with _TH.lock:
+            ts, sketches = _TH.latency.get(_TH._host(baseurl, baseurl)) or (0, ())
+            return tuple(sk.quantile(q) for sk in sketches) or (None, None, None)
+
+    @staticmethod
+    def cost(baseurl, size=None, load=0):
+        """The expected seconds to get a file of this size from the
+        host of baseurl: the median time to first byte, and the
+        transfer at the estimated speed, shared with 'load' other
+        transfers.  Unknown sizes count as 1MB."""
+        speed, fail = _TH.estimate(baseurl)
+        ttfb = _TH.quantiles(baseurl)[2]
+        if ttfb is None:
+            ttfb = default_grabber.opts.default_latency
+        size = float(size or 0) or 1e6
+        return ttfb * 2**fail + size * (1 + load) / speed
+
+#####################################################################
+#  Retry delays and circuit breakers
+#####################################################################
+
+def _retry_after(hdr):
+    """The seconds a Retry-After header in hdr asks to wait, or None"""
+    m = re.search(br'^retry-after:\s*(.*?)\s*$', hdr, re.I | re.M)
+    if not m:
+        return None
+    value = m.group(1).decode('latin-1')
+    if value.isdigit():
+        return float(value)
+    t = email.utils.parsedate_tz(value)
+    if t is None:
+        return None
+    return max(email.utils.mktime_tz(t) - time.time(), 0.0)
+
+def _retry_delay(opts, tries, e):
+    """The seconds to wait before retrying after try number 'tries'
+    failed with e: exponential backoff with full jitter, or what the
+    server asked for.  None if that's over retry_backoff_max."""
+    delay = min(opts.retry_backoff * 2**min(tries - 1, 30),
+                opts.retry_backoff_max)
+    delay = random.uniform(0, delay)
+    retry_after = getattr(e, 'retry_after', None)
+    if retry_after is not None:
+        if retry_after > opts.retry_backoff_max:
+            return None
+        delay = max(delay, retry_after)
+    return delay
+
+class _CB:
+    """The circuit breakers of the hosts, shared by all the requests
+    of the process.  Each is closed, open or half-open."""
+    hosts = {} # host => [failures in a row, open until, probe started]
+    lock = threading.Lock()
+
+    @staticmethod
+    def _failure(ug_err):
+        """whether ug_err says the host is in trouble"""
+        if ug_err.errno not in (12, 14):
+            return False
+        code = getattr(ug_err, 'code', 0)
+        return not 400 <= code <= 499 or code in (408, 429)
+
+    @staticmethod
+    def is_open(url):
+        """whether requests to the host of url would fail now"""
+        with _CB.lock:
+            fails, until, probe = _CB.hosts.get(_TH._host(url)) or (0, 0, 0)
+        return time.time() < until or bool(probe)
+
+    @staticmethod
+    def check(url, opts):
+        """Raise URLGrabError 19 if the breaker of the host of url is
+        open.  When half-open, the first request is let through."""
+        host = _TH._host(url)
+        if not host or not opts.breaker_threshold:
+            return
+        with _CB.lock:
+            state = _CB.hosts.get(host)
+            if state is None or not state[1]:
+                return # closed
+            now = time.time()
+            if now >= state[1] and (not state[2] or now - state[2] > opts.breaker_cooldown):
+                if DEBUG: DEBUG.info('breaker of %s half-open', host)
+                state[2] = now
+                return
+        if metrics.REGISTRY:
+            metrics.REGISTRY.inc('urlgrabber_breaker_rejections_total', host=host)
+        err = URLGrabError(19, _('Circuit breaker of %s is open') % host)
+        err.url = _urlunquote_convert(url)
+        raise err
+
+    @staticmethod
+    def update(url, ug_err, opts):
+        """Record the result of a request to the host of url"""
+        host = _TH._host(url)
+        if not host or not opts.breaker_threshold:
+            return
+        if ug_err is not None and ug_err.errno == 19:
+            return # not even tried
+        with _CB.lock:
+            if ug_err is None or not _CB._failure(ug_err):
+                if DEBUG and host in _CB.hosts: DEBUG.info('breaker of %s closed', host)
+                _CB.hosts.pop(host, None)
+                return
+            fails, until, probe = _CB.hosts.get(host) or (0, 0, 0)
+            fails += 1
+            now = time.time()
+            if probe or fails >= opts.breaker_threshold:
+                until = now + opts.breaker_cooldown
+            retry_after = getattr(ug_err, 'retry_after', None)
+            if retry_after:
+                until = max(until, now + retry_after)
+            if DEBUG and until > now: DEBUG.info('breaker of %s open for %.1fs', host, until - now)
+            _CB.hosts[host] = [fails, until, 0]
+
 #####################################################################
 #  TESTING
 def _main_test():
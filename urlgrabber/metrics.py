@@ -0,0 +1,187 @@
+#   This library is free software; you can redistribute it and/or
+#   modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+#
+#   This library is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, write to the
+#      Free Software Foundation, Inc.,
+#      59 Temple Place, Suite 330,
+#      Boston, MA  02111-1307  USA
+
+# This file is part of urlgrabber, a high-level cross-protocol url-grabber
+
+"""metrics of urlgrabber transfers
+
+DESCRIPTION
+
+  Counters, gauges and histograms of what urlgrabber does, for
+  monitoring long-running programs.  Nothing is recorded until
+  a Registry is enabled, and there are no dependencies.
+
+    from urlgrabber import metrics
+
+    registry = metrics.enable()
+    ...
+    print(registry.snapshot())
+
+  snapshot() returns the metrics in the Prometheus text format.
+  A callback given to the Registry is called with (kind, name,
+  labels, value) on each update, to feed other monitoring systems.
+
+METRICS
+
+  urlgrabber_requests_total{host,code}
+    finished transfers.  code is 'ok', or the HTTP status of a
+    failure, or 'curl#N' for libcurl errors and 'errno#N' for other
+    URLGrabErrors
+
+  urlgrabber_bytes_total{host}
+    downloaded bytes
+
+  urlgrabber_request_seconds{host}  (histogram)
+    transfer times
+
+  urlgrabber_ttfb_seconds{host}  (histogram)
+    times to the first byte of successful transfers
+
+  urlgrabber_retries_total{host}
+    retries, by the grabbers and by parallel_wait()
+
+  urlgrabber_breaker_rejections_total{host}
+    requests failed at once by an open circuit breaker
+
+  urlgrabber_mirror_failovers_total{mirror}
+    failed tries of a MirrorGroup, sync and parallel
+
+  urlgrabber_helpers_spawned_total
+    urlgrabber-ext-down processes started
+
+  urlgrabber_queue_depth
+    requests of parallel_wait() that wait to be started
+
+  urlgrabber_in_flight{host}
+    running parallel_wait() transfers
+
+  Transfers made by urlgrabber-ext-down are counted by the parent
+  from the results it gets back.
+"""
+
+import threading
+
+REGISTRY = None
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+def enable(registry=None):
+    """Start recording to registry, or to a new Registry.  Returns it."""
+    global REGISTRY
+    REGISTRY = registry or Registry()
+    return REGISTRY
+
+def disable():
+    """Stop recording metrics"""
+    global REGISTRY
+    REGISTRY = None
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+def _labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in items)
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+class Registry:
+    """A thread-safe set of counters, gauges and histograms.  Each
+    metric has samples keyed by their label values."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, callback=None):
+        self.buckets = tuple(buckets)
+        self.callback = callback
+        self._lock = threading.Lock()
+        self._metrics = {} # name => kind, {labels: value}
+
+    def _update(self, kind, name, labels, func):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = kind, {}
+            elif metric[0] != kind:
+                raise ValueError('%s is a %s' % (name, metric[0]))
+            samples = metric[1]
+            samples[key] = func(samples.get(key))
+
+    def inc(self, name, value=1, **labels):
+        """add value to a counter"""
+        self._update('counter', name, labels, lambda v: (v or 0) + value)
+        if self.callback:
+            self.callback('counter', name, labels, value)
+
+    def set(self, name, value, **labels):
+        """set a gauge"""
+        self._update('gauge', name, labels, lambda v: value)
+        if self.callback:
+            self.callback('gauge', name, labels, value)
+
+    def observe(self, name, value, **labels):
+        """add an observation to a histogram"""
+        def update(v):
+            if v is None:
+                v = [0] * len(self.buckets) + [0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    v[i] += 1
+            v[-2] += 1
+            v[-1] += value
+            return v
+        self._update('histogram', name, labels, update)
+        if self.callback:
+            self.callback('histogram', name, labels, value)
+
+    def get(self, name, **labels):
+        """The value of a counter or gauge, the (count, sum) of
+        a histogram, or None"""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            kind, samples = self._metrics.get(name) or (None, {})
+            value = samples.get(key)
+        if kind == 'histogram' and value is not None:
+            return value[-2], value[-1]
+        return value
+
+    def snapshot(self):
+        """The metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for name in sorted(self._metrics):
+                kind, samples = self._metrics[name]
+                lines.append('# TYPE %s %s' % (name, kind))
+                for key in sorted(samples):
+                    value = samples[key]
+                    if kind != 'histogram':
+                        lines.append('%s%s %s' % (name, _labels(key), _number(value)))
+                        continue
+                    bounds = self.buckets + (float('inf'),)
+                    counts = value[:len(self.buckets)] + [value[-2]]
+                    for bound, count in zip(bounds, counts):
+                        lines.append('%s_bucket%s %d' % (name,
+                                     _labels(key, [('le', _number(bound))]), count))
+                    lines.append('%s_sum%s %s' % (name, _labels(key), _number(value[-1])))
+                    lines.append('%s_count%s %d' % (name, _labels(key), value[-2]))
+        return '\n'.join(lines) + '\n'
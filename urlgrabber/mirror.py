@@ -92,6 +92,7 @@ CUSTOMIZATION
 
 
 import sys
+import time
 import random
 
 if sys.version_info >= (3,):
@@ -110,8 +111,10 @@ from six import string_types
 from .grabber import URLGrabError, CallbackObject, DEBUG, _to_utf8
 from .grabber import _run_callback, _do_raise
 from .grabber import exception2msg
-from .grabber import _TH
+from .grabber import _TH, _CB
 from .grabber import _bytes_repr
+from .grabber import _MirrorRace
+from . import metrics
 
 def _(st):
     return st
@@ -230,6 +233,37 @@ class MirrorGroup:
         CallbackObject instance).  As they contain stack frame
         references, they can lead to circular references.
 
+      race
+
+        the number of mirrors to race.  0 (the default) or 1 tries
+        one mirror at a time.  Racing starts the same request on
+        several mirrors, the best first as ranked by the timedhosts
+        estimates of the time to get the file, each race_delay
+        seconds after the previous one.  The first to get a 2xx reply
+        is kept and the others are cancelled.  A mirror that fails (handled like any other
+        failure) makes room for the next one at once.  This keeps a
+        dead or slow mirror from stalling small, latency-sensitive
+        fetches like repomd.xml for the whole timeout.
+
+        Each racing mirror gets a single try, no retries.  Racing
+        doesn't apply to async, reget, segmented, streaming, seekable
+        or cache_dir requests, nor to groups with mirrors other than
+        http, https or ftp.
+
+      race_delay
+
+        the seconds between the starts of racing requests, 0.2 by
+        default.
+
+      race_budget
+
+        the most racing transfers of the MirrorGroup at once, in all
+        threads, 8 by default.  The first transfer of a request
+        always starts.
+
+        Like default_action, these can be set at instantiation time
+        or when the urlXXX method is called.
+
     Notes:
       * The behavior can be customized by deriving and overriding the
         'CONFIGURATION METHODS'
@@ -273,15 +307,17 @@ class MirrorGroup:
         self.mirrors = self._parse_mirrors(mirrors)
         self._next = 0
         self._lock = thread.allocate_lock()
+        self._racing = 0
         self.default_action = None
         self._process_kwargs(kwargs)
 
         # use the same algorithm as parallel downloader to initially sort
-        # the mirror list (sort by speed, but prefer live private mirrors)
+        # the mirror list (sort by expected time, but prefer live private
+        # mirrors)
         def estimate(m):
             speed, fail = _TH.estimate(m['mirror'])
             private = not fail and m.get('kwargs', {}).get('private', False)
-            return private, speed
+            return private, -_TH.cost(m['mirror'])
 
         # update the initial order.  since sorting is stable, the relative
         # order of unknown (not used yet) hosts is retained.
@@ -290,11 +326,15 @@ class MirrorGroup:
     # if these values are found in **kwargs passed to one of the urlXXX
     # methods, they will be stripped before getting passed on to the
     # grabber
-    options = ['default_action', 'failure_callback']
+    options = ['default_action', 'failure_callback',
+               'race', 'race_delay', 'race_budget']
 
     def _process_kwargs(self, kwargs):
         self.failure_callback = kwargs.get('failure_callback')
         self.default_action   = kwargs.get('default_action')
+        self.race             = kwargs.get('race', 0)
+        self.race_delay       = kwargs.get('race_delay', 0.2)
+        self.race_budget      = kwargs.get('race_budget', 8)
 
     def _parse_mirrors(self, mirrors):
         return [{'mirror':_to_utf8(m)} for m in mirrors]
@@ -322,6 +362,9 @@ class MirrorGroup:
         #   inspect the error - remove=1 for 404, remove=2 for connection
         #                       refused, etc. (this can also be done via
         #                       the callback)
+        if metrics.REGISTRY:
+            metrics.REGISTRY.inc('urlgrabber_mirror_failovers_total',
+                                 mirror=_bytes_repr(cb_obj.mirror))
         cb = gr.kw.get('failure_callback') or self.failure_callback
         if cb:
             if isinstance(cb, tuple):
@@ -342,8 +385,8 @@ class MirrorGroup:
         action = a
         self.increment_mirror(gr, action)
         if action and action.get('fail', 0):
-            sys.exc_info()[1].errors = gr.errors
-            raise
+            cb_obj.exception.errors = gr.errors
+            raise cb_obj.exception
 
     def increment_mirror(self, gr, action={}):
         """Tell the mirror object increment the mirror index
@@ -413,7 +456,9 @@ class MirrorGroup:
 
         return urlparse.urlunsplit((scheme, netloc, path + sep + rel_url, query, fragid))
 
-    def _mirror_try(self, func, url, kw):
+    def _new_gr(self, func, url, kw):
+        """Create the GrabRequest for _mirror_try().  Removes the
+        MirrorGroup options from kw."""
         gr = GrabRequest()
         gr.func = func
         gr.url  = url
@@ -424,29 +469,137 @@ class MirrorGroup:
         for k in self.options:
             try: del kw[k]
             except KeyError: pass
+        return gr
+
+    def _next_try(self, gr):
+        """Pick the mirror for the next try.  Returns the mirror, the
+        full url, the grabber and the options to use."""
+        mirrorchoice = self._get_mirror(gr)
+        fullurl = self._join_url(mirrorchoice['mirror'], gr.url)
+        grabber = mirrorchoice.get('grabber') or self.grabber
+        # apply mirrorchoice kwargs on top of grabber.opts
+        opts = grabber.opts.derive(**mirrorchoice.get('kwargs', {}))
+        if DEBUG: DEBUG.info('MIRROR: trying %s -> %s', _bytes_repr(gr.url), _bytes_repr(fullurl))
+        return mirrorchoice, fullurl, grabber, opts
+
+    def _try_failed(self, gr, mirrorchoice, fullurl, tries, e):
+        """Record a failed try.  Must be called from the except clause,
+        re-raises the exception when the grab has failed for good."""
+        if DEBUG: DEBUG.info('MIRROR: failed')
+        if gr.kw.get('mirror_group') and getattr(e, 'errors', None) is gr.kw['mirror_group'][1]:
+            # a segmented grab has been through the mirrors already
+            raise e
+        gr.errors.append((fullurl, exception2msg(e)))
+        obj = CallbackObject()
+        obj.exception = e
+        obj.mirror = mirrorchoice['mirror']
+        obj.relative_url = gr.url
+        obj.url = fullurl
+        obj.tries = tries
+        self._failure(gr, obj)
+
+    def _segment_mirrors(self, url):
+        """The (url, opts, speed, mirror) of each mirror, for the
+        segment_mirrors option."""
+        sources = []
+        for mirror in self.mirrors:
+            fullurl = self._join_url(mirror['mirror'], url)
+            speed, fail = _TH.estimate(_to_utf8(mirror['mirror']))
+            grabber = mirror.get('grabber') or self.grabber
+            opts = grabber.opts.derive(**mirror.get('kwargs', {}))
+            sources.append((fullurl, opts, speed, mirror['mirror']))
+        return sources
+
+    def _race_ok(self, gr, kw):
+        """whether the mirrors of gr can be raced"""
+        if (gr.kw.get('race', self.race) < 2
+            or gr.func not in ('urlgrab', 'urlread', 'urlopen')):
+            return False
+        opts = self.grabber.opts
+        for name in ('async', 'async_', 'mirror_group', 'reget', 'stream',
+                     'seekable', 'cache_dir'):
+            if kw.get(name, getattr(opts, name, None)):
+                return False
+        if kw.get('segments', opts.segments) > 1:
+            return False
+        for mirror in gr.mirrors:
+            scheme = urlparse.urlsplit(mirror['mirror'])[0]
+            if scheme not in (b'http', b'https', b'ftp'):
+                return False
+        return True
+
+    def _race_failed(self, gr, mirrorchoice, fullurl, tries, e):
+        """_try_failed() for a racing mirror"""
+        if mirrorchoice in gr.mirrors:
+            gr._next = gr.mirrors.index(mirrorchoice)
+        self._try_failed(gr, mirrorchoice, fullurl, tries, e)
+
+    def _mirror_race(self, gr, kw):
+        race_n = gr.kw.get('race', self.race)
+        delay = gr.kw.get('race_delay', self.race_delay)
+        budget = gr.kw.get('race_budget', self.race_budget)
+        size = kw.get('size', self.grabber.opts.size)
+        def estimate(m):
+            return not _CB.is_open(m['mirror']), -_TH.cost(m['mirror'], size)
+
+        race = _MirrorRace(gr.func, kw)
+        started = []
+        counted = 0 # our transfers in self._racing
+        next_start = 0
+        try:
+            while not race.done:
+                now = time.time()
+                todo = [m for m in gr.mirrors if m not in started]
+                more = todo and race.winner is None and len(race.running) < race_n
+                if more and (not race.running or now >= next_start
+                             and self._racing < budget):
+                    mirrorchoice = max(todo, key=estimate)
+                    started.append(mirrorchoice)
+                    fullurl = self._join_url(mirrorchoice['mirror'], gr.url)
+                    grabber = mirrorchoice.get('grabber') or self.grabber
+                    opts = grabber.opts.derive(**mirrorchoice.get('kwargs', {}))
+                    next_start = now + delay
+                    try:
+                        race.start(mirrorchoice, grabber, fullurl, opts)
+                    except URLGrabError as e:
+                        self._race_failed(gr, mirrorchoice, fullurl, len(started), e)
+                        next_start = 0
+                elif not race.running:
+                    e = URLGrabError(256, _('No more mirrors to try.'))
+                    e.errors = gr.errors
+                    raise e
+                else:
+                    timeout = 1.0
+                    if more:
+                        timeout = min(max(next_start - now, 0.01), 0.1)
+                    for mirrorchoice, fullurl, e in race.perform(timeout):
+                        self._race_failed(gr, mirrorchoice, fullurl, len(started), e)
+                        next_start = 0
+                self._lock.acquire()
+                self._racing += len(race.running) - counted
+                self._lock.release()
+                counted = len(race.running)
+            return race.result
+        finally:
+            race.close()
+            self._lock.acquire()
+            self._racing -= counted
+            self._lock.release()
+
+    def _mirror_try(self, func, url, kw):
+        gr = self._new_gr(func, url, kw)
+        if self._race_ok(gr, kw):
+            return self._mirror_race(gr, kw)
 
         tries = 0
         while True:
             tries += 1
-            mirrorchoice = self._get_mirror(gr)
-            fullurl = self._join_url(mirrorchoice['mirror'], gr.url)
-            grabber = mirrorchoice.get('grabber') or self.grabber
-            # apply mirrorchoice kwargs on top of grabber.opts
-            opts = grabber.opts.derive(**mirrorchoice.get('kwargs', {}))
+            mirrorchoice, fullurl, grabber, opts = self._next_try(gr)
             func_ref = getattr(grabber, func)
-            if DEBUG: DEBUG.info('MIRROR: trying %s -> %s', _bytes_repr(url), _bytes_repr(fullurl))
             try:
                 return func_ref( *(fullurl,), opts=opts, **kw )
             except URLGrabError as e:
-                if DEBUG: DEBUG.info('MIRROR: failed')
-                gr.errors.append((fullurl, exception2msg(e)))
-                obj = CallbackObject()
-                obj.exception = e
-                obj.mirror = mirrorchoice['mirror']
-                obj.relative_url = gr.url
-                obj.url = fullurl
-                obj.tries = tries
-                self._failure(gr, obj)
+                self._try_failed(gr, mirrorchoice, fullurl, tries, e)
 
     def urlgrab(self, url, filename=None, **kwargs):
         kw = dict(kwargs)
@@ -457,6 +610,11 @@ class MirrorGroup:
             kw['relative_url'] = url
         else:
             kw.pop('failfunc', None)
+            if kw.get('segments', self.grabber.opts.segments) > 1:
+                # failed ranges fail over like async_ requests
+                kw['segment_mirrors'] = self._segment_mirrors(url)
+                kw['mirror_group'] = self, [], {}, set()
+                kw['relative_url'] = url
         func = 'urlgrab'
         try:
             return self._mirror_try(func, url, kw)